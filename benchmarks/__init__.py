@@ -0,0 +1,6 @@
+# coding=utf-8
+"""
+Micro benchmarks for pycolo. Run them from the repository root, e.g.::
+
+    python -m benchmarks.bench_from_raw
+"""
@@ -0,0 +1,41 @@
+# coding=utf-8
+"""
+Header extraction for a receive batch: :func:`pycolo.message.decode_batch`
+against decoding every datagram with :meth:`Message.from_raw`.
+"""
+
+import timeit
+
+from pycolo.codes import codes, msgType
+from pycolo.message import Message, decode_batch
+
+BATCH = 1024
+ROUNDS = 50
+
+
+def main():
+    datagrams = [
+        Message(
+            msg_type=msgType.con if mid % 4 else msgType.ack,
+            status_code=codes.get,
+            message_id=mid,
+            token=b"\x10\x20",
+            options={11: ["sensors", "temperature"]},
+            payload="21.5",
+        ).to_raw()
+        for mid in range(BATCH)]
+
+    per_message = timeit.timeit(
+        lambda: [Message().from_raw(datagram) for datagram in datagrams], number=ROUNDS)
+    batched = timeit.timeit(lambda: decode_batch(datagrams), number=ROUNDS)
+    filtered = timeit.timeit(
+        lambda: decode_batch(datagrams).select(msg_type=msgType.ack), number=ROUNDS)
+
+    print("%-28s %12s" % ("headers of %d datagrams" % BATCH, "msg/s"))
+    print("%-28s %12.0f" % ("from_raw per datagram", BATCH * ROUNDS / per_message))
+    print("%-28s %12.0f" % ("decode_batch", BATCH * ROUNDS / batched))
+    print("%-28s %12.0f" % ("decode_batch + select", BATCH * ROUNDS / filtered))
+
+
+if __name__ == '__main__':
+    main()
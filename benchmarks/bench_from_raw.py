@@ -0,0 +1,85 @@
+# coding=utf-8
+"""
+Decoding throughput of :meth:`pycolo.message.Message.from_raw`.
+
+The previous decoder sliced the datagram for every field and rebuilt its
+``struct`` formats on each call. It is kept below as ``legacy_from_raw`` so
+both paths can be compared on the datagrams it was able to decode (header and
+payload only: its token and option branches did not work).
+"""
+
+import logging
+import timeit
+from struct import unpack, calcsize
+
+from pycolo.codes import codes, msgType
+from pycolo.message import Message
+
+ROUNDS = 50000
+
+
+def legacy_from_raw(self, raw):
+    """
+    Header and payload part of the decoder previously used by from_raw.
+    """
+    PAYLOAD_MARKER = b"\xff"
+    pointer = 0
+
+    ver_t_tkl_pattern = "!B"
+    ver_t_tkl = unpack(ver_t_tkl_pattern, raw[pointer: pointer + calcsize(ver_t_tkl_pattern)])
+    ver_t_tkl = ver_t_tkl[0]
+    self.version = ver_t_tkl & 192 >> 6
+    self.msg_type = ver_t_tkl & 48 >> 4
+    pointer += calcsize(ver_t_tkl_pattern)
+
+    code_pattern = "!B"
+    code = unpack(code_pattern, raw[pointer: pointer + calcsize(code_pattern)])
+    self.status_code = code[0]
+    pointer += calcsize(code_pattern)
+
+    message_id_pattern = "!H"
+    message_id = unpack(message_id_pattern, raw[pointer: pointer + calcsize(message_id_pattern)])
+    self.message_id = message_id[0]
+    pointer += calcsize(message_id_pattern)
+
+    payload_marker_pattern = "!B"
+    while raw[pointer: pointer + calcsize(payload_marker_pattern)] != PAYLOAD_MARKER and len(raw[pointer:]):
+        logging.error("Options are not supported by the legacy decoder")
+        return None
+
+    if len(raw[pointer:]) and raw[pointer] == b"\xff"[0]:
+        self.payload = raw[pointer + 1:].decode("utf-8")
+    else:
+        self.payload = None
+    return self
+
+
+def rate(function, raw):
+    """
+    Decoded messages per second for one datagram.
+    """
+    seconds = timeit.timeit(lambda: function(Message(), raw), number=ROUNDS)
+    return ROUNDS / seconds
+
+
+def main():
+    simple = Message(
+        msg_type=msgType.con,
+        status_code=codes.get,
+        message_id=12345,
+        payload="Hello",
+    ).to_raw()
+    options = b"".join([
+        b"\x44\x01\x30\x39\x01\x02\x03\x04",
+        b"\xb4temp\x04room\x43a=1\x03b=2\x81\x02",
+        b"\xffHello",
+    ])
+
+    print("%-28s %12s" % ("datagram", "msg/s"))
+    print("%-28s %12.0f" % ("header+payload (legacy)", rate(legacy_from_raw, simple)))
+    print("%-28s %12.0f" % ("header+payload", rate(Message.from_raw, simple)))
+    print("%-28s %12.0f" % ("token+5 options+payload", rate(Message.from_raw, options)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# coding=utf-8
+"""
+Cost of option decoding in :meth:`pycolo.message.Message.from_raw` for
+option-heavy requests, when only Uri-Path is inspected (routing, early
+rejection) compared to full materialization of every option.
+"""
+
+import timeit
+
+from pycolo.codes import codes, msgType
+from pycolo.message import Message
+
+ROUNDS = 50000
+
+URI_PATH = 11
+
+
+def request():
+    """
+    A typical proxied GET: host, port, four path segments, three queries,
+    Accept, Block2 and an ETag.
+    """
+    return Message(
+        msg_type=msgType.con,
+        status_code=codes.get,
+        message_id=4242,
+        token=b"\x8a\x13\x05\xc7",
+        options={
+            1: [b"\x01\x02\x03\x04"],
+            3: "gateway.example.org",
+            7: 5683,
+            11: ["building", "floor3", "room12", "temperature"],
+            15: ["unit=celsius", "precision=2", "history=24h"],
+            16: [50],
+            23: 0x16,
+        },
+    ).to_raw()
+
+
+def main():
+    raw = request()
+    runs = [
+        ("eager, Uri-Path only", lambda: Message().from_raw(raw, lazy=False).options[URI_PATH]),
+        ("lazy, Uri-Path only", lambda: Message().from_raw(raw).options[URI_PATH]),
+        ("lazy, all options", lambda: dict(Message().from_raw(raw).options)),
+    ]
+    print("%-24s %12s" % ("decoding", "msg/s"))
+    for name, function in runs:
+        seconds = timeit.timeit(function, number=ROUNDS)
+        print("%-24s %12.0f" % (name, ROUNDS / seconds))
+
+
+if __name__ == '__main__':
+    main()
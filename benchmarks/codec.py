@@ -0,0 +1,186 @@
+# coding=utf-8
+"""
+Codec benchmark suite: throughput and allocations of
+:meth:`Message.to_raw`, :meth:`Message.encode_into` and
+:meth:`Message.from_raw` for representative messages.
+
+Results are written as JSON so that runs can be compared between releases::
+
+    python -m benchmarks.codec --output bench_output.txt
+
+``blocks_per_op`` counts the memory blocks still allocated per operation
+while every result is kept alive (the result and what it references), and
+``bytes_per_op`` is the matching traced size. Transient objects freed
+within an operation only show up in the throughput.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import timeit
+import tracemalloc
+
+import pycolo
+from pycolo.codes import codes, msgType, options, optionTable
+from pycolo.message import Message, MAX_DATAGRAM_SIZE
+
+
+def empty_ack():
+    """
+    Empty acknowledgement, header only.
+    """
+    return Message(msg_type=msgType.ack, status_code=codes.empty, message_id=0x1234)
+
+
+def get_request():
+    """
+    Typical GET with a token, a multi-segment Uri-Path and Uri-Query.
+    """
+    return Message(
+        msg_type=msgType.con,
+        status_code=codes.get,
+        message_id=0x1234,
+        token=b"\x3a\x8c\x01\xfe",
+        options={
+            options.uri_host: "sensors.example.org",
+            options.uri_path: ["building", "floor3", "room12", "temperature"],
+            options.uri_query: ["unit=celsius", "precision=2"],
+            options.accept: [50],
+        })
+
+
+def block2_response():
+    """
+    Block2 response carrying a 1024 bytes block of a larger representation.
+    """
+    return Message(
+        msg_type=msgType.ack,
+        status_code=codes.content,
+        message_id=0x1234,
+        token=b"\x3a\x8c\x01\xfe",
+        options={
+            options.content_format: 42,
+            options.etag: [b"\x00\x01\x02\x03"],
+            options.block2: 3 << 4 | 1 << 3 | 6,
+            options.size2: 65536,
+        },
+        payload=bytes(range(256)) * 4)
+
+
+def max_options():
+    """
+    Every known option once, at its maximum length.
+    """
+    values = {}
+    for option in optionTable:
+        if option is None:
+            continue
+        if option.format == "string":
+            value = "x" * option.max_length
+        elif option.format == "opaque":
+            value = b"\xff" * option.max_length
+        elif option.format == "uint":
+            value = (1 << 8 * option.max_length) - 1
+        else:
+            value = True
+        values[option.number] = [value] if option.repeatable else value
+    return Message(
+        msg_type=msgType.con,
+        status_code=codes.put,
+        message_id=0x1234,
+        token=b"\xff" * 8,
+        options=values)
+
+
+SCENARIOS = [
+    ("empty_ack", empty_ack),
+    ("get_request", get_request),
+    ("block2_response", block2_response),
+    ("max_options", max_options),
+]
+
+
+def throughput(function, rounds):
+    """
+    Operations per second, best of three runs.
+    """
+    return rounds / min(timeit.repeat(function, number=rounds, repeat=3))
+
+
+def allocations(function, rounds):
+    """
+    Memory blocks and traced bytes retained per operation.
+    """
+    results = [None] * rounds
+    gc.collect()
+    gc.disable()
+    try:
+        before = sys.getallocatedblocks()
+        for i in range(rounds):
+            results[i] = function()
+        blocks = sys.getallocatedblocks() - before
+        results = [None] * rounds
+        tracemalloc.start()
+        for i in range(rounds):
+            results[i] = function()
+        traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        gc.enable()
+    return blocks / rounds, traced / rounds
+
+
+def run(rounds):
+    """
+    Runs every scenario and returns the results.
+    """
+    results = []
+    buffer = bytearray(MAX_DATAGRAM_SIZE)
+    for name, factory in SCENARIOS:
+        msg = factory()
+        raw = msg.to_raw()
+        operations = [
+            ("to_raw", msg.to_raw),
+            ("encode_into", lambda: msg.encode_into(buffer)),
+            ("from_raw", lambda: Message().from_raw(raw)),
+            ("from_raw_eager", lambda: Message().from_raw(raw, lazy=False)),
+        ]
+        for operation, function in operations:
+            blocks, traced = allocations(function, min(rounds, 10000))
+            results.append({
+                "scenario": name,
+                "operation": operation,
+                "size": len(raw),
+                "ops_per_sec": round(throughput(function, rounds)),
+                "blocks_per_op": round(blocks, 2),
+                "bytes_per_op": round(traced, 1),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rounds", type=int, default=20000,
+                        help="operations per timing run")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    report = {
+        "pycolo": pycolo.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "rounds": args.rounds,
+        "results": run(args.rounds),
+    }
+    dump = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(dump + "\n")
+    else:
+        print(dump)
+
+
+if __name__ == '__main__':
+    main()
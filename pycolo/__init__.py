@@ -26,14 +26,28 @@ CoAP Protocol constants
 :MESSAGE_CACHE_SIZE: capacity (in messages) for caches.
     Used for duplicate detection and retransmissions.
 
+:EXCHANGE_LIFETIME: time (in milliseconds) from the first transmission of
+    a confirmable message until its message ID may be reused, as defined in
+    RFC 7252, section 4.8.2. Entries of the message caches expire after it.
+
 :RX_BUFFER_SIZE:
     buffer size for incoming datagrams, in bytes
 
+:BLOCKWISE_STORE_SIZE: maximum number of blockwise transfers in progress
+    kept by an endpoint
+
+:BLOCKWISE_STORE_BUDGET: bytes the blockwise transfers in progress of an
+    endpoint may hold in memory together
+
 :DEFAULT_OVERALL_TIMEOUT: time (in milliseconds)
     for transaction to complete.
     Used to avoid infinite waits for replies to non-confirmables and separate
     responses
 
+:NSTART:
+    maximum number of outstanding confirmable requests to one endpoint, as
+    defined in RFC 7252, section 4.7
+
 :RESPONSE_TIMEOUT & RESPONSE_RANDOM_FACTOR:
     constants to calculate initial timeout for confirmable messages,
     used by the exponential backoff mechanism
@@ -45,14 +59,18 @@ __title__ = 'pycolo'
 __author__ = 'Rémy Léone'
 __version__ = '0.0.1'
 
-MESSAGE_CACHE_SIZE = 32
+MESSAGE_CACHE_SIZE = 8192
 DEFAULT_BLOCK_SIZE = 512
 DEFAULT_PORT = 5683
 URI_SCHEME_NAME = "coap"
 MAX_RETRANSMIT = 4
+NSTART = 1
 OBSERVING_REFRESH_INTERVAL = 10
 RESPONSE_TIMEOUT = 2000  # [milliseconds]
 RESPONSE_RANDOM_FACTOR = 1.5
 RX_BUFFER_SIZE = 4 * 1024
+BLOCKWISE_STORE_SIZE = 4096
+BLOCKWISE_STORE_BUDGET = 16 * 1024 * 1024
 DEFAULT_OVERALL_TIMEOUT = 60000
+EXCHANGE_LIFETIME = 247000
 PROTOCOL_VERSION = 1
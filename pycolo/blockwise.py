@@ -0,0 +1,616 @@
+# coding=utf-8
+
+"""
+pycolo.blockwise
+~~~~~~~~~~~~~~~~
+
+Helpers for blockwise transfers (Block1 and Block2 options) and the block
+sources streaming a representation block by block. A block NUM/SZX reads
+only its slice of the source: bytes-like objects and mmaps are sliced
+through a memoryview without copying, files are read at the block offset
+and generators are consumed as blocks are demanded.
+
+PeerStatistics adapts the block size to each peer from the round-trip
+times and retransmissions measured by the transaction layer, and
+BlockwiseStore bounds the state kept for transfers in progress.
+"""
+
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from pycolo import BLOCKWISE_STORE_SIZE, EXCHANGE_LIFETIME
+from pycolo.codes import options
+from pycolo.message import Message
+
+# Largest SZX, 1024-byte blocks. 7 is reserved.
+MAX_SZX = 6
+
+
+def encodeSZX(blockSize):
+    """
+    :param blockSize: a block size, power of two between 16 and 1024
+    :return: the SZX encoding the size
+    """
+    return blockSize.bit_length() - 5
+
+
+def decodeSZX(szx):
+    """
+    :param szx: a SZX
+    :return: the block size it encodes, in bytes
+    """
+    return 1 << (szx + 4)
+
+
+def validSZX(szx):
+    """
+    :param szx: a SZX
+    :return: True if the SZX encodes a block size
+    """
+    return 0 <= szx <= MAX_SZX
+
+
+class BlockOption(namedtuple("BlockOption", ["num", "m", "szx"])):
+    """
+    Value of a Block1 or Block2 option: block number, more flag and size
+    exponent.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromValue(cls, value):
+        """
+        :param value: the option value, as an integer
+        :return: the BlockOption
+        """
+        return cls(value >> 4, bool(value & 0x8), value & 0x7)
+
+    @property
+    def value(self):
+        """
+        :return: the option value, as an integer
+        """
+        return self.num << 4 | self.m << 3 | self.szx
+
+    @property
+    def size(self):
+        return decodeSZX(self.szx)
+
+    @property
+    def offset(self):
+        return self.num * self.size
+
+    def __str__(self):
+        return "NUM: %d, SZX: %d (%d bytes), M: %d" % (self.num, self.szx, self.size, self.m)
+
+
+class BufferSource:
+    """
+    Block source over a bytes-like object or an mmap, sliced without
+    copying.
+
+    :param data: the representation
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.length = len(self.view)
+
+    def read(self, offset, size):
+        """
+        :param offset: position of the block
+        :param size: size of the block
+        :return: the block, shorter than size at the end of the
+            representation, None if offset is beyond its end
+        """
+        if offset >= self.length and offset:
+            return None
+        return self.view[offset:offset + size]
+
+    def more(self, end):
+        """
+        :param end: position following a block
+        :return: True if the representation continues after end
+        """
+        return end < self.length
+
+    def footprint(self):
+        """
+        :return: the number of bytes the source holds in memory
+        """
+        return 0 if isinstance(self.data, mmap.mmap) else self.length
+
+    def close(self):
+        self.view.release()
+
+
+class MmapSource(BufferSource):
+    """
+    Block source mapping a file into memory, the pages of a block are only
+    read when it is demanded.
+
+    :param path: path of the file
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b""
+        super().__init__(data)
+
+    def close(self):
+        super().close()
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # blocks still referenced, e.g. by a reply cache
+                pass
+
+
+class FileSource:
+    """
+    Block source reading a seekable binary file at the offset of each block.
+    Each block is read straight into a buffer of its own, that stays valid
+    while messages referencing it are cached.
+
+    :param file: a binary file object
+    """
+
+    def __init__(self, file):
+        self.file = file
+        file.seek(0, os.SEEK_END)
+        self.length = file.tell()
+
+    def read(self, offset, size):
+        if offset >= self.length and offset:
+            return None
+        block = bytearray(min(size, self.length - offset))
+        self.file.seek(offset)
+        count = self.file.readinto(block)
+        return memoryview(block)[:count]
+
+    def more(self, end):
+        return end < self.length
+
+    def footprint(self):
+        return 0
+
+    def close(self):
+        self.file.close()
+
+
+class GeneratorSource:
+    """
+    Block source consuming an iterable of byte chunks of any size. Blocks
+    must be demanded in order; the last block served can be demanded again,
+    e.g. after a lost response. The length is unknown until the iterable is
+    exhausted.
+
+    :param chunks: iterable of bytes-like objects
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+        # position of the first byte of buffer in the representation
+        self.start = 0
+        self.length = None
+
+    def fill(self, end):
+        """
+        Consumes chunks until the buffer reaches end or the iterable is
+        exhausted.
+        """
+        while self.length is None and self.start + len(self.buffer) < end:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.length = self.start + len(self.buffer)
+            else:
+                self.buffer += chunk
+
+    def read(self, offset, size):
+        if offset < self.start:
+            return None
+        self.fill(offset + size)
+        if self.length is not None and offset >= self.length and offset:
+            return None
+        # drop what precedes the block
+        del self.buffer[:offset - self.start]
+        self.start = offset
+        return bytes(self.buffer[:size])
+
+    def more(self, end):
+        self.fill(end + 1)
+        return self.length is None or end < self.length
+
+    def footprint(self):
+        return len(self.buffer)
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+        self.buffer = bytearray()
+
+
+def isStream(payload):
+    """
+    :param payload: a message payload
+    :return: True if the payload is a block source, a file, an mmap or an
+        iterable rather than bytes or text
+    """
+    return payload is not None and not isinstance(payload, (bytes, bytearray, memoryview, str))
+
+
+def sourceFor(payload):
+    """
+    Wraps a payload into a block source.
+
+    :param payload: bytes-like, text, mmap, block source, binary file or
+        iterable of byte chunks
+    :return: the block source
+    """
+    if hasattr(payload, "more"):
+        return payload
+    if isinstance(payload, str):
+        return BufferSource(payload.encode("utf-8"))
+    if isinstance(payload, (bytes, bytearray, memoryview, mmap.mmap)):
+        return BufferSource(payload)
+    if hasattr(payload, "readinto") and payload.seekable():
+        return FileSource(payload)
+    return GeneratorSource(payload)
+
+
+class PeerStatistics:
+    """
+    Round-trip time and loss statistics of the peers of an endpoint, and
+    the block size chosen for each of them.
+
+    Round-trip times are smoothed as for the retransmission timeout of TCP
+    and only sampled from exchanges completed without retransmission. The
+    loss rate is a moving average of the exchanges that needed
+    retransmissions, or whose messages the peer had to retransmit. The SZX
+    of a peer shrinks by one when the loss rate exceeds shrinkLoss, and
+    grows by one after growAfter exchanges without loss nor round-trip time
+    spike while the loss rate stays under growLoss: blocks grow toward 1024
+    bytes on clean links and shrink on lossy paths, where every fragment of
+    a large block is a chance to lose it.
+
+    :param defaultSZX: the SZX of new peers
+    :param minSZX: the smallest SZX chosen
+    :param maxSZX: the largest SZX chosen
+    :param capacity: number of peers kept, the least recently seen are
+        forgotten first
+    """
+
+    # Weight of a new sample in the loss rate
+    LOSS_GAIN = 1 / 8
+    # Weights of a new sample in the smoothed round-trip time and variation
+    RTT_GAIN = 1 / 8
+    RTTVAR_GAIN = 1 / 4
+
+    class Peer:
+        """
+        Entity class to keep the statistics of a peer
+        """
+        __slots__ = ("szx", "srtt", "rttvar", "loss", "clean", "exchanges", "retransmissions", "changes")
+
+        def __init__(self, szx):
+            self.szx = szx
+            self.srtt = None
+            self.rttvar = 0.0
+            self.loss = 0.0
+            #  exchanges without loss since the last change of SZX
+            self.clean = 0
+            self.exchanges = 0
+            self.retransmissions = 0
+            self.changes = 0
+
+    def __init__(self, defaultSZX, minSZX=0, maxSZX=MAX_SZX, capacity=4096,
+                 shrinkLoss=0.2, growLoss=0.05, growAfter=16):
+        self.defaultSZX = defaultSZX
+        self.minSZX = minSZX
+        self.maxSZX = maxSZX
+        self.capacity = capacity
+        self.shrinkLoss = shrinkLoss
+        self.growLoss = growLoss
+        self.growAfter = growAfter
+        self.peers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def getPeer(self, address):
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = self.Peer(self.defaultSZX)
+            if len(self.peers) > self.capacity:
+                self.peers.popitem(last=False)
+        else:
+            self.peers.move_to_end(address)
+        return peer
+
+    def getSZX(self, address):
+        """
+        :param address: the address of the peer
+        :return: the SZX of the blocks sent to the peer
+        """
+        with self.lock:
+            peer = self.peers.get(address)
+            return self.defaultSZX if peer is None else peer.szx
+
+    def recordExchange(self, address, rtt=None, retransmissions=0):
+        """
+        Records a completed exchange with a peer.
+
+        :param address: the address of the peer
+        :param rtt: the round-trip time, in seconds, None if it cannot be
+            sampled
+        :param retransmissions: the number of retransmissions it needed
+        """
+        with self.lock:
+            peer = self.getPeer(address)
+            peer.exchanges += 1
+            peer.retransmissions += retransmissions
+            lost = retransmissions > 0
+            peer.loss += ((1.0 if lost else 0.0) - peer.loss) * self.LOSS_GAIN
+            spike = False
+            if rtt is not None and not lost:
+                if peer.srtt is None:
+                    peer.srtt = rtt
+                    peer.rttvar = rtt / 2
+                else:
+                    spike = rtt > peer.srtt + 4 * peer.rttvar
+                    peer.rttvar += (abs(peer.srtt - rtt) - peer.rttvar) * self.RTTVAR_GAIN
+                    peer.srtt += (rtt - peer.srtt) * self.RTT_GAIN
+            if lost or spike:
+                peer.clean = 0
+                if lost and peer.loss > self.shrinkLoss and peer.szx > self.minSZX:
+                    peer.szx -= 1
+                    peer.changes += 1
+                    # the smaller blocks have to prove themselves
+                    peer.loss = self.shrinkLoss / 2
+            else:
+                peer.clean += 1
+                if peer.clean >= self.growAfter and peer.loss < self.growLoss and peer.szx < self.maxSZX:
+                    peer.szx += 1
+                    peer.changes += 1
+                    peer.clean = 0
+
+    def recordLoss(self, address):
+        """
+        Records an exchange that failed or that the peer retransmitted.
+
+        :param address: the address of the peer
+        """
+        self.recordExchange(address, None, 1)
+
+    def getStats(self):
+        stats = dict()
+        with self.lock:
+            for address, peer in self.peers.items():
+                stats[address] = {
+                    "Block size": decodeSZX(peer.szx),
+                    "SRTT (ms)": None if peer.srtt is None else peer.srtt * 1000,
+                    "RTTVAR (ms)": peer.rttvar * 1000,
+                    "Loss rate": peer.loss,
+                    "Exchanges": peer.exchanges,
+                    "Retransmissions": peer.retransmissions,
+                    "Block size changes": peer.changes}
+        return stats
+
+
+class BlockwiseStore:
+    """
+    Bounded store of the state of blockwise transfers, by key, in least
+    recently used order. An entry not accessed for idleTimeout seconds is
+    considered abandoned and expires; the least recently used entries are
+    evicted once more than capacity entries, or more than budget bytes,
+    are held. Expired and evicted entries are handed to onDrop, e.g. to
+    close their source. Expiry is checked whenever the store is accessed,
+    from the least recently used entry on, so it costs O(1) per expired
+    entry.
+
+    :param budget: bytes the entries may hold together, None for no limit
+    :param idleTimeout: seconds after which an entry not accessed expires
+    :param capacity: maximum number of entries
+    :param onDrop: called with the key and the value of each entry expired
+        or evicted
+    :param clock: monotonic clock, in seconds
+    """
+
+    def __init__(self, budget=None, idleTimeout=EXCHANGE_LIFETIME / 1000, capacity=BLOCKWISE_STORE_SIZE,
+                 onDrop=None, clock=time.monotonic):
+        self.budget = budget
+        self.idleTimeout = idleTimeout
+        self.capacity = capacity
+        self.onDrop = onDrop
+        self.clock = clock
+        # key: [value, size, last access]
+        self.entries = OrderedDict()
+        self.used = 0
+        self.evictions = 0
+        self.abandoned = 0
+        self.lock = threading.Lock()
+
+    def put(self, key, value, size=0):
+        """
+        Stores an entry, replacing the entry of the key if any.
+
+        :param key: the key of the entry
+        :param value: the state to store
+        :param size: the number of bytes the state holds
+        :return: False if the entry alone exceeds the budget and was not
+            stored
+        """
+        dropped = []
+        with self.lock:
+            now = self.clock()
+            self._expire(now, dropped)
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.used -= entry[1]
+                if entry[0] is not value:
+                    dropped.append((key, entry[0]))
+            stored = self.budget is None or size <= self.budget
+            if stored:
+                self.entries[key] = [value, size, now]
+                self.used += size
+                self._evict(key, dropped)
+        self._drop(dropped)
+        return stored
+
+    def get(self, key, default=None):
+        """
+        :param key: the key of an entry
+        :param default: returned if the store has no entry for key
+        :return: the value of the entry, which becomes the most recently
+            used
+        """
+        dropped = []
+        with self.lock:
+            now = self.clock()
+            self._expire(now, dropped)
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] = now
+                self.entries.move_to_end(key)
+        self._drop(dropped)
+        return default if entry is None else entry[0]
+
+    def resize(self, key, size):
+        """
+        Updates the number of bytes held by an entry, evicting the least
+        recently used entries if the budget is exceeded.
+
+        :param key: the key of an entry
+        :param size: the number of bytes it now holds
+        :return: False if the entry was evicted, alone exceeding the budget
+        """
+        dropped = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            self.used += size - entry[1]
+            entry[1] = size
+            stored = self._evict(key, dropped)
+        self._drop(dropped)
+        return stored
+
+    def pop(self, key, default=None):
+        """
+        Removes an entry without handing it to onDrop.
+
+        :param key: the key of the entry
+        :param default: returned if the store has no entry for key
+        :return: the value of the entry
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            self.used -= entry[1]
+        return entry[0]
+
+    def expire(self):
+        """
+        Drops the entries idle for more than idleTimeout.
+        """
+        dropped = []
+        with self.lock:
+            self._expire(self.clock(), dropped)
+        self._drop(dropped)
+
+    def _expire(self, now, dropped):
+        entries = self.entries
+        while entries:
+            key = next(iter(entries))
+            entry = entries[key]
+            if now - entry[2] < self.idleTimeout:
+                break
+            del entries[key]
+            self.used -= entry[1]
+            self.abandoned += 1
+            dropped.append((key, entry[0]))
+
+    def _evict(self, key, dropped):
+        """
+        Evicts least recently used entries until the store is within its
+        bounds, the entry of key last.
+
+        :return: False if the entry of key was evicted
+        """
+        entries = self.entries
+        while entries and (len(entries) > self.capacity or self.budget is not None and self.used > self.budget):
+            victim = next(iter(entries))
+            if victim == key and len(entries) > 1:
+                # spare the entry being stored while others remain
+                entries.move_to_end(key)
+                continue
+            entry = entries.pop(victim)
+            self.used -= entry[1]
+            self.evictions += 1
+            dropped.append((victim, entry[0]))
+            if victim == key:
+                return False
+        return True
+
+    def _drop(self, dropped):
+        for key, value in dropped:
+            logging.info("Dropped blockwise state: %s", key)
+            if self.onDrop is not None:
+                try:
+                    self.onDrop(key, value)
+                except Exception:
+                    logging.exception("Failed to drop blockwise state: %s", key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getStats(self):
+        stats = dict()
+        with self.lock:
+            stats["Entries"] = len(self.entries)
+            stats["Bytes"] = self.used
+            stats["Budget"] = self.budget
+            stats["Evictions"] = self.evictions
+            stats["Abandoned"] = self.abandoned
+        return stats
+
+
+def getBlock(msg, source, num, szx, number=options.block2):
+    """
+    Builds the message carrying one block of a representation.
+
+    :param msg: the message the block is cut from, its type, message ID,
+        token, peer address and options are copied
+    :param source: the block source of the representation
+    :param num: the block number
+    :param szx: the block size exponent
+    :param number: the option, Block2 or Block1
+    :return: the message, None if the block is beyond the representation
+    """
+    size = decodeSZX(szx)
+    payload = source.read(num * size, size)
+    if payload is None:
+        return None
+    more = source.more(num * size + len(payload))
+    block = Message(
+        msg_type=msg.msg_type,
+        status_code=msg.status_code,
+        message_id=msg.message_id,
+        token=msg.token,
+        options=dict(msg.options),
+        payload=payload,
+        peerAddress=msg.peerAddress)
+    block.options[number] = BlockOption(num, more, szx).value
+    if source.length is not None and number == options.block2:
+        block.options[options.size2] = source.length
+    return block
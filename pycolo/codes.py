@@ -11,9 +11,13 @@ Registry of all constant status code
 
 :options:
     describes the CoAP Option Number Registry
+
+:optionTable:
+    option descriptors (format, repeatability, length bounds and codec)
+    indexed by option number
 """
 
-from struct import pack, unpack
+from collections import namedtuple
 from pycolo import DEFAULT_PORT
 from pycolo.structures import LookupDict
 
@@ -41,6 +45,7 @@ _codes = {
     67: ("RESP_VALID", "2.03 Valid", "valid"),
     68: ("RESP_CHANGED", "2.04 Changed", "changed"),
     69: ("RESP_CONTENT", "2.05 Content", "content"),
+    95: ("RESP_CONTINUE", "2.31 Continue"),
 
     #  class 4.xx
     128: ("RESP_BAD_REQUEST", "4.00 Bad Request"),
@@ -93,130 +98,108 @@ _mediaCode = {
     51: ("APPLICATION_X_OBIX_BINARY", "xObixBin"),
 }
 
-# Encoders
+# Media types whose payload is text, encoded in UTF-8
+textMediaCodes = frozenset([0, 1, 2, 3, 40, 41, 43, 44, 45, 46, 50])
 
+# Option value codecs, one pair per option format
 
-def string_once(min_size, max_size, default=None):
-    """
-    TODO
 
-    :param min_size:
-    :param max_size:
-    :param default:
-    :return:
-    """
-    return {
-        "range": range(min_size, max_size),
-        "repeat": False,
-        "format": "str",
-        "encoder": lambda x: b"" if x == default else x.encode("utf-8"),
-        "decoder": lambda raw: raw.decode("utf-8")
-    }
+def _encode_empty(value):
+    return b""
 
 
-def string_many(min_size, max_size, default=None):
-    """
-    Repeatable string option.
+def _decode_empty(raw):
+    return True
 
-    :param min_size:
-    :param max_size:
-    :param default:
-    :return:
-    """
-    return {
-        "range": range(min_size, max_size),
-        "repeat": True,
-        "encoder": lambda x: b"" if x == default else x.encode("utf-8"),
-        "decoder": lambda raw: raw.decode("utf-8")
-    }
 
+def _encode_opaque(value):
+    return bytes(value)
 
-def opaque_256_many(min_size, max_size, default=None):
-    """
-    TODO
 
-    :param min_size:
-    :param max_size:
-    :param default:
-    :return:
-    """
-    return {
-        "range": range(min_size, max_size),
-        "repeat": True,
-        "format": "opaque",
-        "encoder": lambda x: b"" if x == default else pack("!H", x),
-        "decoder": lambda raw: raw
-    }
+def _decode_opaque(raw):
+    return bytes(raw)
 
 
-def presence_once():
-    """
-    TODO
+def _encode_uint(value):
+    return value.to_bytes((value.bit_length() + 7) // 8, "big")
 
-    :return:
-    """
-    return {
-        "repeat": False,
-        "format": None,
-        "encoder": lambda x: b"",
-        "decoder": lambda raw: True
-    }
 
+def _decode_uint(raw):
+    return int.from_bytes(raw, "big")
 
-def uint_once(min_size, max_size, default=None):
-    """
-    TODO
 
-    :param min_size:
-    :param max_size:
-    :param default:
-    :return:
-    """
-    return {
-        "range": range(min_size, max_size),
-        "repeat": False,
-        "encoder": lambda x: b"" if x == default else pack("!H", x),
-        "decoder": lambda raw: unpack("!H", raw)
-    }
+def _encode_string(value):
+    return value.encode("utf-8")
 
 
-def uint_many(min_size, max_size, default=None):
-    """
-    TODO
+def _decode_string(raw):
+    return str(raw, "utf-8")
 
-    :param min_size:
-    :param max_size:
-    :param default:
-    :return:
-    """
-    return {
-        "range": range(min_size, max_size),
-        "repeat": True,
-        "encoder": lambda x: b"" if x == default else pack("!H", x),
-        "decoder": lambda raw: unpack("!H", raw)
-    }
-
-options = {
-    1: opaque_256_many(0, 8).update(name="If-Match"),  # core-coap-12
-    3: string_once(1, 255).update(name="Uri-Host"),  # core-coap-12
-    4: opaque_256_many(1, 8).update(name="etag"),  # core-coap-12 !! once in rp
-    5: presence_once().update(name="if_none_match"),  # core-coap-12
-    6: uint_once(0, 3).update(name="observe"),  # core-observe-07
-    7: uint_once(0, 2, DEFAULT_PORT).update(name="uri_port"),  # core-coap-12
-    8: string_many(0, 255).update(name="location_path"),  # core-coap-12
-    11: string_many(0, 255).update(name="uri_path"),  # core-coap-12
-    12: uint_once(0, 2).update(name="content_format"),  # core-coap-12
-    14: uint_once(0, 4, 60).update(name="max_age"),  # core-coap-12
-    15: string_many(0, 255).update(name="uri_query"),  # core-coap-12
-    16: uint_many(0, 2).update(name="accept"),  # core-coap-12
-    20: string_many(0, 255).update(name="location_query"),  # core-coap-12
-    23: uint_once(0, 3).update(name="block2"),  # core-block-10
-    27: uint_once(0, 3).update(name="block1"),  # core-block-10
-    28: uint_once(0, 4).update(name="size"),  # core-block-10
-    35: string_many(1, 1034).update(name="proxy_uri")  # core-coap-12
+
+_formats = {
+    "empty": (_encode_empty, _decode_empty),
+    "opaque": (_encode_opaque, _decode_opaque),
+    "uint": (_encode_uint, _decode_uint),
+    "string": (_encode_string, _decode_string),
+}
+
+OptionDescriptor = namedtuple("OptionDescriptor", [
+    "number", "name", "format", "repeatable",
+    "min_length", "max_length", "default", "encoder", "decoder"])
+
+_options = {
+    #  number: (names, format, repeatable, min length, max length, default)
+    1: (("If-Match", "if_match"), "opaque", True, 0, 8, None),  # core-coap-12
+    3: (("Uri-Host", "uri_host"), "string", False, 1, 255, None),  # core-coap-12
+    4: (("ETag", "etag"), "opaque", True, 1, 8, None),  # core-coap-12 !! once in rp
+    5: (("If-None-Match", "if_none_match"), "empty", False, 0, 0, None),  # core-coap-12
+    6: (("Observe", "observe"), "uint", False, 0, 3, None),  # core-observe-07
+    7: (("Uri-Port", "uri_port"), "uint", False, 0, 2, DEFAULT_PORT),  # core-coap-12
+    8: (("Location-Path", "location_path"), "string", True, 0, 255, None),  # core-coap-12
+    11: (("Uri-Path", "uri_path"), "string", True, 0, 255, None),  # core-coap-12
+    12: (("Content-Format", "content_format"), "uint", False, 0, 2, None),  # core-coap-12
+    14: (("Max-Age", "max_age"), "uint", False, 0, 4, 60),  # core-coap-12
+    15: (("Uri-Query", "uri_query"), "string", True, 0, 255, None),  # core-coap-12
+    16: (("Accept", "accept"), "uint", True, 0, 2, None),  # core-coap-12
+    20: (("Location-Query", "location_query"), "string", True, 0, 255, None),  # core-coap-12
+    23: (("Block2", "block2"), "uint", False, 0, 3, None),  # core-block-10
+    27: (("Block1", "block1"), "uint", False, 0, 3, None),  # core-block-10
+    28: (("Size2", "size2", "size"), "uint", False, 0, 4, None),  # core-block-10
+    35: (("Proxy-Uri", "proxy_uri"), "string", False, 1, 1034, None),  # core-coap-12
+    60: (("Size1", "size1"), "uint", False, 0, 4, None),  # RFC 7959
 }
 
-opt_i = dict([v, k] for k, v in options.items())
+
+def _build_option_table(definitions):
+    table = [None] * (max(definitions) + 1)
+    for number, (names, format, repeatable, min_length, max_length, default) in definitions.items():
+        table[number] = OptionDescriptor(
+            number, names[0], format, repeatable, min_length, max_length,
+            default, *_formats[format])
+    return tuple(table)
+
+# Option descriptors indexed by option number, None for unknown numbers
+optionTable = _build_option_table(_options)
+
+# Option descriptors by name and aliases
+optionNames = dict(
+    (name, optionTable[number])
+    for number, definition in _options.items()
+    for name in definition[0])
+
+
+def getOption(key):
+    """
+    Returns the descriptor of an option.
+
+    :param key: option number, name or alias
+    :return: the OptionDescriptor, or None if the option is unknown
+    """
+    if isinstance(key, str):
+        return optionNames.get(key)
+    if 0 <= key < len(optionTable):
+        return optionTable[key]
+    return None
 
 
 def isRequest(code):
@@ -280,7 +263,9 @@ def _init(d, status):
 codes = LookupDict(name="status_code")
 mediaCodes = LookupDict(name="media_code")
 msgType = LookupDict(name="msgType")
+options = LookupDict(name="options")
 
 _init(codes, _codes)
 _init(mediaCodes, _mediaCode)
 _init(msgType, _msgType)
+_init(options, dict((number, definition[0]) for number, definition in _options.items()))
@@ -1,8 +1,13 @@
 # coding=utf-8
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import threading
 import urllib
 from pycolo.codes import codes, options
-from pycolo.message import Response
+from pycolo.layers import UDPLayer
 from pycolo.observe import addObserver, isObserved
 
 from pycolo.resource import Resource
@@ -174,3 +179,178 @@ class Endpoint:
 
     def register(self, res):
         raise NotImplementedError
+
+
+def _serveWorker(factory, port, address, batchSize, connection):
+    """
+    Main function of a ReusePortServer worker process: builds a stack on a
+    SO_REUSEPORT socket and answers the commands of the supervisor until
+    told to stop.
+    """
+    layer = UDPLayer(port=port, batchSize=batchSize, address=address, reusePort=True)
+    top = factory(layer)
+    connection.send("ready")
+    try:
+        while True:
+            try:
+                command = connection.recv()
+            except EOFError:
+                #  the supervisor is gone
+                break
+            if command == "stats":
+                stats = layer.getStats()
+                if top is not None and top is not layer:
+                    stats.update(top.getStats())
+                connection.send(stats)
+            elif command == "stop":
+                break
+    finally:
+        layer.close()
+        connection.close()
+
+
+class ReusePortServer:
+    """
+    Serves a CoAP port from several worker processes, each with its own
+    layer stack on a socket bound with SO_REUSEPORT, so that a server is not
+    limited to the core running its interpreter. The kernel hashes the flows
+    over the sockets, the exchanges of a client thus stay on one worker and
+    the duplicate detection and blockwise state can stay process-local.
+
+    A supervisor thread restarts the workers that die.
+
+    :param factory: called in each worker with its UDPLayer, builds the
+        stack on top of it and returns its top layer. It must be picklable
+        when processes are spawned, e.g. a module-level function
+    :param workers: number of worker processes, one per CPU if None
+    :param port: The local UDP port, 0 for any free port
+    :param address: The local address to bind to
+    :param batchSize: batch size of the UDP layers
+    """
+
+    def __init__(self, factory, workers=None, port=DEFAULT_PORT, address="", batchSize=1):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise NotImplementedError("SO_REUSEPORT is not supported on this platform")
+        self.factory = factory
+        self.workers = workers or os.cpu_count() or 1
+        self.port = port
+        self.address = address
+        self.batchSize = batchSize
+        self.processes = [None] * self.workers
+        self.connections = [None] * self.workers
+        self.restarts = 0
+        self.running = False
+        self.lock = threading.Lock()
+        self.supervisor = None
+
+    def start(self):
+        """
+        Starts the workers and the supervisor thread.
+
+        :return: the server itself
+        """
+        if self.port == 0:
+            #  resolve the port once, so that every worker binds the same one
+            family = socket.AF_INET6 if ":" in self.address else socket.AF_INET
+            probe = socket.socket(family, socket.SOCK_DGRAM)
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            probe.bind((self.address, 0))
+            self.port = probe.getsockname()[1]
+            probe.close()
+        self.running = True
+        for index in range(self.workers):
+            self.startWorker(index)
+        self.supervisor = threading.Thread(target=self.supervise, name="ReusePortSupervisor", daemon=True)
+        self.supervisor.start()
+        return self
+
+    def startWorker(self, index):
+        """
+        Starts, or restarts, a worker process and waits until it serves.
+
+        :param index: the slot of the worker
+        """
+        connection, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_serveWorker,
+            args=(self.factory, self.port, self.address, self.batchSize, child),
+            name="ReusePortWorker-%d" % index,
+            daemon=True)
+        process.start()
+        child.close()
+        self.processes[index] = process
+        self.connections[index] = connection
+        try:
+            connection.recv()
+        except EOFError:
+            logging.error("Worker %s failed to start", process.name)
+
+    def supervise(self, interval=0.5):
+        """
+        Restarts the workers that died, until the server is stopped.
+
+        :param interval: the longest time between two checks, in seconds
+        """
+        while self.running:
+            multiprocessing.connection.wait(
+                [process.sentinel for process in self.processes], interval)
+            with self.lock:
+                if not self.running:
+                    break
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        logging.warning("Worker %s exited with code %s, restarting",
+                                        process.name, process.exitcode)
+                        self.connections[index].close()
+                        self.restarts += 1
+                        self.startWorker(index)
+
+    def getStats(self):
+        """
+        Sums the statistics of the workers. Values that are not numbers are
+        kept when all workers agree on them.
+
+        :return: dict of statistics
+        """
+        stats = dict()
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.send("stats")
+                    workerStats = connection.recv()
+                except (EOFError, OSError):
+                    #  dead worker, restarted by the supervisor
+                    continue
+                for key, value in workerStats.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        stats[key] = stats.get(key, 0) + value
+                    elif stats.setdefault(key, value) != value:
+                        stats[key] = None
+            stats["UDP port"] = self.port
+            stats["Batch size"] = self.batchSize
+            stats["Workers"] = sum(process.is_alive() for process in self.processes)
+            stats["Restarts"] = self.restarts
+        return stats
+
+    def stop(self, timeout=5):
+        """
+        Stops the supervisor and the workers.
+
+        :param timeout: time given to each worker to exit, in seconds
+        """
+        with self.lock:
+            self.running = False
+        if self.supervisor is not None:
+            self.supervisor.join()
+        for process, connection in zip(self.processes, self.connections):
+            if process is None:
+                continue
+            try:
+                connection.send("stop")
+            except OSError:
+                pass
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            connection.close()
@@ -1,16 +1,27 @@
 # coding=utf-8
+import asyncio
 import logging
 import random
-from threading import Thread, Timer
-from pycolo import DEFAULT_OVERALL_TIMEOUT
-from pycolo.message import Message
+import socket
+import time
+from array import array
+from threading import Thread, current_thread
+from pycolo import BLOCKWISE_STORE_BUDGET, DEFAULT_BLOCK_SIZE, DEFAULT_OVERALL_TIMEOUT, DEFAULT_PORT, EXCHANGE_LIFETIME
+from pycolo import MAX_RETRANSMIT, MESSAGE_CACHE_SIZE, RESPONSE_RANDOM_FACTOR, RESPONSE_TIMEOUT, RX_BUFFER_SIZE
+from pycolo import blockwise
+from pycolo.codes import codes, isRequest, isResponse, msgType, options
+from pycolo.message import Message, decode_batch
+from pycolo.mmsg import BatchReceiver, sendBatch
+from pycolo.observe import ObservingManager
+from pycolo.timing import TimingWheel, getDefaultWheel
+from pycolo.token import TokenManager, defaultManager as defaultTokenManager
 
 class Layer:
     """
     An abstract Layer class that enforced a uniform interface for building
     a layered communications stack.
     """
-    receivers = list()
+    receivers = None
     numMessagesSent = 0
     numMessagesReceived = 0
 
@@ -53,32 +64,72 @@ class Layer:
         pass message to registered receivers
         :param msg:
         """
-        raise NotImplementedError
-#        if self.receivers:
-#            for receiver in self.receivers:
-#                receiver.receiveMessage(msg)
+        if self.receivers:
+            for receiver in self.receivers:
+                receiver.receiveMessage(msg)
+
+    def failMessage(self, msg):
+        """
+        Called by the lower layer when a message sent through this layer
+        failed for good: its transaction timed out or the peer reset it.
+        :param msg: the message sent
+        """
+        if msg:
+            self.doFailMessage(msg)
+
+    def doFailMessage(self, msg):
+        """
+        :param msg:
+        """
+        self.deliverFailure(msg)
+
+    def deliverFailure(self, msg):
+        """
+        pass the failure of a message to the registered receivers that
+        handle failures
+        :param msg:
+        """
+        if self.receivers:
+            for receiver in self.receivers:
+                failMessage = getattr(receiver, "failMessage", None)
+                if failMessage is not None:
+                    failMessage(msg)
+
+    def cancelMessage(self, msg):
+        """
+        Called by the upper layer when the exchange of a message sent
+        through this layer ended without success, e.g. timed out, so that
+        its state is released.
+        :param msg: the message sent
+        """
+        if msg:
+            self.doCancelMessage(msg)
+
+    def doCancelMessage(self, msg):
+        """
+        :param msg:
+        """
+        pass
 
     def registerReceiver(self, receiver):
         """
         check for valid receiver
         :param receiver:
         """
-        raise NotImplementedError
-#        if receiver and receiver != self:
-#            #  lazy creation of receiver list
-#            if not self.receivers:
-#                self.receivers = list()
-#                #  add receiver to list
-#            self.receivers.append(receiver)
+        if receiver and receiver != self:
+            #  lazy creation of receiver list
+            if not self.receivers:
+                self.receivers = list()
+            #  add receiver to list
+            self.receivers.append(receiver)
 
     def unregisterReceiver(self, receiver):
         """
         remove receiver from list
         :param receiver:
         """
-        raise NotImplementedError
-#        if self.receivers:
-#            self.receivers.remove(receiver)
+        if self.receivers:
+            self.receivers.remove(receiver)
 
 
 class AdverseLayer(Layer):
@@ -114,392 +165,488 @@ class AdverseLayer(Layer):
 #        else:
 #            logging.info("[%s] Incoming message dropped: %s", str(self), msg.key())
 
-class MatchingLayer(Layer):
+class UpperLayer(Layer):
     """
-    This class matches the request/response pairs using the token option. It
-    must be below the TransferLayer, which requires set buddies for each
-    message ({@link Response#getRequest()} and {@link Request#getResponse()}).
+    A layer stacked on top of another one, which it uses to send messages
+    and from which it receives messages.
     """
 
-    #pairs = dict()
+    lowerLayer = None
 
-    class RequestResponsePair:
-        """ Entity class to keep state of transfers """
-#        key = str()
-#        request = request()
+    def sendMessageOverLowerLayer(self, msg):
+        """
+        :param msg:
+        """
+        #  check if lower layer assigned
+        if self.lowerLayer is not None:
+            self.lowerLayer.sendMessage(msg)
+        else:
+            logging.critical("[%s] ERROR: No lower layer present", type(self).__name__)
 
-    def __init__(self):
-        raise NotImplementedError
-        # super(MatchingLayer, self).__init__()
+    def doCancelMessage(self, msg):
+        #  the layers below keep state for the message as well
+        if self.lowerLayer is not None:
+            self.lowerLayer.cancelMessage(msg)
 
-    def doSendMessage(self, msg):
-        raise NotImplementedError
-#        if isinstance(msg, (request,)):
-#            self.addOpenRequest(msg)
-#        self.sendMessageOverLowerLayer(msg)
+    def setLowerLayer(self, layer):
+        """
+        :param layer:
+        """
+        #  unsubscribe from old lower layer
+        if self.lowerLayer is not None:
+            self.lowerLayer.unregisterReceiver(self)
+        #  set new lower layer
+        self.lowerLayer = layer
+        #  subscribe to new lower layer
+        if layer is not None:
+            layer.registerReceiver(self)
 
-    def doReceiveMessage(self, msg):
-        raise NotImplementedError
-#        if isinstance(msg, (Response,)):
-#            #  check for missing token
-#            if not self.pair and len(self.length):
-#                logging.info("Remote endpoint failed to echo token: {:s}".format(msg.key()))
-#                #  TODO try to recover from peerAddress
-#                #  let timeout handle the problem
-#                return
-#            if self.pair:
-#                #  attach request and response to each other
-#                self.response.setRequest(self.pair.request)
-#                self.pair.request.setResponse(self.response)
-#                logging.info("Matched open request: {:s}".format(self.response.sequenceKey()))
-#                #  TODO: ObservingManager.getInstance().isObserving(msg.exchangeKey());
-#                if msg.getFirstOption(OptionNumberRegistry.OBSERVE) is None:
-#                    self.removeOpenRequest(self.response.sequenceKey())
-#            else:
-#                logging.info("Dropping unexpected response: {:s}".format(self.response.sequenceKey()))
-#                return
-#        self.deliverMessage(msg)
+    def getLowerLayer(self):
+        """
+        :return: the layer below this one
+        """
+        return self.lowerLayer
 
-    def addOpenRequest(self, request):
-        raise NotImplementedError
-#        #  create new Transaction
-#        exchange = self.RequestResponsePair()
-#        exchange.key = request.sequenceKey()
-#        exchange.request = request
-#        logging.info("Storing open request: {:s}".format(exchange.key))
-#        #  associate token with Transaction
-#        self.pairs.put(exchange.key, exchange)
-#        return exchange
+class MatchingLayer(UpperLayer):
+    """
+    This class matches the request/response pairs using the token option. It
+    must be below the TransferLayer, which requires set buddies for each
+    message ({@link Response#getRequest()} and {@link Request#getResponse()}).
 
-    def getOpenRequest(self, key):
-        raise NotImplementedError
-#        return self.pairs.get(key)
+    Open requests are kept by their sequence key, a (peer address, token)
+    tuple. They are cleared when matched, when their transaction fails or
+    their exchange is cancelled, and at the latest after lifetime.
 
-    def removeOpenRequest(self, key):
-        raise NotImplementedError
-#        exchange = self.pairs.remove(key)
-#        logging.info("Cleared open request: {:s}".format(exchange.key))
+    :param timer: the TimingWheel expiring the open requests, the shared
+        default wheel if None
+    :param lifetime: time after which an open request is cleared, in
+        milliseconds
+    """
 
-    def getStats(self):
-        raise NotImplementedError
-#        stats = dict()
-#        stats["Open requests"] = self.pairs
-#        stats["Messages sent"] = self.numMessagesSent
-#        stats["Messages received"] = self.numMessagesReceived
-#        return str(stats)
+    class RequestResponsePair:
+        """ Entity class to keep state of transfers """
+        __slots__ = ("key", "request", "timeoutTask")
 
+        def __init__(self, key, request):
+            self.key = key
+            self.request = request
+            self.timeoutTask = None
 
+    def __init__(self, timer=None, lifetime=EXCHANGE_LIFETIME):
+        self.pairs = dict()
+        self.timer = timer if timer is not None else getDefaultWheel()
+        self.lifetime = lifetime
 
-class UpperLayer(Layer):
-    """ generated source for class UpperLayer """
-    def sendMessageOverLowerLayer(self, msg):
-#        """ generated source for method sendMessageOverLowerLayer """
-#        #  check if lower layer assigned
-#        if self.lowerLayer is not None:
-#            self.lowerLayer.sendMessage(msg)
-#        else:
-#            logging.critical("[%s] ERROR: No lower layer present", self.getClass().__name__)
-        raise NotImplementedError
+    def doSendMessage(self, msg):
+        self.prepareMessage(msg)
+        self.sendMessageOverLowerLayer(msg)
 
-    def setLowerLayer(self, layer):
-        """ generated source for method setLowerLayer """
-#        #  unsubscribe from old lower layer
-#        if self.lowerLayer is not None:
-#            self.lowerLayer.unregisterReceiver(self)
-#            #  set new lower layer
-#        lowerLayer = layer
-#        #  subscribe to new lower layer
-#        if lowerLayer is not None:
-#            lowerLayer.registerReceiver(self)
-        raise NotImplementedError
+    def doReceiveMessage(self, msg):
+        if self.acceptMessage(msg):
+            self.deliverMessage(msg)
 
-    def getLowerLayer(self):
-        """ generated source for method getLowerLayer """
-        #return self.lowerLayer
-        raise NotImplementedError
+    def doFailMessage(self, msg):
+        if isRequest(msg.status_code):
+            self.removeOpenRequest(msg.sequenceKey())
+        self.deliverFailure(msg)
 
-    #lowerLayer = layers()
+    def doCancelMessage(self, msg):
+        if isRequest(msg.status_code):
+            self.removeOpenRequest(msg.sequenceKey())
+        super().doCancelMessage(msg)
 
-    class TransactionLayer(Layer):
-        """
-        The class TransactionLayer provides the functionality of the CoAP messaging
-        layer as a subclass of {@link UpperLayer}. It introduces reliable transport
-        of confirmable messages over underlying layers by making use of
-        retransmissions and exponential backoff, matching of confirmables to their
-        corresponding ACK / RST, detection and cancellation of duplicate messages,
-        retransmission of ACK / RST messages upon receiving duplicate confirmable
-        messages.
+    def prepareMessage(self, msg):
         """
+        Records outgoing requests as open.
 
-    # The message ID used for newly generated messages.
-    # currentMID = random.SystemRandom() * 0x10000
+        :param msg: a message on its way down the stack
+        """
+        if isRequest(msg.status_code):
+            self.addOpenRequest(msg)
 
-    def nextMessageID(self):
+    def acceptMessage(self, msg):
         """
-        Returns the next message ID to use out of the consecutive 16 - bit
-        range.
-        @return the current message ID
+        Matches incoming responses to their open request.
+
+        :param msg: a message on its way up the stack
+        :return: True if the message is to be delivered upwards
         """
-        raise NotImplementedError
-#        self.currentMID += 1
-#        self.currentMID %= 0x10000
-#        return self.currentMID
+        if isResponse(msg.status_code):
+            key = msg.sequenceKey()
+            pair = self.pairs.get(key)
+            #  check for missing token
+            if pair is None and not msg.token:
+                logging.info("Remote endpoint failed to echo token: %s", msg.key())
+                #  TODO try to recover from peerAddress
+                #  let timeout handle the problem
+                return False
+            if pair is None:
+                logging.info("Dropping unexpected response: %s", key)
+                return False
+            logging.info("Matched open request: %s", key)
+            #  TODO: ObservingManager.getInstance().isObserving(msg.exchangeKey());
+            if options.observe not in msg.options:
+                self.removeOpenRequest(key)
+        return True
+
+    def addOpenRequest(self, request):
+        #  a request sent again with the same token replaces the previous one
+        self.removeOpenRequest(request.sequenceKey())
+        #  create new Transaction
+        exchange = self.RequestResponsePair(request.sequenceKey(), request)
+        exchange.timeoutTask = self.timer.schedule(self.lifetime / 1000, self.openRequestExpired, exchange)
+        logging.info("Storing open request: %s", exchange.key)
+        #  associate token with Transaction
+        self.pairs[exchange.key] = exchange
+        return exchange
+
+    def getOpenRequest(self, key):
+        return self.pairs.get(key)
 
-    # The timer daemon to schedule retransmissions.
-    # timer = Timer(true) # run as daemon
+    def removeOpenRequest(self, key):
+        exchange = self.pairs.pop(key, None)
+        if exchange is not None:
+            exchange.timeoutTask.cancel()
+            logging.info("Cleared open request: %s", exchange.key)
 
-    # The Table to store the transactions of outgoing messages.
-    # transactionTable = {}
+    def openRequestExpired(self, exchange):
+        # the request may have been matched meanwhile
+        if self.pairs.get(exchange.key) is exchange:
+            logging.info("Open request expired: %s", exchange.key)
+            self.removeOpenRequest(exchange.key)
 
-    # The cache for duplicate detection.
-    # dupCache = MessageCache()
+    def getStats(self):
+        stats = dict()
+        stats["Open requests"] = len(self.pairs)
+        stats["Messages sent"] = self.numMessagesSent
+        stats["Messages received"] = self.numMessagesReceived
+        return stats
 
-    # Cache used to retransmit replies to incoming messages
-    # replyCache = MessageCache()
 
+class TransactionLayer(UpperLayer):
+    """
+    The class TransactionLayer provides the functionality of the CoAP messaging
+    layer as a subclass of {@link UpperLayer}. It introduces reliable transport
+    of confirmable messages over underlying layers by making use of
+    retransmissions and exponential backoff, matching of confirmables to their
+    corresponding ACK / RST, detection and cancellation of duplicate messages,
+    retransmission of ACK / RST messages upon receiving duplicate confirmable
+    messages.
+
+    Retransmissions are scheduled on a timing wheel shared by all
+    transactions, rather than on one timer thread per confirmable.
+
+    :param timer: the TimingWheel scheduling retransmissions, the shared
+        default wheel if None
+    :param peerStatistics: the PeerStatistics recording the round-trip
+        times and retransmissions of each peer, if any
+    """
 
     class Transaction:
         """
-          Entity class to keep state of retransmissions.
-          """
-#        msg = Message()
-#        retransmitTask = RestransmitTask()
-#        numRetransmit = 0
-#        timeout = 0 # to satisfy RESPONSE_RANDOM_FACTOR
+        Entity class to keep state of retransmissions.
+        """
+        __slots__ = ("msg", "retransmitTask", "numRetransmit", "timeout", "sent")
+
+        def __init__(self, msg):
+            self.msg = msg
+            self.retransmitTask = None
+            self.numRetransmit = 0
+            self.timeout = 0  # to satisfy RESPONSE_RANDOM_FACTOR
+            self.sent = time.monotonic()
 
     class MessageCache:
         """
         The MessageCache is a utility class used for duplicate detection and
-        reply retransmissions. It is a ring buffer whose size is configured
-        through the Californium properties file.
+        reply retransmissions. It is a ring buffer of fixed capacity, its
+        storage is allocated once: inserting, looking up and evicting are
+        O(1) and allocate nothing in steady state. Entries also expire after
+        lifetime seconds.
+
+        :param capacity: number of entries, MESSAGE_CACHE_SIZE by default
+        :param lifetime: time after which an entry expires, in seconds
+        :param clock: monotonic clock, in seconds
         """
 
-        def removeEldestEntry(eldest):
-            raise NotImplementedError
-            # return size() > MESSAGE_CACHE_SIZE
-
-
-#    class RetransmitTask(Timer):
-#        """
-#        Utility class to handle timeouts.
-#        """
+        def __init__(self, capacity=MESSAGE_CACHE_SIZE, lifetime=EXCHANGE_LIFETIME / 1000, clock=time.monotonic):
+            self.capacity = capacity
+            self.lifetime = lifetime
+            self.clock = clock
+            self.keys = [None] * capacity
+            self.values = [None] * capacity
+            self.expires = array("d", bytes(8 * capacity))
+            # slot of each cached key
+            self.index = dict()
+            # next slot to overwrite
+            self.head = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+        def put(self, key, msg):
+            """
+            Caches a message, evicting the oldest entry if the cache is full.
+
+            :param key: the key of the message
+            :param msg: the message
+            """
+            now = self.clock()
+            expires = now + self.lifetime
+            slot = self.index.get(key)
+            if slot is None:
+                slot = self.head
+                self.head = (slot + 1) % self.capacity
+                old = self.keys[slot]
+                if old is not None:
+                    del self.index[old]
+                    if self.expires[slot] > now:
+                        self.evictions += 1
+                    else:
+                        self.expirations += 1
+                self.keys[slot] = key
+                self.index[key] = slot
+            self.values[slot] = msg
+            self.expires[slot] = expires
+
+        def get(self, key, default=None):
+            """
+            :param key: the key of the message
+            :return: the cached message, default if absent or expired
+            """
+            slot = self.index.get(key)
+            if slot is not None:
+                if self.expires[slot] > self.clock():
+                    self.hits += 1
+                    return self.values[slot]
+                # expired, free the slot
+                del self.index[key]
+                self.keys[slot] = None
+                self.values[slot] = None
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+        def __contains__(self, key):
+            return self.get(key) is not None
+
+        def __len__(self):
+            return len(self.index)
+
+        def getStats(self):
+            stats = dict()
+            stats["Entries"] = len(self.index)
+            stats["Hits"] = self.hits
+            stats["Misses"] = self.misses
+            stats["Evictions"] = self.evictions
+            stats["Expirations"] = self.expirations
+            return stats
+
+    def __init__(self, timer=None, peerStatistics=None):
+        # The message ID used for newly generated messages.
+        self.currentMID = random.SystemRandom().randrange(0x10000)
+        # The timer to schedule retransmissions.
+        self.timer = timer if timer is not None else getDefaultWheel()
+        # The Table to store the transactions of outgoing messages.
+        self.transactionTable = dict()
+        # The cache for duplicate detection.
+        self.dupCache = self.MessageCache()
+        # Cache used to retransmit replies to incoming messages
+        self.replyCache = self.MessageCache()
+        self.peerStatistics = peerStatistics
 
-#        transaction = Transaction()
-#
-#        def RetransmitTask(transaction):
-#            self.transaction = transaction
-#
-#        def run():
-#            handleResponseTimeout(transaction)
+    def nextMessageID(self):
+        """
+        Returns the next message ID to use out of the consecutive 16 - bit
+        range.
+        @return the current message ID
+        """
+        self.currentMID += 1
+        self.currentMID %= 0x10000
+        return self.currentMID
 
     def initialTimeout(self):
         """
         Calculates the initial timeout for outgoing confirmable messages.
         :return: the timeout in milliseconds
         """
-        raise NotImplementedError
-#        min = RESPONSE_TIMEOUT
-#        f = RESPONSE_RANDOM_FACTOR
+        minimum = RESPONSE_TIMEOUT
+        f = RESPONSE_RANDOM_FACTOR
+        return minimum + minimum * (f - 1) * random.random()
 
-        # return min + (min * (f - 1) * random.SystemRandom())
-
-
-    def doSendMessage(msg):
-        raise NotImplementedError
+    def doSendMessage(self, msg):
         # set message ID
-#        if msg.getMID() < 0:
-#            msg.setMID(self.nextMessageID())
-#
-#        # check if message needs confirmation, i.e., a reply is expected
-#        if msg.isConfirmable():
-#            # create new transmission context for retransmissions
-#            self.addTransaction(msg)
-#
-#        elif msg.isReply():
-#            # put message into ring buffer in case peer retransmits
-#            self.replyCache.put(msg.transactionKey(), msg)
-#
-#        # send message over unreliable channel
-#        self.sendMessageOverLowerLayer(msg)
-
-
-    def doReceiveMessage(msg):
-        raise NotImplementedError
-#        # check for duplicate
-#        if msg.key() in dupCache:
-#            # check for retransmitted Confirmable
-#            if msg.isConfirmable():
-#                # retrieve cached reply
-#                reply = replyCache.get(msg.transactionKey())
-#                if reply:
-#                    # retransmit reply
-#                    try:
-#                        logging.info("Replied to duplicate confirmable: %s" % msg.key())
-#                        self.sendMessageOverLowerLayer(reply)
-#                    except IOException
-#                    e:
-#                    logging.severe("Replying to duplicate confirmable failed: %s\n%s", msg.key(), e.getMessage())
-#                else:
-#                    logging.info("Dropped duplicate confirmable without cached reply: %s" % msg.key())
-#
-#                # drop duplicate anyway
-#                return
-#
-#            else:
-#                # ignore duplicate
-#                logging.info(String.format("Dropped duplicate: %s", msg.key()))
-#                return
-#
-#        else:
-#        # cache received message
-#            dupCache.put(msg.key(), msg)
-#
-#
-#        # check for reply to CON and remove transaction
-#        if msg.isReply():
-#            # retrieve transaction for the incoming message
-#            Transaction
-#            transaction = getTransaction(msg)
-#
-#            if transaction:
-#                # transmission completed
-#                removeTransaction(transaction)
-#
-#                if msg.isEmptyACK():
-#                    # transaction is complete, no information for higher layers
-#                    return
-#
-#                else
-#                if (msg.getType() == Message.messageType.RST):
-#                    handleIncomingReset(msg)
-#                    return
-#
-#            elif (msg.getType() == Message.messageType.RST):
-#                handleIncomingReset(msg)
-#                return
-#
-#            else:
-#                # ignore unexpected reply except RST, which could match to a NON sent by the endpoint
-#                logging.warning("Dropped unexpected reply: %s", msg.key())
-#                return
-#
-#        # Only accept Responses here, Requests must be handled at application level
-#        if (msg instanceof Response & & msg.isConfirmable()) {
-#        try:
-#            logging.info("Accepted confirmable response: %s" % msg.key())
-#            sendMessageOverLowerLayer(msg.newAccept())
-#        except IOException as e:
-#            logging.severe("Accepting confirmable failed: %s\n%s" % msg.key(), e.getMessage())
-#            # pass message to registered receivers
-#            deliverMessage(msg)
-
-    def handleIncomingReset(msg):
-        # remove possible observers
-        raise NotImplementedError
-        # ObservingManager.getInstance().removeObserver(msg.getPeerAddress().toString(), msg.getMID())
+        if msg.message_id is None:
+            msg.message_id = self.nextMessageID()
 
+        # check if message needs confirmation, i.e., a reply is expected
+        if msg.msg_type == msgType.con:
+            # create new transmission context for retransmissions
+            self.addTransaction(msg)
+        elif msg.is_reply():
+            # put message into ring buffer in case peer retransmits
+            self.replyCache.put(msg.transactionKey(), msg)
 
-    def handleResponseTimeout(transaction):
-        raise NotImplementedError
+        # send message over unreliable channel
+        self.sendMessageOverLowerLayer(msg)
 
-#        max = MAX_RETRANSMIT
-#
-#        # check if limit of retransmissions reached
-#        if transaction.numRetransmit < max:
-#            # retransmit message
-#            transaction.msg.setRetransmissioned(transaction.numRetransmit)
-#
-#            logging.info("Retransmitting %s (%d of %d)" % transaction.msg.key(), transaction.numRetransmit, max)
-#
-#            try:
-#                sendMessageOverLowerLayer(transaction.msg)
-#            except IOException, e:
-#
-#            logging.severe("Retransmission failed: %s", e.getMessage())
-#            removeTransaction(transaction)
-#
-#            # schedule next retransmission
-#            scheduleRetransmission(transaction)
-#
-#            return
-#
-#        else:
-#            # cancel transmission
-#            removeTransaction(transaction)
-#
-#            # cancel observations
-#            ObservingManager.getInstance().removeObserver(transaction.msg.getPeerAddress().toString())
-#
-#            # invoke event handler method
-#            transaction.msg.handleTimeout()
-
-    def addTransaction(msg):
-        raise NotImplementedError
+    def doReceiveMessage(self, msg):
+        # check for duplicate, replies are matched to their transaction
+        if not msg.is_reply() and msg.transactionKey() in self.dupCache:
+            # check for retransmitted Confirmable
+            if msg.msg_type == msgType.con:
+                # the peer missed our reply
+                if self.peerStatistics is not None:
+                    self.peerStatistics.recordLoss(msg.peerAddress)
+                # retrieve cached reply
+                reply = self.replyCache.get(msg.transactionKey())
+                if reply is not None:
+                    # retransmit reply
+                    logging.info("Replied to duplicate confirmable: %s", msg.key())
+                    self.sendMessageOverLowerLayer(reply)
+                else:
+                    logging.info("Dropped duplicate confirmable without cached reply: %s", msg.key())
+            else:
+                # ignore duplicate
+                logging.info("Dropped duplicate: %s", msg.key())
+            # drop duplicate anyway
+            return
+
+        # check for reply to CON and remove transaction
+        if msg.is_reply():
+            # retrieve transaction for the incoming message
+            transaction = self.getTransaction(msg)
+            if transaction is not None:
+                # transmission completed
+                self.removeTransaction(transaction)
+                if self.peerStatistics is not None:
+                    # sample the round-trip time only if unambiguous
+                    rtt = msg.timestamp - transaction.sent if not transaction.numRetransmit and msg.timestamp else None
+                    self.peerStatistics.recordExchange(msg.peerAddress, rtt, transaction.numRetransmit)
+                if msg.is_emptyACK():
+                    # transaction is complete, no information for higher layers
+                    return
+                if msg.msg_type == msgType.rst:
+                    self.handleIncomingReset(msg)
+                    # the peer rejected the message
+                    self.deliverFailure(transaction.msg)
+                    return
+            elif msg.msg_type == msgType.rst:
+                self.handleIncomingReset(msg)
+                return
+            else:
+                # ignore unexpected reply except RST, which could match to a NON sent by the endpoint
+                logging.warning("Dropped unexpected reply: %s", msg.key())
+                return
+
+        # cache received message
+        if not msg.is_reply():
+            self.dupCache.put(msg.transactionKey(), msg)
+            if msg.msg_type == msgType.con and self.peerStatistics is not None:
+                # a new confirmable from the peer, lost ones show up as duplicates
+                self.peerStatistics.recordExchange(msg.peerAddress)
+
+        # Only accept Responses here, Requests must be handled at application level
+        if isResponse(msg.status_code) and msg.msg_type == msgType.con:
+            logging.info("Accepted confirmable response: %s", msg.key())
+            self.sendMessageOverLowerLayer(msg.new_accept())
+
+        # pass message to registered receivers
+        self.deliverMessage(msg)
+
+    def handleIncomingReset(self, msg):
+        # TODO: remove possible observers
+        logging.info("Received reset: %s", msg.key())
+
+    def handleResponseTimeout(self, transaction):
+        # the transaction may have completed meanwhile
+        if self.transactionTable.get(transaction.msg.transactionKey()) is not transaction:
+            return
+        # check if limit of retransmissions reached
+        if transaction.numRetransmit < MAX_RETRANSMIT:
+            # retransmit message
+            transaction.numRetransmit += 1
+            logging.info("Retransmitting %s (%d of %d)",
+                         transaction.msg.key(), transaction.numRetransmit, MAX_RETRANSMIT)
+            try:
+                self.sendMessageOverLowerLayer(transaction.msg)
+            except OSError as e:
+                logging.critical("Retransmission failed: %s", e)
+                self.removeTransaction(transaction)
+                self.deliverFailure(transaction.msg)
+                return
+            # schedule next retransmission
+            self.scheduleRetransmission(transaction)
+        else:
+            # cancel transmission
+            self.removeTransaction(transaction)
+            if self.peerStatistics is not None:
+                self.peerStatistics.recordExchange(transaction.msg.peerAddress, None, transaction.numRetransmit)
+            # TODO: cancel observations
+            self.deliverFailure(transaction.msg)
+            # invoke event handler method
+            transaction.msg.handle_timeout()
+
+    def doCancelMessage(self, msg):
+        # stop retransmitting a message whose exchange is over
+        if msg.msg_type == msgType.con and msg.message_id is not None:
+            transaction = self.getTransaction(msg)
+            if transaction is not None and transaction.msg is msg:
+                self.removeTransaction(transaction)
+        super().doCancelMessage(msg)
+
+    def addTransaction(self, msg):
         # initialize new transmission context
-#        transaction = Transaction()
-#        transaction.msg = msg
-#        transaction.numRetransmit = 0
-#        transaction.retransmitTask = None
-#
-#        transactionTable.put(msg.transactionKey(), transaction)
-#
-#        # schedule first retransmission
-#        self.scheduleRetransmission(transaction)
-#
-#        logging.info("Stored new transaction for %s" % msg.key())
-#
-#        return transaction
-
-
-    def getTransaction(msg):
-        raise NotImplementedError
-        # return transactionTable.get(msg.transactionKey())
+        transaction = self.Transaction(msg)
+        self.transactionTable[msg.transactionKey()] = transaction
+        # schedule first retransmission
+        self.scheduleRetransmission(transaction)
+        logging.info("Stored new transaction for %s", msg.key())
+        return transaction
 
+    def getTransaction(self, msg):
+        return self.transactionTable.get(msg.transactionKey())
 
-    def removeTransaction(transaction):
+    def removeTransaction(self, transaction):
         # cancel any pending retransmission schedule
-        raise NotImplementedError
-#        transaction.retransmitTask.cancel()
-#        transaction.retransmitTask = None
-#
-#        # remove transaction from table
-#        self.transactionTable.remove(transaction.msg.transactionKey())
-#
-#        logging.info("Cleared transaction for %s" % transaction.msg.key())
+        if transaction.retransmitTask is not None:
+            transaction.retransmitTask.cancel()
+            transaction.retransmitTask = None
+        # remove transaction from table
+        self.transactionTable.pop(transaction.msg.transactionKey(), None)
+        logging.info("Cleared transaction for %s", transaction.msg.key())
+
+    def scheduleRetransmission(self, transaction):
+        # cancel existing schedule (if any)
+        if transaction.retransmitTask is not None:
+            transaction.retransmitTask.cancel()
+        # calculate timeout using exponential back - off
+        if transaction.timeout == 0:
+            # use initial timeout
+            transaction.timeout = self.initialTimeout()
+        else:
+            # double timeout
+            transaction.timeout *= 2
+        # schedule retransmission task
+        transaction.retransmitTask = self.timer.schedule(
+            transaction.timeout / 1000, self.handleResponseTimeout, transaction)
 
+    def getStats(self):
+        stats = dict()
+        stats["Current message ID"] = self.currentMID
+        stats["Open transactions"] = len(self.transactionTable)
+        for name, cache in (("Duplicate cache", self.dupCache), ("Reply cache", self.replyCache)):
+            for key, value in cache.getStats().items():
+                stats["%s %s" % (name, key.lower())] = value
+        stats["Messages sent"] = self.numMessagesSent
+        stats["Messages received"] = self.numMessagesReceived
+        return stats
 
-    def scheduleRetransmission(transaction):
-        raise NotImplementedError
-    #    # cancel existing schedule (if any)
-    #    if transaction.retransmitTask:
-    #        transaction.retransmitTask.cancel()
-    #
-    #    # create new retransmission task
-    #    transaction.retransmitTask = RetransmitTask(transaction)
-    #
-    #    # calculate timeout using exponential back - off
-    #
-    #    if transaction.timeout == 0:
-    #        # use initial timeout
-    #        transaction.timeout = self.initialTimeout()
-    #    else:
-    #        # double timeout
-    #        transaction.timeout *= 2
-    #
-    #    # schedule retransmission task
-    #    timer.schedule(transaction.retransmitTask, transaction.timeout)
+    def __str__(self):
+        return str(self.getStats())
 
 
-    def __str__(self):
-        raise NotImplementedError
-    #    stats = dict()
-    #    stats["Current message ID"] = self.currentMID
-    #    stats["Open transactions"] = self.transactionTable.size()
-    #    stats["Messages sent"] = self.numMessagesSent
-    #    stats["Messages received"] = self.numMessagesReceived
-    #    return str(stats)
-
-class TransferLayer(Layer):
+class TransferLayer(UpperLayer):
     """
     The class TransferLayer provides support for
     <http://tools.ietf.org/html/draft-ietf-core-block">blockwise transfers
@@ -511,243 +658,410 @@ class TransferLayer(Layer):
     TODO: Explore alternative designs.
     """
     class TransferContext:
-
-        #cache = Message()
-        #uriPath = ""
-        # current = BlockOption()
-
-        #  TODO: timer
-        #def __init__(self, msg):
-        #    raise NotImplementedError
-#
-#            if isinstance(msg, (request,)):
-#                self.cache = msg
-#                self.uriPath = msg.getUriPath()
-#                self.current = msg.getFirstOption(options.BLOCK1)
-#            elif isinstance(msg, (Response,)):
-#                msg.requiresToken(False)
-#                #  FIXME check if still required after new TokenLayer
-#                self.cache = msg
-#                self.uriPath = msg.getRequest().getUriPath()
-#                self.current = msg.getFirstOption(options.BLOCK2)
-#            logging.info("Created new transfer context for {:s}: {:s}".format(self.uriPath, msg.sequenceKey()))
-
-        incoming = dict()
-        outgoing = dict()
-        defaultSZX = int()
-
-    def __init__(self, defaultBlockSize):
-        raise NotImplementedError
-#        super(TransferLayer, self).__init__()
-#        if defaultBlockSize == 0:
-#            defaultBlockSize = Properties.std.getInt("DEFAULT_BLOCK_SIZE")
-#        if defaultBlockSize > 0:
-#            self.defaultSZX = BlockOption.encodeSZX(defaultBlockSize)
-#            if not BlockOption.validSZX(self.defaultSZX):
-#                self.defaultSZX = 6 if defaultBlockSize > 1024 else BlockOption.encodeSZX(defaultBlockSize & 0x07f0)
-#                logging.warning("Unsupported block size {:d}, using {:d} instead".format(defaultBlockSize, BlockOption.decodeSZX(self.defaultSZX)))
-#        else:
-#            self.defaultSZX = -1
-
+        """
+        Entity class to keep state of transfers: the message the blocks are
+        cut from, the block source of its representation and the last block.
+        Uploads hand their blocks to a sink, or to an in-memory buffer
+        without sink, and count the bytes received.
+        """
+        __slots__ = ("cache", "source", "current", "sink", "received")
+
+        def __init__(self, msg, source, current, sink=None):
+            self.cache = msg
+            self.source = source
+            self.current = current
+            self.sink = sink
+            self.received = 0
+            logging.info("Created new transfer context: %s", msg.sequenceKey())
+
+    def __init__(self, defaultBlockSize=DEFAULT_BLOCK_SIZE, sinkProvider=None, maxBodySize=None,
+                 peerStatistics=None, storeBudget=BLOCKWISE_STORE_BUDGET, transferTimeout=EXCHANGE_LIFETIME):
+        """
+        :param defaultBlockSize: the block size of the transfers, -1 to
+            disable outgoing blockwise transfers
+        :param sinkProvider: called with the first block of an upload,
+            returns the sink the blocks are written to, or None to collect
+            the body in memory
+        :param maxBodySize: largest request body accepted, in bytes, None
+            for no limit
+        :param peerStatistics: the PeerStatistics choosing the block size
+            of each peer, defaultBlockSize for every peer if None
+        :param storeBudget: bytes the transfers in progress may hold in
+            memory together, None for no limit
+        :param transferTimeout: time after which a transfer whose next block
+            is not demanded is abandoned, in milliseconds
+        """
+        self.defaultBlockSize = defaultBlockSize
+        self.sinkProvider = sinkProvider
+        self.maxBodySize = maxBodySize
+        self.peerStatistics = peerStatistics
+        if defaultBlockSize > 0:
+            self.defaultSZX = min(max(blockwise.encodeSZX(defaultBlockSize), 0), blockwise.MAX_SZX)
+            if blockwise.decodeSZX(self.defaultSZX) != defaultBlockSize:
+                logging.warning("Unsupported block size %d, using %d instead",
+                                defaultBlockSize, blockwise.decodeSZX(self.defaultSZX))
+        else:
+            self.defaultSZX = -1
+        #  transfers in progress, by Block1 or Block2 and sequence key
+        self.transfers = blockwise.BlockwiseStore(storeBudget, transferTimeout / 1000, onDrop=self.transferDropped)
+        #  Block2 options of the requests answered by resources
+        self.demanded = blockwise.BlockwiseStore(None, transferTimeout / 1000)
+        #  Block1 options of the completed uploads answered by resources
+        self.uploaded = blockwise.BlockwiseStore(None, transferTimeout / 1000)
+        self.blocksSent = 0
+        self.blocksReceived = 0
+        self.rejected = 0
 
     def doSendMessage(self, msg):
-        raise NotImplementedError
-#        sendSZX = self.defaultSZX
-#        sendNUM = 0
-#        if isinstance(msg, (Response,)) and msg.getRequest() is not None:
-#            if self.buddyBlock:
-#                if self.buddyBlock.getSZX() < self.defaultSZX:
-#                    sendSZX = self.buddyBlock.getSZX()
-#                sendNUM = self.buddyBlock.getNUM()
-#        if msg.payloadSize() > BlockOption.decodeSZX(sendSZX):
-#            if self.msgBlock is not None:
-#                if self.block1 is not None and self.block1.getM() or block2 is not None and self.block2.getM():
-#                    msg.setOption(self.block1)
-#                    msg.setOption(self.block2)
-#                    self.outgoing.put(msg.sequenceKey(), self.transfer)
-#                    logging.info("Caching blockwise transfer for NUM {:d}: {:s}".format(sendNUM, msg.sequenceKey()))
-#                else:
-#                    logging.info("Answering block request without caching: {:s} | {:s}".format(msg.sequenceKey(), block2))
-#                self.sendMessageOverLowerLayer(self.msgBlock)
-#            else:
-#                logging.info("Rejecting initial out-of-scope request: {:s} | NUM: {:d}, SZX: {:d} ({:d} bytes), M: n/a, {:d} bytes available".format(msg.sequenceKey(), sendNUM, sendSZX, BlockOption.decodeSZX(sendSZX), msg.payloadSize()))
-#                self.handleOutOfScopeError(msg.newReply(True))
-#        else:
-#            self.sendMessageOverLowerLayer(msg)
+        """
+        Cuts responses larger than a block, or whose payload is a stream, into
+        Block2 blocks. The first block is sent at once; the transfer is kept
+        to answer the demands for the next ones, reading each block from the
+        source only when it is demanded. The transfer owns the source and
+        closes it once the last block is served. Blocks demanded outside a
+        transfer, e.g. by the concurrent requests of a windowed download,
+        are answered without caching.
+        """
+        demand = self.demanded.pop(msg.sequenceKey(), None) if self.demanded else None
+        if self.uploaded:
+            upload = self.uploaded.pop(msg.sequenceKey(), None)
+            if upload is not None and isResponse(msg.status_code):
+                msg.options[options.block1] = upload.value
+        payload = msg.payload
+        if payload is None or not isResponse(msg.status_code):
+            self.sendMessageOverLowerLayer(msg)
+            return
+        streamed = blockwise.isStream(payload)
+        if self.defaultSZX < 0:
+            if streamed:
+                msg.payload = self.readAll(blockwise.sourceFor(payload))
+            self.sendMessageOverLowerLayer(msg)
+            return
+
+        sendSZX = self.getSZX(msg.peerAddress)
+        sendNUM = 0
+        if demand is not None:
+            sendSZX = min(sendSZX, demand.szx)
+            sendNUM = demand.offset // blockwise.decodeSZX(sendSZX)
+
+        if not streamed and sendNUM == 0 and len(payload) <= blockwise.decodeSZX(sendSZX):
+            self.sendMessageOverLowerLayer(msg)
+            return
+        source = blockwise.sourceFor(payload)
+        if sendNUM == 0 and source.length is not None and source.length <= blockwise.decodeSZX(sendSZX):
+            msg.payload = self.readAll(source)
+            self.sendMessageOverLowerLayer(msg)
+            return
+
+        block = blockwise.getBlock(msg, source, sendNUM, sendSZX)
+        if block is None:
+            logging.info("Rejecting initial out-of-scope request: %s | NUM: %d, SZX: %d (%d bytes), %s bytes available",
+                         msg.sequenceKey(), sendNUM, sendSZX, blockwise.decodeSZX(sendSZX), source.length)
+            source.close()
+            msg.payload = None
+            self.handleOutOfScopeError(msg)
+            return
+        current = blockwise.BlockOption.fromValue(block.options[options.block2])
+        if current.m and sendNUM == 0 and self.transfers.put(
+                (options.block2, msg.sequenceKey()), self.TransferContext(msg, source, current), source.footprint()):
+            logging.info("Caching blockwise transfer for NUM %d: %s", sendNUM, msg.sequenceKey())
+        else:
+            source.close()
+            logging.info("Answering block request without caching: %s | %s", msg.sequenceKey(), current)
+        self.blocksSent += 1
+        self.sendMessageOverLowerLayer(block)
 
     def doReceiveMessage(self, msg):
-        raise NotImplementedError
-#        blockIn = None
-#        blockOut = None
-#        if isinstance(msg, (request,)):
-#            blockIn = msg.getFirstOption(options.BLOCK1)
-#            blockOut = msg.getFirstOption(options.BLOCK2)
-#        elif isinstance(msg, (Response,)):
-#            blockIn = msg.getFirstOption(options.BLOCK2)
-#            blockOut = msg.getFirstOption(options.BLOCK1)
-#            if blockOut is not None:
-#                blockOut.setNUM(blockOut.getNUM() + 1)
-#        else:
-#            logging.warning("Unknown message type received: {:s}".format(msg.key()))
-#            return
-#        if blockIn is None and msg.requiresBlockwise():
-#            blockIn = BlockOption(options.BLOCK1, 0, self.defaultSZX, True)
-#            self.handleIncomingPayload(msg, blockIn)
-#            return
-#        elif blockIn is not None:
-#            self.handleIncomingPayload(msg, blockIn)
-#            return
-#        elif blockOut is not None:
-#            logging.info("Received demand for next block: {:s} | {:s}".format(msg.sequenceKey(), blockOut))
-#            if self.transfer:
-#                if isinstance(msg, (request,)) and not msg.getUriPath() == transfer.uriPath:
-#                    self.outgoing.remove(msg.sequenceKey())
-#                    logging.info("Freed blockwise transfer by client token reuse: {:s}".format(msg.sequenceKey()))
-#                else:
-#                    if isinstance(msg, (request,)):
-#                        self.transfer.cache.setMID(msg.getMID())
-#                    if next is not None:
-#                        try:
-#                            logging.info("Sending next block: {:s} | {:s}".format(next.sequenceKey(), blockOut))
-#                            self.sendMessageOverLowerLayer(next)
-#                        except IOException as e:
-#                            logging.critical("Failed to send block response: {:s}".format(e.getMessage()))
-#                        if not self.respBlock.getM() and isinstance(msg, (request,)):
-#                            self.outgoing.remove(msg.sequenceKey())
-#                            logging.info("Freed blockwise download by completion: {:s}".format(next.sequenceKey()))
-#                        return
-#                    elif isinstance(msg, (Response,)) and not blockOut.getM():
-#                        self.outgoing.remove(msg.sequenceKey())
-#                        logging.info("Freed blockwise upload by completion: {:s}".format(msg.sequenceKey()))
-#                        msg.setRequest(self.transfer.cache)
-#                    else:
-#                        logging.warning("Rejecting out-of-scope demand for cached transfer (freed): {:s} | {:s}, {:d} bytes available".format(msg.sequenceKey(), blockOut, transfer.cache.payloadSize()))
-#                        self.outgoing.remove(msg.sequenceKey())
-#                        self.handleOutOfScopeError(msg.newReply(True))
-#                        return
-#        elif isinstance(msg, (Response,)):
-#            if self.transfer:
-#                msg.setRequest(self.transfer.cache)
-#                self.outgoing.remove(msg.sequenceKey())
-#                logging.info("Freed outgoing transfer by client abort: {:s}".format(msg.sequenceKey()))
-#            transfer = self.incoming.get(msg.sequenceKey())
-#            if transfer is not None:
-#                msg.setRequest(transfer.cache)
-#                self.incoming.remove(msg.sequenceKey())
-#                logging.info("Freed incoming transfer by client abort: {:s}".format(msg.sequenceKey()))
-#        self.deliverMessage(msg)
-        raise NotImplementedError
+        """
+        Answers the demands for the next block of a cached transfer. Other
+        requests carrying a Block2 option are delivered to the resource, the
+        block they demand being cut from its response. Blocks of uploads are
+        handled by handleIncomingPayload, and requests announcing a body
+        larger than maxBodySize in their Size1 option are rejected.
+        """
+        if isRequest(msg.status_code) and options.block1 in msg.options:
+            self.handleIncomingPayload(msg, blockwise.BlockOption.fromValue(msg.options[options.block1]))
+            return
+        if isRequest(msg.status_code) and options.size1 in msg.options and self.exceedsBody(msg.options[options.size1]):
+            logging.info("Rejecting request body of %d bytes: %s", msg.options[options.size1], msg.sequenceKey())
+            self.handleTooLargeError(self.newBlockReply(msg), self.maxBodySize)
+            return
+        if isRequest(msg.status_code) and options.block2 in msg.options:
+            key = msg.sequenceKey()
+            demand = blockwise.BlockOption.fromValue(msg.options[options.block2])
+            if not blockwise.validSZX(demand.szx):
+                logging.info("Rejecting block demand with reserved SZX: %s | %s", key, demand)
+                self.handleOutOfScopeError(self.newBlockReply(msg))
+                return
+            transfer = self.transfers.get((options.block2, key))
+            if transfer is not None:
+                if demand.num > 0:
+                    logging.info("Received demand for next block: %s | %s", key, demand)
+                    self.sendNextBlock(msg, transfer, demand)
+                    return
+                # the client restarts the transfer, the resource renders it again
+                self.removeTransfer(key)
+                logging.info("Freed blockwise transfer by client restart: %s", key)
+            self.demanded.put(key, demand)
+        self.deliverMessage(msg)
+
+    def sendNextBlock(self, request, transfer, demand):
+        """
+        Serves a demanded block of a cached transfer.
+
+        :param request: the request demanding the block
+        :param transfer: the TransferContext of the sequence
+        :param demand: the Block2 option of the request
+        """
+        key = request.sequenceKey()
+        # blocks only shrink during a transfer
+        szx = min(demand.szx, transfer.current.szx, self.getSZX(request.peerAddress))
+        num = demand.offset // blockwise.decodeSZX(szx)
+        reply = self.newBlockReply(request)
+        block = blockwise.getBlock(transfer.cache, transfer.source, num, szx)
+        if block is None:
+            logging.warning("Rejecting out-of-scope demand for cached transfer (freed): %s | %s, %s bytes available",
+                            key, demand, transfer.source.length)
+            self.removeTransfer(key)
+            self.handleOutOfScopeError(reply)
+            return
+        block.msg_type = reply.msg_type
+        block.message_id = reply.message_id
+        block.token = reply.token
+        block.peerAddress = reply.peerAddress
+        transfer.current = blockwise.BlockOption.fromValue(block.options[options.block2])
+        if not transfer.current.m:
+            self.removeTransfer(key)
+            logging.info("Freed blockwise download by completion: %s", key)
+        elif isinstance(transfer.source, blockwise.GeneratorSource):
+            self.transfers.resize((options.block2, key), transfer.source.footprint())
+        self.blocksSent += 1
+        logging.info("Sending next block: %s | %s", key, transfer.current)
+        self.sendMessageOverLowerLayer(block)
+
+    def getSZX(self, address):
+        """
+        :param address: the address of a peer
+        :return: the SZX of the blocks sent to it
+        """
+        if self.peerStatistics is None:
+            return self.defaultSZX
+        return self.peerStatistics.getSZX(address)
+
+    def removeTransfer(self, key):
+        transfer = self.transfers.pop((options.block2, key))
+        if transfer is not None:
+            transfer.source.close()
+
+    def transferDropped(self, key, transfer):
+        """
+        Frees a transfer abandoned by its peer or evicted from the store.
+        """
+        number, key = key
+        logging.info("Freed abandoned blockwise transfer: %s", key)
+        if number == options.block2:
+            transfer.source.close()
+        else:
+            self.abortSink(transfer.sink)
+
+    @staticmethod
+    def newBlockReply(request):
+        """
+        :param request: a request demanding a block
+        :return: the response skeleton answering it, piggy-backed on the ACK
+            of a CON request
+        """
+        reply = request.new_reply(True)
+        if reply.msg_type != msgType.ack:
+            reply.message_id = None
+        return reply
+
+    @staticmethod
+    def readAll(source):
+        """
+        Reads a whole representation of known length from its source, or
+        until exhaustion for generators, and closes the source.
+        """
+        chunks = []
+        offset = 0
+        while True:
+            chunk = source.read(offset, 1 << 16)
+            if not chunk:
+                break
+            chunks.append(bytes(chunk))
+            offset += len(chunk)
+            if not source.more(offset):
+                break
+        source.close()
+        return b"".join(chunks)
 
     def handleIncomingPayload(self, msg, blockOpt):
-        raise NotImplementedError
-#        transfer = self.incoming.get(msg.sequenceKey())
-#        if blockOpt.getNUM() > 0 and transfer is not None:
-#            if blockOpt.getNUM() * blockOpt.getSize() == (transfer.current.getNUM() + 1) * transfer.current.getSize():
-#                transfer.cache.appendPayload(msg.getPayload())
-#                transfer.cache.setMID(msg.getMID())
-#                logging.info("Received next block:  {:s} | {:s}".format(msg.sequenceKey(), blockOpt))
-#            else:
-#                logging.info("Dropping wrong block: {:s} | {:s}".format(msg.sequenceKey(), blockOpt))
-#        elif blockOpt.getNUM() == 0 and msg.payloadSize() > 0:
-#            if msg.payloadSize() > blockOpt.getSize():
-#                blockOpt.setNUM(newNUM - 1)
-#                msg.setPayload(Arrays.copyOf(msg.getPayload(), newNUM))
-#            transfer = self.TransferContext(msg)
-#            self.incoming.put(msg.sequenceKey(), transfer)
-#            logging.info("Incoming blockwise transfer: {:s} | {:s}".format(msg.sequenceKey(), blockOpt))
-#        else:
-#            logging.info("Rejecting out-of-order block: {:s} | {:s}".format(msg.sequenceKey(), blockOpt))
-#            self.handleIncompleteError(msg.newReply(True))
-#            return
-#        if blockOpt.getM():
-#            if self.demandSZX > self.defaultSZX:
-#                demandNUM = self.demandSZX / self.defaultSZX * self.demandNUM
-#                demandSZX = self.defaultSZX
-#            if isinstance(msg, (Response,)):
-#                reply = request(codes.METHOD_GET, not msg.isNonConfirmable())
-#                reply.setURI("coap://" + msg.getPeerAddress().__str__() + transfer.uriPath)
-#                demandNUM += 1
-#            elif isinstance(msg, (request,)):
-#                reply = Response(codes.RESP_VALID)
-#                reply.setType(self.messageType.ACK if msg.isConfirmable() else self.messageType.NON)
-#                reply.setPeerAddress(msg.getPeerAddress())
-#                if msg.isConfirmable():
-#                    reply.setMID(msg.getMID())
-#            else:
-#                logging.critical("Unsupported message type: {:s}".format(msg.key()))
-#                return
-#            reply.setOption(msg.getFirstOption(options.TOKEN))
-#            reply.setOption(next)
-#            try:
-#                logging.info("Demanding next block: {:s} | {:s}".format(reply.sequenceKey(), next))
-#                sendMessageOverLowerLayer(reply)
-#            except IOException as e:
-#                logging.critical("Failed to request block: {:s}".format(e.getMessage()))
-#            transfer.current = blockOpt
-#        else:
-#            transfer.cache.setOption(blockOpt)
-#            logging.info("Finished blockwise transfer: {:s}".format(msg.sequenceKey()))
-#            self.incoming.remove(msg.sequenceKey())
-#            self.deliverMessage(transfer.cache)
+        """
+        Hands an upload block to the sink of its transfer as soon as it
+        arrives in order, so that the body never has to be held in memory.
+        The first block opens the sink and may be rejected with 4.13 from its
+        Size1 option. Intermediate blocks are answered with 2.31 Continue;
+        the request carrying the last block is delivered to the resource
+        with the sink, or the collected body without sink, as payload.
+
+        :param msg: a request carrying a Block1 option
+        :param blockOpt: its Block1 option
+        """
+        key = msg.sequenceKey()
+        transfer = self.transfers.get((options.block1, key))
+        payload = msg.payload
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.blocksReceived += 1
+
+        if blockOpt.num == 0:
+            if transfer is not None:
+                self.removeUpload(key, aborted=True)
+                logging.info("Freed incoming transfer by client restart: %s", key)
+            size1 = msg.options.get(options.size1)
+            if size1 is not None and self.exceedsBody(size1):
+                logging.info("Rejecting initial block, body of %d bytes: %s | %s", size1, key, blockOpt)
+                self.handleTooLargeError(self.newBlockReply(msg), self.maxBodySize)
+                return
+            sink = self.sinkProvider(msg) if self.sinkProvider is not None else None
+            transfer = self.TransferContext(msg, None, blockOpt, sink if sink is not None else bytearray())
+            self.transfers.put((options.block1, key), transfer)
+            logging.info("Incoming blockwise transfer: %s | %s", key, blockOpt)
+        elif transfer is None or blockOpt.offset != transfer.received:
+            if transfer is not None and blockOpt.offset == transfer.current.offset:
+                # a NON block sent again, its data is already written
+                logging.info("Dropping duplicate block: %s | %s", key, blockOpt)
+                self.sendContinue(msg, transfer)
+                return
+            logging.info("Rejecting out-of-order block: %s | %s", key, blockOpt)
+            self.removeUpload(key, aborted=True)
+            self.handleIncompleteError(self.newBlockReply(msg))
+            return
+        else:
+            logging.info("Received next block: %s | %s", key, blockOpt)
+
+        if self.exceedsBody(transfer.received + len(payload)):
+            logging.info("Rejecting upload beyond %d bytes: %s | %s", self.maxBodySize, key, blockOpt)
+            self.removeUpload(key, aborted=True)
+            self.handleTooLargeError(self.newBlockReply(msg), self.maxBodySize)
+            return
+        if isinstance(transfer.sink, bytearray):
+            transfer.sink += payload
+            if not self.transfers.resize((options.block1, key), len(transfer.sink)):
+                logging.warning("Rejecting upload beyond the store budget: %s | %s", key, blockOpt)
+                self.handleTooLargeError(self.newBlockReply(msg), self.transfers.budget)
+                return
+        else:
+            transfer.sink.write(payload)
+        transfer.received += len(payload)
+        transfer.current = blockOpt
+
+        if blockOpt.m:
+            self.sendContinue(msg, transfer)
+            return
+        self.removeUpload(key)
+        logging.info("Finished blockwise transfer: %s, %d bytes", key, transfer.received)
+        self.uploaded.put(key, blockOpt)
+        msg.payload = bytes(transfer.sink) if isinstance(transfer.sink, bytearray) else transfer.sink
+        self.deliverMessage(msg)
+
+    def sendContinue(self, request, transfer):
+        """
+        Acknowledges an upload block and demands the next one, in blocks of
+        at most the default size.
+
+        :param request: the request carrying the block
+        :param transfer: the TransferContext of the upload
+        """
+        reply = self.newBlockReply(request)
+        reply.status_code = codes.RESP_CONTINUE
+        szx = transfer.current.szx
+        if 0 <= self.defaultSZX:
+            szx = min(szx, self.getSZX(request.peerAddress))
+        reply.options[options.block1] = blockwise.BlockOption(transfer.current.num, True, szx).value
+        try:
+            self.sendMessageOverLowerLayer(reply)
+        except OSError as e:
+            logging.critical("Failed to request block: %s", e)
+
+    def removeUpload(self, key, aborted=False):
+        """
+        Frees an upload, closing its sink, or aborting it if it has an
+        abort method and the upload did not complete.
+        """
+        transfer = self.transfers.pop((options.block1, key))
+        if transfer is None:
+            return
+        if aborted:
+            self.abortSink(transfer.sink)
+        elif hasattr(transfer.sink, "close"):
+            transfer.sink.close()
+
+    @staticmethod
+    def abortSink(sink):
+        if isinstance(sink, bytearray):
+            return
+        close = getattr(sink, "abort", None)
+        if close is None:
+            close = getattr(sink, "close", None)
+        if close is not None:
+            close()
+
+    def exceedsBody(self, size):
+        return self.maxBodySize is not None and size > self.maxBodySize
 
     def handleOutOfScopeError(self, resp):
-        raise NotImplementedError
-#        """ generated source for method handleOutOfScopeError """
-#        resp.setCode(codes.RESP_BAD_REQUEST)
-#        resp.setPayload("BlockOutOfScope")
-#        try:
-#            sendMessageOverLowerLayer(resp)
-#        except IOException as e:
-#            logging.critical("Failed to send error message: {:s}".format(e.getMessage()))
+        resp.status_code = codes.RESP_BAD_REQUEST
+        resp.payload = "BlockOutOfScope"
+        try:
+            self.sendMessageOverLowerLayer(resp)
+        except OSError as e:
+            logging.critical("Failed to send error message: %s", e)
 
     def handleIncompleteError(self, resp):
-        raise NotImplementedError
-#        """ generated source for method handleIncompleteError """
-#        resp.setCode(codes.RESP_REQUEST_ENTITY_INCOMPLETE)
-#        resp.setPayload("Start with block num 0")
-#        try:
-#            sendMessageOverLowerLayer(resp)
-#        except IOException as e:
-#            logging.critical("Failed to send error message: {:s}".format(e.getMessage()))
-
-    def getBlock(cls, msg, num, szx):
-        raise NotImplementedError
-#        """ generated source for method getBlock """
-#        blockSize = 1 << (szx + 4)
-#        payloadOffset = num * blockSize
-#        payloadLeft = msg.payloadSize() - payloadOffset
-#        if payloadLeft > 0:
-#            if isinstance(msg, (request,)):
-#                block = request(msg.getCode(), msg.isConfirmable())
-#            else:
-#                block = Response(msg.getCode())
-#                if num == 0 and msg.getType() == Message.messageType.CON:
-#                    block.setType(Message.messageType.CON)
-#                else:
-#                    block.setType(Message.messageType.NON if msg.isNonConfirmable() else Message.messageType.ACK)
-#                block.setMID(msg.getMID())
-#            block.setPeerAddress(msg.getPeerAddress())
-#            for opt in msg.getOptions():
-#                block.addOption(opt)
-#            if not m:
-#                blockSize = payloadLeft
-#            System.arraycopy(msg.getPayload(), payloadOffset, blockPayload, 0, blockSize)
-#            block.setPayload(blockPayload)
-#            if isinstance(msg, (request,)):
-#                blockOpt = BlockOption(OptionNumberRegistry.BLOCK1, num, szx, m)
-#            else:
-#                blockOpt = BlockOption(OptionNumberRegistry.BLOCK2, num, szx, m)
-#            block.setOption(blockOpt)
-#            return block
-#        else:
-#            return None
+        resp.status_code = codes.RESP_REQUEST_ENTITY_INCOMPLETE
+        resp.payload = "Start with block num 0"
+        try:
+            self.sendMessageOverLowerLayer(resp)
+        except OSError as e:
+            logging.critical("Failed to send error message: %s", e)
+
+    def handleTooLargeError(self, resp, limit=None):
+        self.rejected += 1
+        resp.status_code = codes.RESP_REQUEST_ENTITY_TOO_LARGE
+        if limit is not None:
+            resp.options[options.size1] = limit
+        try:
+            self.sendMessageOverLowerLayer(resp)
+        except OSError as e:
+            logging.critical("Failed to send error message: %s", e)
+
+    def awaitsResponse(self, msg):
+        """
+        :param msg: an outgoing message
+        :return: True if the message answers a block demand or an upload
+            handled by this layer
+        """
+        if not self.demanded and not self.uploaded:
+            return False
+        key = msg.sequenceKey()
+        return key in self.demanded or key in self.uploaded
 
     def getStats(self):
-        raise NotImplementedError
-#        stats = {"Default block size": BlockOption.decodeSZX(self.defaultSZX),
-#                 "Outgoing cache size": len(self.outgoing), "Incoming cache size": len(self.incoming),
-#                 "Messages sent": self.numMessagesSent, "Messages received": self.numMessagesReceived}
-#        return str(stats)
+        stats = dict()
+        stats["Default block size"] = blockwise.decodeSZX(self.defaultSZX) if self.defaultSZX >= 0 else -1
+        for key, value in self.transfers.getStats().items():
+            stats["Transfer store %s" % key.lower()] = value
+        stats["Blocks sent"] = self.blocksSent
+        stats["Blocks received"] = self.blocksReceived
+        stats["Rejected uploads"] = self.rejected
+        if self.peerStatistics is not None:
+            stats["Peers"] = self.peerStatistics.getStats()
+        stats["Messages sent"] = self.numMessagesSent
+        stats["Messages received"] = self.numMessagesReceived
+        return stats
 
 
 class TokenLayer(UpperLayer):
@@ -756,164 +1070,141 @@ class TokenLayer(UpperLayer):
     exchanges.
     Additionally, the TokenLayer takes care of an overall timeout for each
     request/response exchange.
-    """
-
-    #exchanges = dict()
-
-    # A timer for scheduling overall request timeouts.
-    #timer = Timer(True)
-
-    # The time to wait for requests to complete, in milliseconds.
-    #sequenceTimeout = 0
 
+    :param sequenceTimeout: The time to wait for requests to complete, in
+        milliseconds
+    :param timer: the TimingWheel scheduling the overall timeouts, the
+        shared default wheel if None
+    :param tokenManager: the TokenManager tokens are acquired from, the
+        default manager of pycolo.token if None
+    """
 
     class RequestResponseSequence:
         """
         Entity class to keep state of transfers
         """
+        __slots__ = ("key", "request", "timeoutTask")
 
-#    public String key public Request request
-#    public
-#    TimerTask
-#    timeoutTask
+        def __init__(self, key, request):
+            self.key = key
+            self.request = request
+            self.timeoutTask = None
 
+    def __init__(self, sequenceTimeout=DEFAULT_OVERALL_TIMEOUT, timer=None, tokenManager=None):
+        self.exchanges = dict()
+        self.tokenManager = tokenManager if tokenManager is not None else defaultTokenManager
+        # A timer for scheduling overall request timeouts.
+        self.timer = timer if timer is not None else getDefaultWheel()
+        self.sequenceTimeout = sequenceTimeout
 
-class TimeoutTask:  # from TimerTask
-#    """
-#    Utility class to provide transaction timeouts
-#    """
-
-    def run(self, sequence):
-        raise NotImplementedError
-        #self.transferTimedOut(sequence)
-
-
-    def __init__(self, sequence, sequenceTimeout=DEFAULT_OVERALL_TIMEOUT):
-        raise NotImplementedError
-        # member initialization
-#        self.sequenceTimeout = sequenceTimeout
-#        self.sequence = sequence
+    def doSendMessage(self, msg):
+        self.prepareMessage(msg)
+        self.sendMessageOverLowerLayer(msg)
 
+    def doReceiveMessage(self, msg):
+        if self.acceptMessage(msg):
+            self.deliverMessage(msg)
 
-    def doSendMessage(msg):
-        raise NotImplementedError
-#        # set token option if required
-#        if msg.requiresToken():
-#            msg.setToken(TokenManager.getInstance().acquireToken(true))
-#
-#        # use overall timeout for clients (e.g., server crash after separate response ACK)
-#        if msg is Request:
-#            logging.info(String.format("Requesting response for %s: %s", ((Request)
-#            msg).getUriPath(), msg.sequenceKey()));
-#            addExchange((Request)
-#            msg);
-#            elif (msg.getCode() == codes.EMPTY_MESSAGE):
-#            logging.info(String.format("Accepting request: %s", msg.key()))
-#        else:
-#            logging.info(String.format("Responding request: %s", msg.sequenceKey()))
-#
-#        self.sendMessageOverLowerLayer(msg)
+    def prepareMessage(self, msg):
+        """
+        Sets the token of outgoing requests and tracks their exchange.
 
+        :param msg: a message on its way down the stack
+        """
+        request = isRequest(msg.status_code)
+        # set token option if required
+        if request and msg.requiresToken and not msg.token:
+            msg.token = self.tokenManager.acquireToken(True)
+
+        # use overall timeout for clients (e.g., server crash after separate response ACK)
+        if request:
+            logging.info("Requesting response: %s", msg.sequenceKey())
+            self.addExchange(msg)
+        elif msg.status_code == codes.empty:
+            logging.info("Accepting request: %s", msg.key())
+        else:
+            logging.info("Responding request: %s", msg.sequenceKey())
+
+    def acceptMessage(self, msg):
+        """
+        Completes the exchange of incoming responses.
 
-    def doReceiveMessage(msg):
-        raise NotImplementedError
-#        if (msg
-#        instanceof
-#        Response) {
-#
-#            response = (Response)
-#        msg
-#
-#        RequestResponseSequence
-#        sequence = getExchange(msg.sequenceKey())
-#
-#        # check for missing token
-#        if (not sequence and not response.getToken()):
-#        logging.warning("Remote endpoint failed to echo token: %s" % msg.key())
-#
-#        # TODO try to recover from peerAddress
-#
-#
-#        if sequence:
-#            # cancel timeout
-#            sequence.timeoutTask.cancel()
-#
-#            # TODO separate observe registry
-#            if msg.getFirstOption(options.OBSERVE) == null:
-#                removeExchange(msg.sequenceKey())
-#
-#            logging.info("Incoming response from %s: %s # RTT: %fms", ((Response)
-#            msg).getRequest().getUriPath(), msg.sequenceKey(), ((Response)
-#            msg).getRTT()));
-#            deliverMessage(msg)
-#
-#        else:
-#            logging.warning("Dropping unexpected response: %s", response.sequenceKey())
-#
-#        elif msg is Request:
-#            logging.info("Incoming request: %s" % msg.sequenceKey())
-#
-#        self.deliverMessage(msg)
-
-    def addExchange(request):
-        raise NotImplementedError
+        :param msg: a message on its way up the stack
+        :return: True if the message is to be delivered upwards
+        """
+        if isResponse(msg.status_code):
+            sequence = self.getExchange(msg.sequenceKey())
+
+            # check for missing token
+            if sequence is None and not msg.token:
+                logging.warning("Remote endpoint failed to echo token: %s", msg.key())
+                # TODO try to recover from peerAddress
+
+            if sequence is None:
+                logging.warning("Dropping unexpected response: %s", msg.sequenceKey())
+                return False
+            # TODO separate observe registry
+            if options.observe not in msg.options:
+                self.removeExchange(msg.sequenceKey())
+            logging.info("Incoming response: %s, RTT: %fms", msg.sequenceKey(),
+                         (msg.timestamp - sequence.request.timestamp) * 1000)
+            return True
+
+        if isRequest(msg.status_code):
+            logging.info("Incoming request: %s", msg.sequenceKey())
+            return True
+        return False
+
+    def doFailMessage(self, msg):
+        if isRequest(msg.status_code):
+            self.removeExchange(msg.sequenceKey())
+        self.deliverFailure(msg)
+
+    def doCancelMessage(self, msg):
+        if isRequest(msg.status_code):
+            self.removeExchange(msg.sequenceKey())
+        super().doCancelMessage(msg)
+
+    def addExchange(self, request):
         # be aware when manually setting tokens, as request/response will be replace
-#        self.removeExchange(request.sequenceKey())
-#
-#        # create new Transaction
-#        RequestResponseSequence
-#        sequence = new
-#        RequestResponseSequence()
-#        sequence.key = request.sequenceKey()
-#        sequence.request = request
-#        sequence.timeoutTask = new
-#        TimeoutTask(sequence)
-#
-#        # associate token with Transaction
-#        exchanges.put(sequence.key, sequence)
-#
-#        timer.schedule(sequence.timeoutTask, sequenceTimeout)
-#
-#        logging.fine("Stored new exchange: %s" % sequence.key)
-#
-#        return sequence
-
-
-    def getExchange(key):
-        raise NotImplementedError
-        # return exchanges.get(key)
-
-
-    def removeExchange(key):
-        raise NotImplementedError
-#        exchange = exchanges.remove(key)
-#
-#        if exchange:
-#            exchange.timeoutTask.cancel()
-#            TokenManager.getInstance().releaseToken(exchange.request.getToken())
-#            logging.finer(String.format("Cleared exchange: %s", exchange.key))
-
-
-    def transferTimedOut(exchange):
-        raise NotImplementedError
-        # cancel transaction
-#        self.removeExchange(exchange.key)
-#
-#        logging.warning("Request/Response exchange timed out: %s" % exchange.request.sequenceKey())
-#
-#        exchange.request.handleTimeout()  # call event handler
-
+        self.removeExchange(request.sequenceKey())
+
+        # create new Transaction
+        sequence = self.RequestResponseSequence(request.sequenceKey(), request)
+        sequence.timeoutTask = self.timer.schedule(
+            self.sequenceTimeout / 1000, self.transferTimedOut, sequence)
+
+        # associate token with Transaction
+        self.exchanges[sequence.key] = sequence
+
+        logging.debug("Stored new exchange: %s", sequence.key)
+        return sequence
+
+    def getExchange(self, key):
+        return self.exchanges.get(key)
+
+    def removeExchange(self, key):
+        exchange = self.exchanges.pop(key, None)
+        if exchange is not None:
+            exchange.timeoutTask.cancel()
+            self.tokenManager.releaseToken(exchange.request.token)
+            logging.debug("Cleared exchange: %s", exchange.key)
+
+    def transferTimedOut(self, exchange):
+        # the exchange may have completed meanwhile
+        if self.exchanges.get(exchange.key) is not exchange:
+            return
+        # cancel transaction, and the state kept by the lower layers
+        self.cancelMessage(exchange.request)
+        logging.warning("Request/Response exchange timed out: %s", exchange.request.sequenceKey())
+        exchange.request.handle_timeout()  # call event handler
 
     def getStats(self):
-        raise NotImplementedError
-#        stats = dict()
-#
-#        stats["Request-Response exchanges"] = self.exchanges.size()
-#        stats["Messages sent"] = self.numMessagesSent
-#        stats["Messages received"] = self.numMessagesReceived
-#
-#        return str(stats)
-
+        stats = dict()
+        stats["Request-Response exchanges"] = len(self.exchanges)
+        stats["Messages sent"] = self.numMessagesSent
+        stats["Messages received"] = self.numMessagesReceived
+        return stats
 
 
 class UDPLayer(Layer):
@@ -926,132 +1217,351 @@ class UDPLayer(Layer):
     The UDPLayer is the base layer of the stack, sub-calssing {@link Layer}.
     Any {@link UpperLayer} can be stacked on top, using a Communicator as
     stack builder.
-    """
-    #  The UDP socket used to send and receive datagrams
-    #  TODO Use MulticastSocket
-    #socket = DatagramSocket()
 
-    #  The thread that listens on the socket for incoming datagrams
-    #receiverThread = ReceiverThread()
+    With a batchSize above 1 the receiver thread drains up to batchSize
+    datagrams per wakeup into preallocated buffers (recvmmsg where the C
+    library provides it), decodes them as one batch, and the messages sent
+    while handling the batch are flushed together (sendmmsg where
+    available). Messages sent from other threads are sent at once.
+
+    :param port: The local UDP port to listen for incoming messages, 0 for
+        any free port
+    :param daemon: True if receiver thread should terminate with main thread
+    :param batchSize: maximum number of datagrams received per wakeup
+    :param address: The local address to bind to
+    :param reusePort: set SO_REUSEPORT, so that several processes can bind
+        the same port and share its datagrams
+    """
 
     #  Inner Classes //////////////////////////////////////////////////////////
     class ReceiverThread(Thread):
-        """ generated source for class ReceiverThread """
-        def __init__(self):
-            raise NotImplementedError
-#            """ generated source for method __init__ """
-#            super(ReceiverThread, self).__init__("ReceiverThread")
+        """
+        Listens on the socket of a layer for incoming datagrams.
+        """
+
+        def __init__(self, layer):
+            super().__init__(name="ReceiverThread")
+            self.layer = layer
 
         def run(self):
-            """ generated source for method run """
+            layer = self.layer
             #  always listen for incoming datagrams
-#            while True:
-#                #  allocate buffer
-#                #  +1 to check for > RX_BUFFER_SIZE
-#                #  initialize new datagram
-#                #  receive datagram
-#                try:
-#                    self.socket.receive(datagram)
-#                except IOException as e:
-#                    logging.critical("Could not receive datagram: %s" % e.getMessage())
-#                    continue
-#                    #  TODO: Dispatch to worker thread
-#                self.datagramReceived(self.datagram)
-
-    def __init__(self, port, daemon):
-        """
-        Constructor for a new UDP layer
-        @param port The local UDP port to listen for incoming messages
-        @param daemon True if receiver thread should terminate with main thread
-        """
-        raise NotImplementedError
-#        super(UDPLayer, self).__init__()
-#        #  initialize members
-#        self.socket = DatagramSocket(port)
-#        self.receiverThread = self.ReceiverThread()
-#        #  decide if receiver thread terminates with main thread
-#        self.receiverThread.setDaemon(daemon)
-#        #  start listening right from the beginning
-#        self.receiverThread.start()
-
+            while not layer.closed:
+                try:
+                    if layer.receiver is None:
+                        #  +1 to check for > RX_BUFFER_SIZE
+                        data, address = layer.socket.recvfrom(RX_BUFFER_SIZE + 1)
+                        if not layer.closed:
+                            layer.datagramReceived(data, address)
+                    else:
+                        batch = layer.receiver.receive()
+                        if not layer.closed:
+                            layer.batchReceived(batch)
+                except OSError as e:
+                    if not layer.closed:
+                        logging.critical("Could not receive datagram: %s", e)
+
+    def __init__(self, port=DEFAULT_PORT, daemon=True, batchSize=1, address="", reusePort=False):
+        #  initialize members
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        if reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind((address, port))
+        self.port = self.socket.getsockname()[1]
+        self.closed = False
+        self.batchSize = batchSize
+        self.receiver = None
+        self.outgoing = None
+        if batchSize > 1:
+            self.receiver = BatchReceiver(self.socket, batchSize, RX_BUFFER_SIZE + 1)
+            self.outgoing = []
+        self.receiverThread = self.ReceiverThread(self)
+        #  decide if receiver thread terminates with main thread
+        self.receiverThread.daemon = daemon
+        #  start listening right from the beginning
+        self.receiverThread.start()
 
     def setDaemon(self, on):
         """
         Decides if the listener thread persists after the main thread
-        terminates
-        @param on True if the listener thread should stay alive after the main
-        thread terminates. This is useful for e.g. server applications
+        terminates. Only effective before the thread is started, as with
+        threading.Thread.
+
+        :param on: False if the listener thread should stay alive after the
+            main thread terminates. This is useful for e.g. server
+            applications
         """
-        raise NotImplementedError
-        # self.receiverThread.setDaemon(on)
+        self.receiverThread.daemon = on
+
+    def isDaemon(self):
+        """
+        Checks whether the listener thread terminates with the main thread
+
+        :return: False if the listener thread stays alive after the main
+            thread terminates. This is useful for e.g. server applications
+        """
+        return self.receiverThread.daemon
+
+    def close(self):
+        """
+        Stops the receiver thread and closes the UDP socket.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        #  wakes up the receiver thread blocked on the socket
+        try:
+            self.socket.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        if current_thread() is not self.receiverThread:
+            self.receiverThread.join()
+        self.socket.close()
 
     def doSendMessage(self, msg):
-        raise NotImplementedError
-#        payload = msg.toByteArray()  # retrieve payload
-#        #  create datagram
-#        datagram = DatagramPacket(payload, msg.getPeerAddress().getAddress(), msg.getPeerAddress().getPort(),)
-#        #  remember when this message was sent for the first time
-#        #  set timestamp only once in order
-#        #  to handle retransmissions correctly
-#        if msg.getTimestamp() == -1:
-#            msg.setTimestamp(System.nanoTime())
-#            #  send it over the UDP socket
-#        self.socket.send(datagram)
+        #  remember when this message was sent for the first time
+        #  set timestamp only once in order
+        #  to handle retransmissions correctly
+        if not msg.timestamp:
+            msg.timestamp = time.monotonic()
+        self.transmit(msg.to_raw(), msg.peerAddress)
+
+    def sendDatagram(self, datagram, address):
+        """
+        Sends a message already in its wire form, such as one rendered from a
+        MessageTemplate.
+
+        :param datagram: the encoded message
+        :param address: the address of the peer
+        """
+        self.transmit(datagram, address)
+        self.numMessagesSent += 1
+
+    def transmit(self, datagram, address):
+        if self.outgoing is not None and current_thread() is self.receiverThread:
+            #  sent while handling a batch, flushed at its end
+            self.outgoing.append((datagram, address))
+        else:
+            self.socket.sendto(datagram, address)
+
+    def flush(self):
+        """
+        Sends the messages queued while handling a batch, in one batch.
+        """
+        if self.outgoing:
+            datagrams, self.outgoing = self.outgoing, []
+            try:
+                sendBatch(self.socket, datagrams, self.receiver.native)
+            except OSError as e:
+                logging.critical("Could not send datagrams: %s", e)
 
     def doReceiveMessage(self, msg):
-        raise NotImplementedError
         #  pass message to registered receivers
-        # self.deliverMessage(msg)
+        self.deliverMessage(msg)
 
+    def datagramReceived(self, data, address):
+        """
+        Decodes a datagram and passes it up the stack.
 
-    def datagramReceived(self, datagram):
-        raise NotImplementedError
+        :param data: the datagram
+        :param address: the address of the sender
+        """
+        if not data:
+            logging.info("Dropped empty datagram from: %s", address)
+            return
+        msg = Message().from_raw(data)
+        if msg is None:
+            logging.critical("Illegal datagram received from %s: %r", address, data)
+            return
+        self.messageReceived(msg, address, len(data), time.monotonic())
+
+    def batchReceived(self, batch):
+        """
+        Decodes a batch of datagrams and passes the messages up the stack,
+        then flushes the messages sent while handling them.
 
-#        if datagram.getLength() > 0:
-#            #  get current time
-#            #  extract message data from datagram
-#            #  create new message from the received data
-#            if self.msg is not None:
-#                #  remember when this message was received
-#                self.msg.setTimestamp(timestamp)
-#                self.msg.setPeerAddress(EndpointAddress(datagram.getAddress(), datagram.getPort()))
-#                if datagram.getLength() > Properties.std.getInt("RX_BUFFER_SIZE"):
-#                    logging.info("Marking large datagram for blockwise transfer: {:s}".format(msg.key()))
-#                    self.msg.requiresBlockwise(True)
-#                    #  protect against unknown exceptions
-#                try:
-#                    #  call receive handler
-#                    receiveMessage(msg)
-#                except Exception as e:
-#                    e.with_traceback()
-#                    logging.critical(self.builder.__str__())
-#            else:
-#                logging.critical("Illegal datagram received:\n%s" % data.__str__())
-#        else:
-#            logging.info("Dropped empty datagram from: {:s}:{:d}".format(datagram.getAddress().getHostName(), datagram.getPort()))
+        :param batch: list of (buffer, length, address), as returned by
+            BatchReceiver.receive
+        """
+        timestamp = time.monotonic()
+        #  the receive buffers are reused, copy the batch out in one block
+        offsets = []
+        position = 0
+        for buffer, length, address in batch:
+            offsets.append(position)
+            position += length
+        data = b"".join([memoryview(buffer)[:length] for buffer, length, address in batch])
+        headers = decode_batch(data, offsets)
+        rows = headers.select()
+        if len(rows) < len(batch):
+            for row in set(range(len(batch))).difference(rows):
+                buffer, length, address = batch[row]
+                logging.critical("Illegal datagram received from %s: %r", address, bytes(buffer[:length]))
+        for row, msg in zip(rows, headers.decode(rows)):
+            buffer, length, address = batch[row]
+            if msg is None:
+                logging.critical("Illegal datagram received from %s: %r", address, bytes(buffer[:length]))
+                continue
+            self.messageReceived(msg, address, length, timestamp)
+        self.flush()
+
+    def messageReceived(self, msg, address, length, timestamp):
+        """
+        Passes a decoded message up the stack.
 
-    def isDaemon(self):
+        :param msg: the message
+        :param address: the address of the sender
+        :param length: the size of the datagram
+        :param timestamp: when the datagram was received
         """
-        Checks whether the listener thread persists after the main thread
-        terminates
+        #  remember when this message was received
+        msg.timestamp = timestamp
+        msg.peerAddress = address
+        if length > RX_BUFFER_SIZE:
+            logging.info("Marking large datagram for blockwise transfer: %s", msg.key())
+            msg.requiresBlockwise = True
+        #  protect against unknown exceptions
+        try:
+            self.receiveMessage(msg)
+        except Exception:
+            logging.exception("Failed to handle message: %s", msg.key())
 
-        @return True if the listener thread stays alive after the main thread
-        terminates. This is useful for e.g. server applications
+    def getPort(self):
         """
-        raise NotImplementedError
-        #return self.receiverThread.isDaemon()
+        :return: the local UDP port
+        """
+        return self.port
+
+    def getStats(self):
+        stats = dict()
+        stats["UDP port"] = self.getPort()
+        stats["Messages sent"] = self.numMessagesSent
+        stats["Messages received"] = self.numMessagesReceived
+        stats["Batch size"] = self.batchSize
+        return stats
+
+
+class AsyncUDPLayer(Layer):
+    """
+    The class AsyncUDPLayer is the asyncio counterpart of {@link UDPLayer}:
+    datagrams are received by an asyncio.DatagramProtocol and handed to the
+    stack on the event loop, instead of by a receiver thread per socket.
+    It is a base layer, any {@link UpperLayer} can be stacked on top.
+
+    Messages must be sent from the event loop thread.
+
+    :param port: The local UDP port to listen for incoming messages, 0 for
+        any free port
+    :param address: The local address to bind to
+    """
+
+    class DatagramProtocol(asyncio.DatagramProtocol):
+        """
+        Forwards the datagrams of an asyncio transport to its layer.
+        """
+
+        def __init__(self, layer):
+            self.layer = layer
+
+        def connection_made(self, transport):
+            self.layer.transport = transport
+
+        def datagram_received(self, data, addr):
+            self.layer.datagramReceived(data, addr)
+
+        def error_received(self, exc):
+            logging.error("[%s] Socket error: %s", type(self.layer).__name__, exc)
+
+    def __init__(self, port=DEFAULT_PORT, address=""):
+        self.port = port
+        self.address = address
+        self.transport = None
+
+    async def open(self, loop=None):
+        """
+        Binds the UDP socket and starts receiving datagrams on the loop.
+
+        :param loop: the event loop, the running one if None
+        :return: the layer itself
+        """
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(
+            lambda: self.DatagramProtocol(self),
+            local_addr=(self.address, self.port))
+        return self
+
+    def close(self):
+        """
+        Closes the UDP socket.
+        """
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def doSendMessage(self, msg):
+        #  remember when this message was sent for the first time
+        #  set timestamp only once in order
+        #  to handle retransmissions correctly
+        if not msg.timestamp:
+            msg.timestamp = time.monotonic()
+        self.transport.sendto(msg.to_raw(), msg.peerAddress)
+
+    def sendDatagram(self, datagram, address):
+        """
+        Sends a message already in its wire form, such as one rendered from a
+        MessageTemplate.
+
+        :param datagram: the encoded message
+        :param address: the address of the peer
+        """
+        self.transport.sendto(datagram, address)
+        self.numMessagesSent += 1
+
+    def doReceiveMessage(self, msg):
+        #  pass message to registered receivers
+        self.deliverMessage(msg)
+
+    def datagramReceived(self, data, address):
+        """
+        Decodes a datagram and passes it up the stack.
+
+        :param data: the datagram
+        :param address: the (host, port) address of the sender
+        """
+        if not data:
+            logging.info("Dropped empty datagram from: %s", address)
+            return
+        msg = Message().from_raw(data)
+        if msg is None:
+            logging.critical("Illegal datagram received from %s: %r", address, data)
+            return
+        #  remember when this message was received
+        msg.timestamp = time.monotonic()
+        msg.peerAddress = address
+        if len(data) > RX_BUFFER_SIZE:
+            logging.info("Marking large datagram for blockwise transfer: %s", msg.key())
+            msg.requiresBlockwise = True
+        #  protect against unknown exceptions
+        try:
+            self.receiveMessage(msg)
+        except Exception:
+            logging.exception("Failed to handle message: %s", msg.key())
 
     def getPort(self):
-        raise NotImplementedError
-        # return self.socket.getLocalPort()
+        """
+        :return: the local UDP port
+        """
+        return self.transport.get_extra_info("sockname")[1]
 
     def getStats(self):
-        raise NotImplementedError
-#        stats = dict()
-#        stats["UDP port"] = self.port
-#        stats["Messages sent"] = self.numMessagesSent
-#        stats["Messages received"] = self.numMessagesReceived
-#        return str(stats)
+        stats = dict()
+        stats["UDP port"] = self.getPort() if self.transport else self.port
+        stats["Messages sent"] = self.numMessagesSent
+        stats["Messages received"] = self.numMessagesReceived
+        return stats
+
 
 class Communicator(UpperLayer):
     """
@@ -1061,75 +1571,107 @@ class Communicator(UpperLayer):
     the subsequent layers in the order defined in {@link #buildStack()}.
 
     Endpoints must register as a receiver using {@link #registerReceiver(MessageReceiver)}.
-    Prior to that, they should configure the Communicator using @link {@link #setup(int, boolean)}.
-    A client only using {@link Request}s are not required to do any of that.
-    Here, {@link Message}s will create the required instance automatically.
-
-    The Communicator implements the Singleton pattern, as there should only be
-    one stack per endpoint and it is required in different contexts to send a
-    message. It is not using the Enum approach because it still needs to inherit
-    from {@link UpperLayer}.
+
+    Communicators are independent of each other: each one owns its layers,
+    its TokenManager, its ObservingManager and its timer, so that several
+    stacks, e.g. one per network interface, run side by side in one process.
     """
 
-#    singleton = None
-#    udpPort = 0
-#    runAsDaemon = True
-#
-#    transferBlockSize = 0
-#
-#    tokenLayer = TokenLayer()
-#    transferLayer = TransferLayer()
-#    matchingLayer = MatchingLayer()
-#    transactionLayer = TransactionLayer()
-#    adverseLayer = AdverseLayer()
-#    udpLayer = UDPLayer()
-
-    def __init__(self):
+    class FastPath:
+        """
+        Receiver of the transaction layer in fused mode: hands the messages
+        without Block1, Block2 or Observe option straight to the
+        Communicator, doing the token and matching bookkeeping inline, and
+        the other ones to the full stack.
+        """
+
+        def __init__(self, communicator):
+            self.communicator = communicator
+
+        def receiveMessage(self, msg):
+            communicator = self.communicator
+            if communicator.requiresFullStack(msg):
+                communicator.matchingLayer.receiveMessage(msg)
+            elif communicator.matchingLayer.acceptMessage(msg) and communicator.tokenLayer.acceptMessage(msg):
+                communicator.fastReceived += 1
+                communicator.receiveMessage(msg)
+
+        def failMessage(self, msg):
+            #  the open request and the exchange are kept by the full stack
+            self.communicator.matchingLayer.failMessage(msg)
+
+    def __init__(self, port=DEFAULT_PORT, daemon=True, defaultBlockSize=DEFAULT_BLOCK_SIZE,
+                 fused=True, address="", batchSize=1, timer=None, adaptiveBlockSize=True, udpLayer=None,
+                 sinkProvider=None, maxBodySize=None):
         """
         Constructor for a new Communicator
         @param port The local UDP port to listen for incoming messages
         @param daemon True if receiver thread should terminate with main thread
         @param defaultBlockSize The default block size used for block-wise transfers
         or -1 to disable outgoing block-wise transfers
+        @param fused True to let messages without blockwise or observe
+        options bypass the token, transfer and matching layers
+        @param address The local address to bind to
+        @param batchSize maximum number of datagrams received per wakeup
+        @param timer the TimingWheel of the stack, a new one run by its own
+        thread if None
+        @param adaptiveBlockSize True to adapt the block size of each peer
+        to its round-trip time and retransmission rate
+        @param udpLayer the base layer of the stack, e.g. an opened
+        AsyncUDPLayer, a new UDPLayer if None
+        @param sinkProvider called with the first block of an upload, returns
+        the sink the blocks are written to, or None to collect the body in
+        memory
+        @param maxBodySize largest request body accepted, in bytes, None for
+        no limit
         """
-        raise NotImplementedError
+        self.udpPort = port
+        self.runAsDaemon = daemon
+        self.transferBlockSize = defaultBlockSize
+        self.fused = fused
+        self.fastSent = 0
+        self.fastReceived = 0
+        #  state of this endpoint
+        self.ownsTimer = timer is None
+        self.timer = TimingWheel().start() if timer is None else timer
+        self.tokenManager = TokenManager()
+        self.observingManager = ObservingManager(communicator=self)
         #  initialize layers
-#        self.tokenLayer = TokenLayer()
-#        self.transferLayer = TransferLayer(self.transferBlockSize)
-#        self.matchingLayer = MatchingLayer()
-#        self.transactionLayer = TransactionLayer()
-#        self.adverseLayer = AdverseLayer()
-#        self.udpLayer = UDPLayer(self.udpPort, self.runAsDaemon)
-#        #  connect layers
-#        self.buildStack()
-
-
-    def setupPort(port):
-        raise NotImplementedError
-#        if port != self.udpPort and not singleton:
-#            if not singleton:
-#                udpPort = port
-#                logging.config("Custom port: %d", udpPort)
-#            else:
-#                logging.severe("Communicator already initialized, setup failed")
-
-    def setupTransfer(defaultBlockSize):
-        raise NotImplementedError
-#        if (defaultBlockSize!=transferBlockSize && singleton==null):
-#            if (singleton==null):
-#                transferBlockSize = defaultBlockSize
-#                logging.config("Custom block size: %d" % transferBlockSize)
-#            else:
-#                logging.severe("Communicator already initialized, setup failed")
-
-    def setupDeamon(daemon):
-        raise NotImplementedError
-#        if daemon != self.runAsDaemon and not singleton:
-#            if not singleton:
-#                self.runAsDaemon = daemon
-#                logging.config("Custom daemon option: %b" % self.runAsDaemon)
-#            else:
-#                logging.critical("Communicator already initialized, setup failed")
+        self.tokenLayer = TokenLayer(timer=self.timer, tokenManager=self.tokenManager)
+        self.transferLayer = TransferLayer(defaultBlockSize, sinkProvider=sinkProvider, maxBodySize=maxBodySize)
+        self.peerStatistics = None
+        if adaptiveBlockSize and self.transferLayer.defaultSZX >= 0:
+            self.peerStatistics = blockwise.PeerStatistics(self.transferLayer.defaultSZX)
+            self.transferLayer.peerStatistics = self.peerStatistics
+        self.matchingLayer = MatchingLayer(timer=self.timer)
+        self.transactionLayer = TransactionLayer(timer=self.timer, peerStatistics=self.peerStatistics)
+        self.udpLayer = UDPLayer(port, daemon, batchSize, address) if udpLayer is None else udpLayer
+        self.fastPath = self.FastPath(self)
+        #  connect layers
+        self.buildStack()
+
+    @classmethod
+    async def openAsync(cls, port=DEFAULT_PORT, address="", loop=None, **kwargs):
+        """
+        Builds a Communicator on an AsyncUDPLayer, with a TimingWheel
+        advanced by the event loop: retransmissions and timeouts then run on
+        the loop, like the handling of the received datagrams. Messages must
+        be sent from the loop as well.
+
+        :param port: the local UDP port, 0 for any free port
+        :param address: the local address to bind to
+        :param loop: the event loop, the running one if None
+        :param kwargs: the other arguments of the constructor
+        :return: the Communicator, its socket bound
+        """
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        udpLayer = await AsyncUDPLayer(port, address).open(loop)
+        communicator = cls(port=port, address=address, timer=TimingWheel().attach(loop),
+                           udpLayer=udpLayer, **kwargs)
+        #  the wheel is stopped with the stack
+        communicator.ownsTimer = True
+        return communicator
 
     def buildStack(self):
         """
@@ -1137,35 +1679,109 @@ class Communicator(UpperLayer):
         It can be overridden by subclasses in order to add further layers, e.g.
         for introducing a layer that drops or duplicates messages by a
         probabilistic model in order to evaluate the implementation.
+
+        In fused mode the transaction layer delivers to the fast path, which
+        re-enters the full stack at the matching layer when needed.
         """
-        raise NotImplementedError
-#        self.setLowerLayer(self.tokenLayer)
-#        self.tokenLayer.setLowerLayer(self.transferLayer)
-#        self.transferLayer.setLowerLayer(self.matchingLayer)
-#        self.matchingLayer.setLowerLayer(self.transactionLayer)
-#        self.transactionLayer.setLowerLayer(self.udpLayer)
-#        # transactionLayer.setLowerLayer(adverseLayer);
-#        # adverseLayer.setLowerLayer(udpLayer);
+        self.setLowerLayer(self.tokenLayer)
+        self.tokenLayer.setLowerLayer(self.transferLayer)
+        self.transferLayer.setLowerLayer(self.matchingLayer)
+        self.matchingLayer.setLowerLayer(self.transactionLayer)
+        self.transactionLayer.setLowerLayer(self.udpLayer)
+        # transactionLayer.setLowerLayer(adverseLayer);
+        # adverseLayer.setLowerLayer(udpLayer);
+        if self.fused:
+            self.transactionLayer.unregisterReceiver(self.matchingLayer)
+            self.transactionLayer.registerReceiver(self.fastPath)
+
+    def requiresFullStack(self, msg):
+        """
+        Checks whether a message needs blockwise or observe processing:
+        Block1, Block2 or Observe options, a Size1 option to check against
+        the largest body accepted, a stream payload, a payload larger than
+        a block or a response to a block demand or an upload.
+
+        :param msg: the message
+        :return: True if the message must go through every layer
+        """
+        if msg.requiresBlockwise:
+            return True
+        opts = msg.options
+        if options.block1 in opts or options.block2 in opts or options.observe in opts:
+            return True
+        if options.size1 in opts and self.transferLayer.maxBodySize is not None:
+            return True
+        if self.transferLayer.awaitsResponse(msg):
+            return True
+        payload = msg.payload
+        if payload is None:
+            return False
+        if blockwise.isStream(payload):
+            return True
+        szx = self.transferLayer.getSZX(msg.peerAddress)
+        return szx >= 0 and len(payload) > blockwise.decodeSZX(szx)
 
     def doSendMessage(self, msg):
         """
         defensive programming before entering the stack, lower layers should assume a correct message.
         """
-        raise NotImplementedError
-
-#        if msg:
-#            #  check message before sending through the stack
-#            if msg.getPeerAddress().getAddress() is None:
-#                Exception("Remote address not specified")
-#                #  delegate to first layer
-#            self.sendMessageOverLowerLayer(msg)
+        #  check message before sending through the stack
+        if msg.peerAddress is None:
+            logging.error("Remote address not specified: %s", msg.key())
+            return
+        if self.fused and not self.requiresFullStack(msg):
+            self.tokenLayer.prepareMessage(msg)
+            self.matchingLayer.prepareMessage(msg)
+            self.fastSent += 1
+            self.transactionLayer.sendMessage(msg)
+        else:
+            #  delegate to first layer
+            self.sendMessageOverLowerLayer(msg)
+
+    def sendTemplate(self, template, peerAddress, token=b"", msg_type=msgType.non, observe=None):
+        """
+        Sends a message rendered from a MessageTemplate straight through the
+        UDP layer, with a fresh message ID. Only non-confirmable messages whose
+        options and payload fit into one block bypass the stack this way: they need neither
+        retransmission nor block-wise transfer.
+
+        :param template: the MessageTemplate of the message
+        :param peerAddress: the address of the peer
+        :param token: the token of the exchange
+        :param msg_type: the message type
+        :param observe: the value of the Observe option reserved by the template
+        :return: the message ID, or None if the message has to be sent as a
+            Message through the stack
+        """
+        szx = self.transferLayer.getSZX(peerAddress)
+        if msg_type != msgType.non or szx >= 0 and len(template.body) > blockwise.decodeSZX(szx):
+            return None
+        message_id = self.transactionLayer.nextMessageID()
+        self.udpLayer.sendDatagram(template.render(message_id, token, msg_type, observe), peerAddress)
+        self.fastSent += 1
+        self.numMessagesSent += 1
+        return message_id
 
     def doReceiveMessage(self, msg):
-        raise NotImplementedError
-#        if isinstance(msg, (Response,)):
-#            #  initiate custom response handling
-#            if response.getRequest() is not None:
-#                response.getRequest().handleResponse(response)
-#            #  pass message to registered receivers
-#        self.deliverMessage(msg)
+        #  pass message to registered receivers
+        self.deliverMessage(msg)
+
+    def getPort(self):
+        return self.udpLayer.getPort()
 
+    def close(self):
+        """
+        Closes the UDP socket of the stack and stops its own timer.
+        """
+        self.udpLayer.close()
+        if self.ownsTimer:
+            self.timer.stop()
+
+    def getStats(self):
+        stats = dict()
+        stats["Fused"] = self.fused
+        stats["Fast path messages sent"] = self.fastSent
+        stats["Fast path messages received"] = self.fastReceived
+        stats["Messages sent"] = self.numMessagesSent
+        stats["Messages received"] = self.numMessagesReceived
+        return stats
@@ -3,13 +3,279 @@
 test
 """
 import logging
-import math
-from struct import unpack, pack, calcsize
+import sys
+import threading
+from array import array
+from collections.abc import MutableMapping
+from struct import Struct, error as StructError
 from pycolo import PROTOCOL_VERSION as v
-from pycolo.codes import options as refOptions, opt_i, msgType
+from pycolo.codes import options as refOptions, optionTable, msgType, isElective, textMediaCodes
 from pycolo.codes import codes as refCodes
 from pycolo.codes import msgType as refType
-from pycolo.request import request
+
+PAYLOAD_MARKER = 0xFF
+
+# Precompiled wire formats
+_HEADER = Struct("!BBH")
+_UINT16 = Struct("!H")
+
+# Longest option header: one byte of nibbles, two 2-byte extensions
+_MAX_OPTION_HEADER = 5
+
+_OPTION_COUNT = len(optionTable)
+
+# Options whose value must be valid UTF-8
+_STRING_OPTIONS = frozenset(
+    option.number for option in optionTable if option is not None and option.format == "string")
+
+# Observe value reserved by message templates, encoded in 3 bytes
+_OBSERVE_PLACEHOLDER = 0xFFFFFF
+
+# Largest payload of a UDP datagram
+MAX_DATAGRAM_SIZE = 65507
+
+# Per-thread buffer used by Message.to_raw
+_scratch = threading.local()
+
+
+def _pack_option_header(buffer, pointer, delta, length):
+    """
+    Writes an option header (delta and length nibbles followed by their
+    extended forms, if any) into buffer.
+
+    :param buffer: writable buffer
+    :param pointer: position of the option header in buffer
+    :param delta: option number delta to the previous option
+    :param length: length of the option value
+    :return: position of the option value in buffer
+    """
+    start = pointer
+    pointer += 1
+    if delta < 13:
+        raw_delta = delta
+    elif delta < 269:
+        raw_delta = 13
+        buffer[pointer] = delta - 13
+        pointer += 1
+    else:
+        raw_delta = 14
+        _UINT16.pack_into(buffer, pointer, delta - 269)
+        pointer += 2
+    if length < 13:
+        raw_length = length
+    elif length < 269:
+        raw_length = 13
+        buffer[pointer] = length - 13
+        pointer += 1
+    else:
+        raw_length = 14
+        _UINT16.pack_into(buffer, pointer, length - 269)
+        pointer += 2
+    buffer[start] = raw_delta << 4 | raw_length
+    return pointer
+
+
+def _option_header(delta, length):
+    header = bytearray(_MAX_OPTION_HEADER)
+    return bytes(header[:_pack_option_header(header, 0, delta, length)])
+
+
+def _option_nibbles(option_header):
+    fields = []
+    for nibble in (option_header >> 4, option_header & 15):
+        if nibble == 15:
+            return None
+        fields += _NIBBLE_FORMS.get(nibble, (nibble, 0))
+    return tuple(fields)
+
+# Base value and extension size of the delta and length nibbles 13 and 14
+_NIBBLE_FORMS = {13: (13, 1), 14: (269, 2)}
+
+# Decoding of the first option header byte: (delta base, delta extension
+# size, length base, length extension size), None for reserved nibbles
+_OPTION_NIBBLES = tuple(_option_nibbles(option_header) for option_header in range(256))
+
+# Encoded option headers for deltas below 16 and lengths below 64, at index
+# delta << 6 | length. Other headers are packed by _pack_option_header.
+_OPTION_HEADERS = tuple(_option_header(delta, length) for delta in range(16) for length in range(64))
+
+
+class OptionView(MutableMapping):
+    """
+    Options of a decoded message, by option number.
+
+    The framing pass of :meth:`Message.from_raw` only records a
+    (number, offset, length) triple per option. A value is decoded from the
+    datagram the first time its option number is looked up, so messages that
+    are dropped after checking a couple of options never pay for the others.
+    Any modification materializes all the options first.
+
+    :param raw: memoryview of the datagram
+    :param spans: flat list of (number, offset, length) triples, sorted by
+        option number
+    """
+
+    __slots__ = ("_raw", "_spans", "_values")
+
+    def __init__(self, raw, spans):
+        self._raw = raw
+        self._spans = spans
+        self._values = {}
+
+    def _numbers(self):
+        numbers = dict.fromkeys(self._values)
+        numbers.update(dict.fromkeys(self._spans[::3]))
+        return numbers
+
+    def _materialize(self):
+        for option_num in self._numbers():
+            self[option_num]
+        self._spans = []
+
+    def __getitem__(self, option_num):
+        try:
+            return self._values[option_num]
+        except KeyError:
+            pass
+        spans, raw = self._spans, self._raw
+        values = []
+        for i in range(0, len(spans), 3):
+            if spans[i] == option_num:
+                offset = spans[i + 1]
+                values.append(raw[offset:offset + spans[i + 2]])
+            elif spans[i] > option_num:
+                break
+        if not values:
+            raise KeyError(option_num)
+        option = optionTable[option_num]
+        decoder = option.decoder
+        if option.repeatable:
+            value = [decoder(value) for value in values]
+        else:
+            value = decoder(values[-1])
+        self._values[option_num] = value
+        return value
+
+    def __contains__(self, option_num):
+        return option_num in self._values or option_num in self._spans[::3]
+
+    def __setitem__(self, option_num, value):
+        self._materialize()
+        self._values[option_num] = value
+
+    def __delitem__(self, option_num):
+        self._materialize()
+        del self._values[option_num]
+
+    def __iter__(self):
+        return iter(self._numbers())
+
+    def __len__(self):
+        return len(self._numbers())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class MessageTemplate:
+    """
+    Wire form of a message whose options and payload do not change between
+    sends, typically the response of a resource to every client. Options and
+    payload are serialized once, rendering only writes the 4-byte header and
+    the token in front of them.
+
+    For notifications, the template can reserve an Observe option of 3 bytes
+    whose value is written at render time. Its value is then not encoded in
+    the fewest bytes, which receivers have to accept.
+
+    A template becomes stale when the represented resource changes, see
+    :meth:`pycolo.resource.Resource.changed`.
+
+    :param msg: the message to pre-serialize
+    :param observe: reserve an Observe option, set by each rendering
+    """
+
+    __slots__ = ("msg_type", "status_code", "body", "observe_offset")
+
+    def __init__(self, msg, observe=False):
+        self.msg_type = msg.msg_type
+        self.status_code = msg.status_code
+        options = msg.options
+        self.observe_offset = None
+        if observe:
+            options = dict(options)
+            options[refOptions.observe] = _OBSERVE_PLACEHOLDER
+            # the value follows the options before it and a 1-byte header
+            self.observe_offset = len(Message(
+                message_id=0,
+                options={number: value for number, value in options.items() if number < refOptions.observe}
+            ).to_raw()) - _HEADER.size + 1
+        raw = Message(
+            msg_type=msg.msg_type,
+            status_code=msg.status_code,
+            message_id=0,
+            options=options,
+            payload=msg.payload).to_raw()
+        self.body = raw[_HEADER.size:]
+
+    def render_into(self, buffer, offset, message_id, token=b"", msg_type=None, observe=None):
+        """
+        Writes the message for an exchange into buffer.
+
+        :param buffer: writable bytes-like object
+        :param offset: position of the first byte of the message in buffer
+        :param message_id: message ID of the exchange
+        :param token: token of the exchange
+        :param msg_type: message type, the one of the template if None
+        :param observe: value of the reserved Observe option
+        :return: the number of bytes written
+        :raise ValueError: if the message does not fit into the buffer, or
+            observe is given to a template without Observe option
+        """
+        if msg_type is None:
+            msg_type = self.msg_type
+        tkl = len(token)
+        body = self.body
+        end = offset + _HEADER.size + tkl + len(body)
+        if end > len(buffer):
+            raise ValueError("Buffer too small for message template")
+        _HEADER.pack_into(buffer, offset, v << 6 | msg_type << 4 | tkl,
+                          self.status_code, message_id)
+        pointer = offset + _HEADER.size
+        buffer[pointer:pointer + tkl] = token
+        buffer[pointer + tkl:end] = body
+        if observe is not None:
+            pointer += tkl + self._observeOffset()
+            buffer[pointer:pointer + 3] = (observe & 0xFFFFFF).to_bytes(3, "big")
+        return end - offset
+
+    def render(self, message_id, token=b"", msg_type=None, observe=None):
+        """
+        Returns the wire form of the message for an exchange.
+
+        :param message_id: message ID of the exchange
+        :param token: token of the exchange
+        :param msg_type: message type, the one of the template if None
+        :param observe: value of the reserved Observe option
+        :return: the encoded message
+        :raise ValueError: if observe is given to a template without Observe
+            option
+        """
+        if msg_type is None:
+            msg_type = self.msg_type
+        body = self.body
+        if observe is not None:
+            pointer = self._observeOffset()
+            body = b"".join((body[:pointer], (observe & 0xFFFFFF).to_bytes(3, "big"), body[pointer + 3:]))
+        return b"".join((
+            _HEADER.pack(v << 6 | msg_type << 4 | len(token), self.status_code, message_id),
+            token,
+            body))
+
+    def _observeOffset(self):
+        if self.observe_offset is None:
+            raise ValueError("Message template without Observe option")
+        return self.observe_offset
 
 
 class Message:
@@ -58,17 +324,12 @@ class Message:
     MAX_OPTION_DELTA = (1 << OPTION_DELTA_BITS) - 1
     MAX_OPTION_LENGTH_BASE = (1 << OPTION_LENGTH_BASE_BITS) - 2
 
-    # The receiver for this message.
-    peerAddress = None
-
-    # URI
-    uri = None
-
-    # indicates if the message requires a token
-    # this is required to handle implicit empty tokens (default value)
-    requiresToken = True
-    requiresBlockwise = False
-
+    # Per-message state lives in slots rather than in a per-instance
+    # __dict__, messages are kept in bulk by the caches of the stack.
+    __slots__ = (
+        "version", "msg_type", "status_code", "message_id", "token",
+        "options", "payload", "peerAddress", "uri", "timestamp",
+        "requiresToken", "requiresBlockwise", "timeoutHandler")
 
     def __init__(self,
                  msg_type=refType.con,
@@ -77,37 +338,53 @@ class Message:
                  peerAddress=None,
                  timestamp=0,
                  message_id=None,
-                 options={},
+                 options=None,
+                 token=b"",
                  version=1):
         """
         Constructor for a new CoAP message
         :param uri: the URI of the CoAP message
         :param type: the type of the CoAP message
-        :param payload: the payload of the CoAP message
+        :param payload: the payload of the CoAP message, bytes-like or str
         :param code: the code of the CoAP message (See class CodeRegistry)
+        :param peerAddress: the receiver or sender of the message
+        :param timestamp: time stamp associated with the message
         :param version: The CoAP version used. For now, this must be set to 1.
-        :param options: The list of header options set for the message.
+        :param options: The header options of the message, by option number.
+            Repeatable options hold a list of values.
+        :param token: The token of the message, 0 to 8 bytes.
         """
         self.msg_type = msg_type
         self.version = version
-        self.options = options
+        self.options = {} if options is None else options
+        self.token = token
         self.status_code = status_code
-        self.msg_type = msg_type
         self.message_id = message_id
         self.payload = payload
-        self.peerAddress= peerAddress
-#        self.retransmissioned = False
-#        self.retransmissioned = 0
 
-#        # A time stamp associated with the message.
-#        self.timestamp = timestamp  # TODO: Attention aux initialisations.
+        # The receiver for this message.
+        self.peerAddress = peerAddress
+
+        # URI
+        self.uri = None
+
+        # A time stamp associated with the message.
+        self.timestamp = timestamp
+
+        # indicates if the message requires a token
+        # this is required to handle implicit empty tokens (default value)
+        self.requiresToken = True
+        self.requiresBlockwise = False
+
+        # called with the message when it times out
+        self.timeoutHandler = None
 
     def is_reply(self):
         """
 
-        :return:
+        :return: True if the message is an ACK or a RST
         """
-        return self.msg_type == refType.ack or self.isReset()
+        return self.msg_type == refType.ack or self.msg_type == refType.rst
 
     def is_emptyACK(self):
         """
@@ -126,7 +403,7 @@ class Message:
             peerAddress=self.peerAddress,
             msg_type=refType.ack,
             status_code=refCodes.empty,
-            messageID=self.message_id)
+            message_id=self.message_id)
 
     def new_reject(self):
         """
@@ -138,71 +415,99 @@ class Message:
         return Message(
             msg_type=refType.rst,
             status_code=refCodes.empty,
-            messageID=self.message_id,
+            message_id=self.message_id,
             peerAddress=self.peerAddress)
 
     def new_reply(self, ack):
         """
         This method creates a matching reply for requests. It is addressed to
         the peer and has the same message ID and token.
-        :param ack set true to send ACK else RST
-        :param ack:
+        :param ack: set true to send ACK else RST
         """
 
         reply = Message(
-            messageID=self.message_id,
+            message_id=self.message_id,
             status_code=refCodes.empty,
-            peerAddress=self.peerAddress
+            peerAddress=self.peerAddress,
+            token=self.token
         )
 
-        if self.msg_type == self.messageType.CON:
-            reply.msg_type = self.message_type.ACK  if msgType.ack  else msgType.RST
+        if self.msg_type == refType.con:
+            reply.msg_type = refType.ack if ack else refType.rst
         else:
-            reply.msg_type = self.messageType.NON
+            reply.msg_type = refType.non
 
         return reply
 
-
-    def _encode_header(self):
-        header_format = "!BBH"
-        token_format = ""
-        if hasattr(self, "token"):
-            tkl, token = len(self.token), self.token
-            token_format =  tkl * "B"
-        else:
-            tkl, token = 0, b""
-        msg_type = self.msg_type if hasattr(self, "msg_type") else 0
-        version_msgType_tkl = v << 6 & 192 | msg_type << 4 & 48 | tkl & 15
-        header = [pack(header_format, version_msgType_tkl, self.status_code, self.message_id)]
-        if token_format:
-            header.append(pack("!" + token_format, token))
-        return b"".join(header)
-
-    def _encode_options(self):
-        """
-        This function is used to dump byte array representation of
-        a options dictionary.
-
-        :return: Encoded bytes array representing options
-        """
-        lastOptionNumber = 0
-        list_encoded_options = []
-        for option_number in sorted(self.options):
-            delta = self.options[option_number]["num"] - lastOptionNumber
-            list_encoded_options.append(
-                self.options[option_number]["encoder"](delta, self.options[option_number]))
-            lastOptionNumber = self.options[option_number]["num"]
-
-        return b"".join(list_encoded_options)
-
-    def _encode_payload(self):
-        if hasattr(self, "payload"):
-            if hasattr(self.payload, "encode"):
-                return b"\xff" + self.payload.encode("utf-8")
-            else:
-                return b""
+    def handle_timeout(self):
+        """
+        Called by the stack when the message could not be delivered or its
+        exchange did not complete in time. Calls the timeoutHandler of the
+        message, if any.
+        """
+        if self.timeoutHandler is not None:
+            self.timeoutHandler(self)
         else:
-            return b""
+            logging.info("Message timed out: %s", self.key())
+
+    def encode_into(self, buffer, offset=0):
+        """
+        Serializes header, token, options and payload straight into a
+        caller-supplied buffer, without building intermediate byte strings
+        for the framing.
+
+        :param buffer: writable bytes-like object (bytearray, memoryview...)
+        :param offset: position of the first byte of the message in buffer
+        :return: the number of bytes written
+        :raise ValueError: if the message does not fit into the buffer
+        """
+        token = self.token
+        tkl = len(token)
+        with memoryview(buffer) as view:
+            end = len(view)
+            pointer = offset + _HEADER.size + tkl
+            if pointer > end:
+                raise ValueError("Buffer too small for message %s" % (self.key(),))
+            _HEADER.pack_into(view, offset,
+                              v << 6 | self.msg_type << 4 | tkl,
+                              self.status_code, self.message_id)
+            view[pointer - tkl:pointer] = token
+
+            last_option = 0
+            for option_num in sorted(self.options):
+                option = optionTable[option_num] if option_num < _OPTION_COUNT else None
+                if option is None:
+                    raise KeyError("Unknown option number: %d" % option_num)
+                values = self.options[option_num]
+                if not option.repeatable:
+                    values = (values,)
+                for value in values:
+                    value = option.encoder(value)
+                    length = len(value)
+                    if pointer + _MAX_OPTION_HEADER + length > end:
+                        raise ValueError("Buffer too small for message %s" % (self.key(),))
+                    delta = option_num - last_option
+                    if delta < 16 and length < 64:
+                        header = _OPTION_HEADERS[delta << 6 | length]
+                        view[pointer:pointer + len(header)] = header
+                        pointer += len(header)
+                    else:
+                        pointer = _pack_option_header(view, pointer, delta, length)
+                    view[pointer:pointer + length] = value
+                    pointer += length
+                    last_option = option_num
+
+            payload = self.payload
+            if payload:
+                if hasattr(payload, "encode"):
+                    payload = payload.encode("utf-8")
+                length = len(payload)
+                if pointer + 1 + length > end:
+                    raise ValueError("Buffer too small for message %s" % (self.key(),))
+                view[pointer] = PAYLOAD_MARKER
+                view[pointer + 1:pointer + 1 + length] = payload
+                pointer += 1 + length
+        return pointer - offset
 
     def to_raw(self):
         """
@@ -211,108 +516,146 @@ class Message:
 
         :return A byte array containing the CoAP encoding of the message
         """
-        return b"".join([self._encode_header(), self._encode_options(), self._encode_payload()])
+        scratch = getattr(_scratch, "buffer", None)
+        if scratch is None:
+            scratch = _scratch.buffer = bytearray(MAX_DATAGRAM_SIZE)
+        return bytes(scratch[:self.encode_into(scratch)])
+
+    def template(self, observe=False):
+        """
+        Pre-serializes the options and payload of this message, for responses
+        that only differ by message ID and token.
+
+        :param observe: reserve an Observe option, for notifications
+        :return: a MessageTemplate
+        """
+        return MessageTemplate(self, observe)
 
-    def from_raw(self, raw):
+    def from_raw(self, raw, lazy=True):
         """
         Decodes the message from the its binary representation
 
-        :param byteArray: CoAP binary form message
+        The datagram is walked once through a :class:`memoryview`, header
+        fields are read with precompiled :class:`struct.Struct` objects and
+        the framing pass only records where each option value lies. Option
+        values are decoded by the :class:`OptionView` the first time they are
+        accessed, unless lazy is False. String values are checked to be
+        UTF-8 during framing, so that decoding them later cannot fail.
+
+        :param raw: CoAP binary form message (any bytes-like object)
+        :param lazy: decode option values on first access
+        :return: The message itself, or None if the datagram is malformed
         """
-        PAYLOAD_MARKER = b"\xff"
-        pointer, last_option = 0, 0
+        view = memoryview(raw)
+        size = len(view)
 
         # Header decoding
 
-        ver_t_tkl_pattern = "!B"
-        ver_t_tkl = unpack(ver_t_tkl_pattern, raw[pointer: pointer + calcsize(ver_t_tkl_pattern)])
-        ver_t_tkl = ver_t_tkl[0]
-        self.version = ver_t_tkl & 192 >> 6
-        self.message_type = ver_t_tkl & 48 >> 4
+        if size < _HEADER.size:
+            logging.error("Message too short: %d bytes", size)
+            return None
+        ver_t_tkl, self.status_code, self.message_id = _HEADER.unpack_from(view)
+        self.version = ver_t_tkl >> 6
+        self.msg_type = ver_t_tkl >> 4 & 3
         tkl = ver_t_tkl & 15
-        pointer += calcsize(ver_t_tkl_pattern)
-
-        code_pattern = "!B"
-        code = unpack(code_pattern, raw[pointer: pointer + calcsize(code_pattern)])
-        self.status_code = code[0]
-        pointer += calcsize(code_pattern)
-
-        message_id_pattern = "!H"
-        message_id = unpack(message_id_pattern, raw[pointer: pointer + calcsize(message_id_pattern)])
-        self.message_id = message_id[0]
-        pointer += calcsize(message_id_pattern)
+        pointer = _HEADER.size
 
         # Token decoding
-        if tkl:
-            token_pattern = "!" + (tkl * "B")
-            token = unpack(token_pattern, raw[pointer + calcsize(token_pattern)])
-            self.token = token[0]
-            pointer += calcsize(token_pattern)
-
-        # Options decoding
-
-        payload_marker_pattern = "!B"
-        while raw[pointer: pointer + calcsize(payload_marker_pattern)] != PAYLOAD_MARKER and len(raw[pointer:]):
-            common_option_pattern = "!B"
-            option_header = unpack(common_option_pattern, raw[pointer: pointer + calcsize(common_option_pattern)])
-            raw_delta, raw_length = option_header & 240, option_header & 15
-            pointer += calcsize(common_option_pattern)
-
-            # Delta decoding
-
-            if 0 <= raw_delta <= 12:
-                option_num = raw_delta + last_option
-                last_option = option_num
-            elif raw_delta == 13:
-                delta_pattern_1byte = "!B"
-                option_num = unpack(delta_pattern_1byte, raw[pointer:pointer + calcsize(delta_pattern_1byte)])  - 13
-                last_option = option_num
-                pointer += calcsize(delta_pattern_1byte)
-            elif raw_delta == 14:
-                delta_pattern_2bytes = "!2B"
-                option_num = unpack(delta_pattern_2bytes, raw[pointer:pointer + calcsize(delta_pattern_2bytes)]) - 269
-                last_option = option_num
-                pointer += calcsize(delta_pattern_2bytes)
-            elif raw_delta == 15:
-                logging.error("Message delta encoding : 15. Reserved for future use.")
-                return None
-
-            # Length decoding
-
-            if 0 <= raw_length <= 12:
-                length = raw_length
-            elif raw_length == 13:
-                length_pattern_1byte = "!B"
-                length = unpack(length_pattern_1byte, raw[pointer:pointer + calcsize(length_pattern_1byte)]) - 13
-                pointer += calcsize(length_pattern_1byte)
-            elif raw_length == 14:
-                length_pattern_2bytes = "!2B"
-                length = unpack(length_pattern_2bytes, raw[pointer:pointer + calcsize(length_pattern_2bytes)]) - 269
-                pointer += calcsize(length_pattern_2bytes)
-            elif raw_length == 15:
-                logging.error("Message Length encoding : 15. Reserved for future use.")
-                return None
-
-            if length not in opt_i[option_num]["range"]:
-                logging.error("Option too big. Encoding error")
-                return None
-
-            if not opt_i[option_num]["repeat"]:
-                self.options[opt_i[option_num]] = opt_i[option_num]["decoder"](raw[pointer:pointer + length])
-            else:
-                self.options.setdefault(opt_i[option_num], [])\
-                .append(opt_i[option_num]["decoder"](raw[pointer:pointer + length]))
-
-            pointer += length
+
+        if tkl > 8 or pointer + tkl > size:
+            logging.error("Invalid token length: %d", tkl)
+            return None
+        self.token = bytes(view[pointer:pointer + tkl])
+        pointer += tkl
+
+        # Options framing
+
+        spans = []
+        option_num = 0
+        try:
+            while pointer < size and view[pointer] != PAYLOAD_MARKER:
+                nibbles = _OPTION_NIBBLES[view[pointer]]
+                if nibbles is None:
+                    logging.error("Option delta or length encoding : 15. Reserved for future use.")
+                    return None
+                raw_delta, delta_size, length, length_size = nibbles
+                pointer += 1
+
+                # Extended delta and length
+
+                if delta_size == 1:
+                    raw_delta += view[pointer]
+                elif delta_size:
+                    raw_delta += _UINT16.unpack_from(view, pointer)[0]
+                pointer += delta_size
+                option_num += raw_delta
+
+                if length_size == 1:
+                    length += view[pointer]
+                elif length_size:
+                    length += _UINT16.unpack_from(view, pointer)[0]
+                pointer += length_size
+
+                if pointer + length > size:
+                    logging.error("Option %d overruns the datagram", option_num)
+                    return None
+
+                option = optionTable[option_num] if option_num < _OPTION_COUNT else None
+                if option is None:
+                    if not isElective(option_num):
+                        logging.error("Unknown critical option: %d", option_num)
+                        return None
+                elif not option.min_length <= length <= option.max_length:
+                    logging.error("Option too big. Encoding error")
+                    return None
+                else:
+                    if option_num in _STRING_OPTIONS:
+                        # lazily decoded values must not fail once accepted
+                        str(view[pointer:pointer + length], "utf-8")
+                    spans += (option_num, pointer, length)
+
+                pointer += length
+        except (IndexError, StructError):
+            logging.error("Truncated option header")
+            return None
+        except UnicodeDecodeError:
+            logging.error("Invalid UTF-8 in option %d", option_num)
+            return None
+
+        self.options = OptionView(view, spans)
+        if not lazy:
+            self.options = dict(self.options)
 
         # Payload decoding
 
-        if len(raw[pointer:]) and raw[pointer] == b"\xff"[0]:
-            self.payload = raw[pointer + 1:].decode("utf-8")
+        if pointer + 1 < size:
+            self.payload = view[pointer + 1:]
+        elif pointer < size:
+            logging.error("Payload marker followed by an empty payload")
+            return None
         else:
             self.payload = None
         return self
 
+    def payload_text(self):
+        """
+        Decodes the payload as text. The payload of a decoded message is kept
+        as a view on the datagram, it is only decoded when asked to, and only
+        if its Content-Format is textual (or unspecified).
+
+        :return: the payload as a string, or None if there is no payload or
+            the payload is binary
+        """
+        payload = self.payload
+        if payload is None or hasattr(payload, "encode"):
+            return payload
+        content_format = self.options.get(refOptions.content_format)
+        if content_format is not None and content_format not in textMediaCodes:
+            logging.warning("Payload of %s is not text: Content-Format %d",
+                            self.key(), content_format)
+            return None
+        return str(payload, "utf-8")
+
     def send(self):
         """
 
@@ -339,41 +682,37 @@ class Message:
 
     def key(self):
         """
-        Returns a string that is assumed to uniquely identify a message.
+        Returns a key that is assumed to uniquely identify a message.
 
-        :return: A string identifying the message
+        Keys are plain tuples, hashed and compared without formatting a
+        string on every lookup.
+
+        :return: (peer address, message ID, message type), the address is
+            None for local messages
         """
-        return "%s|%d|%s" % (
-            self.peerAddress if self.peerAddress else "local",
-            self.message_id,
-            self.msg_type)
+        return self.peerAddress, self.message_id, self.msg_type
 
     def transactionKey(self):
         """
-        Returns a string that is assumed to uniquely identify a transaction.
+        Returns a key that is assumed to uniquely identify a transaction.
         A transaction matches two buddies that have the same message ID between
         one this and the peer endpoint.
 
-        :return: A string identifying the transaction
+        :return: (peer address, message ID)
         """
-        return "%s|%d" % (
-            self.peerAddress if self.peerAddress else "local",
-            self.message_id
-        )
+        return self.peerAddress, self.message_id
 
     def sequenceKey(self):
         """
-        Returns a string that is assumed to uniquely identify a transfer. A
+        Returns a key that is assumed to uniquely identify a transfer. A
         transfer exceeds matching message IDs, as multiple transactions are
         involved, e.g., for separate responses or blockwise transfers.
         The transfer matching is done using the token (including the empty
         default token.
 
-        :return: A string identifying the transfer
+        :return: (peer address, token)
         """
-        return "%s#%s" % (
-            self.peerAddress if self.peerAddress else "local",
-            self.token)
+        return self.peerAddress, self.token
 
     def __str__(self):
 
@@ -396,3 +735,101 @@ class Message:
         footer = "======================================================="
 
         return "".join([header, "\n", str(info), "\n", footer])
+
+
+# Lookup tables splitting the first header byte, for bytes.translate
+_VERSION_OF = bytes(b >> 6 for b in range(256))
+_TYPE_OF = bytes(b >> 4 & 3 for b in range(256))
+_TKL_OF = bytes(b & 15 for b in range(256))
+
+
+class HeaderBatch:
+    """
+    Header fields of a batch of datagrams, stored column by column.
+
+    version, msg_type, tkl and status_code are ``bytes`` holding one value
+    per datagram, message_id is an ``array('H')``. All of them expose the
+    buffer protocol, e.g. ``numpy.frombuffer(batch.message_id, "u2")``
+    wraps the column without copying. Datagrams shorter than a CoAP header
+    get an all-zero row, which never matches version 1.
+
+    :param datagrams: the datagrams, as memoryviews
+    :param headers: the first four bytes of every datagram, concatenated
+    """
+
+    __slots__ = ("datagrams", "version", "msg_type", "tkl", "status_code", "message_id")
+
+    def __init__(self, datagrams, headers):
+        self.datagrams = datagrams
+        first = headers[0::4]
+        self.version = first.translate(_VERSION_OF)
+        self.msg_type = first.translate(_TYPE_OF)
+        self.tkl = first.translate(_TKL_OF)
+        self.status_code = headers[1::4]
+        message_ids = bytearray(len(first) * 2)
+        message_ids[0::2] = headers[2::4]
+        message_ids[1::2] = headers[3::4]
+        self.message_id = array("H")
+        self.message_id.frombytes(message_ids)
+        if sys.byteorder == "little":
+            self.message_id.byteswap()
+
+    def __len__(self):
+        return len(self.datagrams)
+
+    def select(self, msg_type=None, status_code=None):
+        """
+        Returns the rows holding well-formed CoAP headers, optionally
+        restricted to a message type and a code.
+
+        :param msg_type: only keep messages of this type
+        :param status_code: only keep messages with this code
+        :return: list of row indices
+        """
+        rows = [row for row, version in enumerate(self.version)
+                if version == v and self.tkl[row] <= 8]
+        if msg_type is not None:
+            rows = [row for row in rows if self.msg_type[row] == msg_type]
+        if status_code is not None:
+            rows = [row for row in rows if self.status_code[row] == status_code]
+        return rows
+
+    def decode(self, rows=None, lazy=True):
+        """
+        Fully decodes some rows of the batch.
+
+        :param rows: row indices, all rows if None
+        :param lazy: decode option values on first access
+        :return: list of Message, None for malformed datagrams
+        """
+        datagrams = self.datagrams
+        if rows is None:
+            rows = range(len(datagrams))
+        return [Message().from_raw(datagrams[row], lazy) for row in rows]
+
+
+def decode_batch(buffers, offsets=None):
+    """
+    Extracts version, type, token length, code and message ID of many
+    datagrams in one pass. Full decoding can then be limited to the rows
+    that survive filtering with :meth:`HeaderBatch.decode`.
+
+    :param buffers: a list of datagrams, or a single buffer holding them
+        back to back if offsets is given
+    :param offsets: start of each datagram in buffers, each datagram
+        ending where the next one starts
+    :return: a HeaderBatch
+    """
+    if offsets is None:
+        datagrams = [memoryview(buffer) for buffer in buffers]
+    else:
+        view = memoryview(buffers)
+        ends = list(offsets[1:])
+        ends.append(len(view))
+        datagrams = [view[start:end] for start, end in zip(offsets, ends)]
+    headers = b"".join([datagram[:_HEADER.size] for datagram in datagrams])
+    if len(headers) != _HEADER.size * len(datagrams):
+        headers = b"".join([
+            bytes(datagram[:_HEADER.size]) if len(datagram) >= _HEADER.size else bytes(_HEADER.size)
+            for datagram in datagrams])
+    return HeaderBatch(datagrams, headers)
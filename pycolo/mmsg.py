@@ -0,0 +1,229 @@
+# coding=utf-8
+
+"""
+pycolo.mmsg
+~~~~~~~~~~~
+
+Batched datagram I/O. On Linux the recvmmsg and sendmmsg system calls are
+used through ctypes to move many datagrams per system call. Elsewhere, or if
+the C library does not provide them, the same interface falls back to a
+loop over the socket module.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import sys
+from struct import Struct
+
+# Size of struct sockaddr_storage
+SOCKADDR_SIZE = 128
+
+_PORT = Struct("!H")
+_FLOWINFO = Struct("!I")
+_FAMILY = Struct("=H")
+_SCOPE_ID = Struct("=I")
+
+MSG_WAITFORONE = 0x10000
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _MsgHdr),
+        ("msg_len", ctypes.c_uint)]
+
+
+def _loadLibc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    for function in (recvmmsg, sendmmsg):
+        function.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    return libc
+
+_libc = _loadLibc()
+
+
+def hasNativeBatching():
+    """
+    :return: True if recvmmsg and sendmmsg are available
+    """
+    return _libc is not None
+
+
+def _decodeAddress(name):
+    """
+    Converts a raw sockaddr into the address tuple used by the socket module.
+    """
+    family = _FAMILY.unpack_from(name)[0]
+    port = _PORT.unpack_from(name, 2)[0]
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, name[4:8]), port
+    if family != socket.AF_INET6:
+        return None
+    return (socket.inet_ntop(socket.AF_INET6, name[8:24]), port,
+            _FLOWINFO.unpack_from(name, 4)[0], _SCOPE_ID.unpack_from(name, 24)[0])
+
+
+def _encodeAddress(family, address):
+    """
+    Converts an address tuple with a numeric host into a raw sockaddr.
+    """
+    name = bytearray(SOCKADDR_SIZE)
+    _FAMILY.pack_into(name, 0, family)
+    _PORT.pack_into(name, 2, address[1])
+    if family == socket.AF_INET:
+        name[4:8] = socket.inet_pton(socket.AF_INET, address[0])
+        return bytes(name[:16])
+    name[8:24] = socket.inet_pton(socket.AF_INET6, address[0])
+    if len(address) > 2:
+        _FLOWINFO.pack_into(name, 4, address[2])
+        _SCOPE_ID.pack_into(name, 24, address[3])
+    return bytes(name[:28])
+
+
+class BatchReceiver:
+    """
+    Receives up to count datagrams per call into a pool of buffers that are
+    allocated once and reused by every call.
+
+    :param sock: a bound datagram socket, in blocking mode
+    :param count: maximum number of datagrams per batch
+    :param size: size of each receive buffer
+    :param native: use recvmmsg, if None whenever it is available
+    """
+
+    def __init__(self, sock, count, size, native=None):
+        self.socket = sock
+        self.count = count
+        self.buffers = [bytearray(size) for _ in range(count)]
+        self.native = hasNativeBatching() if native is None else native
+        if self.native:
+            self._names = (ctypes.c_char * SOCKADDR_SIZE * count)()
+            self._iovecs = (_IOVec * count)()
+            self._msgs = (_MMsgHdr * count)()
+            self._views = [(ctypes.c_char * size).from_buffer(buffer) for buffer in self.buffers]
+            for i, view in enumerate(self._views):
+                self._iovecs[i].iov_base = ctypes.addressof(view)
+                self._iovecs[i].iov_len = size
+                hdr = self._msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self._names[i])
+                hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+                hdr.msg_iovlen = 1
+
+    def receive(self):
+        """
+        Waits for at least one datagram, then takes every datagram already
+        queued on the socket, up to count.
+
+        :return: list of (buffer, length, address), the buffers are reused
+            by the next call
+        :raise OSError: if the socket fails
+        """
+        if self.native:
+            return self._receiveNative()
+        return self._receiveLoop()
+
+    def _receiveNative(self):
+        msgs = self._msgs
+        for i in range(self.count):
+            msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        received = _libc.recvmmsg(self.socket.fileno(), msgs, self.count, MSG_WAITFORONE, None)
+        if received < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return [(self.buffers[i], msgs[i].msg_len, _decodeAddress(self._names[i].raw))
+                for i in range(received)]
+
+    def _receiveLoop(self):
+        buffers = self.buffers
+        length, address = self.socket.recvfrom_into(buffers[0])
+        batch = [(buffers[0], length, address)]
+        flags = getattr(socket, "MSG_DONTWAIT", None)
+        if flags is None:
+            return batch
+        for buffer in buffers[1:]:
+            try:
+                length, address = self.socket.recvfrom_into(buffer, 0, flags)
+            except (BlockingIOError, InterruptedError):
+                break
+            batch.append((buffer, length, address))
+        return batch
+
+
+def sendBatch(sock, datagrams, native=None):
+    """
+    Sends many datagrams with as few system calls as possible.
+
+    :param sock: a datagram socket
+    :param datagrams: list of (data, address), data being bytes. On the
+        native path, the datagrams to a host name rather than a numeric
+        address are sent one by one
+    :param native: use sendmmsg, if None whenever it is available
+    :return: the number of datagrams sent
+    :raise OSError: if the socket fails
+    """
+    if native is None:
+        native = hasNativeBatching()
+    if not native:
+        for data, address in datagrams:
+            sock.sendto(data, address)
+        return len(datagrams)
+
+    batch = []
+    for data, address in datagrams:
+        try:
+            batch.append((data, _encodeAddress(sock.family, address)))
+        except OSError:
+            #  a host name, resolved by the socket module
+            sock.sendto(data, address)
+    direct = len(datagrams) - len(batch)
+    count = len(batch)
+    if not count:
+        return direct
+    iovecs = (_IOVec * count)()
+    msgs = (_MMsgHdr * count)()
+    for i, (data, name) in enumerate(batch):
+        iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        iovecs[i].iov_len = len(data)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.cast(ctypes.c_char_p(name), ctypes.c_void_p)
+        hdr.msg_namelen = len(name)
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+
+    sent = 0
+    while sent < count:
+        result = _libc.sendmmsg(sock.fileno(), ctypes.pointer(msgs[sent]), count - sent, 0)
+        if result < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            raise OSError(error, os.strerror(error))
+        sent += result
+    return direct + sent
@@ -1,143 +1,209 @@
 # coding=utf-8
 
 """
-The TokenManager stores all tokens currently used in transfers.
-New transfers can acquire unique tokens from the manager.
+The ObservingManager keeps the observing relationships of an endpoint.
+Each Communicator owns one; the module functions act on a default manager.
 """
 
 import logging
 import time
-from pycolo.codes import options
+from pycolo.codes import msgType, options
+from pycolo.message import Message
 from pycolo import OBSERVING_REFRESH_INTERVAL
 
 
-# Maps a resource path string to the resource's observers stored by client
-# address string.
-uri2client = dict()
-
-checkInterval = OBSERVING_REFRESH_INTERVAL
-intervalByResource = dict()
+class ObservingManager:
+    """
+    Observing relationships between resources and clients.
 
+    :param checkInterval: the number of notifications until a CON
+        notification will be used
+    :param communicator: the Communicator the notifications are sent
+        through, the one owning this manager
+    """
 
-def isObserved(uri):
-    return uri in uri2client
+    class ObservingRelationship:
+        """
+        Entity class to keep state of an observer: the client, the token of
+        its request and the message ID of the last notification, for RST
+        matching.
+        """
+        __slots__ = ("clientID", "resource", "token", "lastMID")
+
+        def __init__(self, request, resource):
+            self.clientID = request.peerAddress
+            self.resource = resource
+            self.token = request.token
+            self.lastMID = None
+
+    def __init__(self, checkInterval=OBSERVING_REFRESH_INTERVAL, communicator=None):
+        # Maps a resource to its observers stored by client address, and a
+        # client address to the resources it observes.
+        self.observersByResource = dict()
+        self.observersByClient = dict()
+        self.checkInterval = checkInterval
+        self.communicator = communicator
+        self.intervalByResource = dict()
+        self.sequenceByResource = dict()
+
+    def isObserved(self, resource):
+        return resource in self.observersByResource
+
+    def notifyObservers(self, resource):
+        """
+        Sends the current representation of a resource to its observers,
+        every checkInterval-th time as a CON to check they are still
+        interested. Non-confirmable notifications are rendered from the
+        template of the resource.
+
+        :param resource: the resource that changed
+        :return: the number of notifications sent
+        """
+        observers = self.observersByResource.get(resource)
+        if not observers:
+            return 0
+        if self.communicator is None:
+            logging.error("No communicator to notify the observers of %s", resource.title)
+            return 0
+        logging.info("Notifying %d observers about %s", len(observers), resource.title)
+        #  get/initialize
+        check = self.intervalByResource.get(resource, self.checkInterval) - 1
+        #  update
+        if check <= 0:
+            self.intervalByResource[resource] = self.checkInterval
+            logging.info("Refreshing observing relationship: %s", resource.title)
+        else:
+            self.intervalByResource[resource] = check
+        # the response establishing the relationship carried 1
+        sequence = self.sequenceByResource[resource] = (self.sequenceByResource.get(resource, 1) + 1) & 0xFFFFFF
+        template = resource.getTemplate()
+        representation = None
+        for observer in list(observers.values()):
+            mid = None
+            if check > 0:
+                mid = self.communicator.sendTemplate(template, observer.clientID, observer.token, observe=sequence)
+            if mid is None:
+                #  confirmable or block-wise notification
+                if representation is None:
+                    representation = resource.getRepresentation()
+                notification = Message(
+                    msg_type=msgType.con if check <= 0 else msgType.non,
+                    status_code=representation.status_code,
+                    token=observer.token,
+                    options=dict(representation.options),
+                    payload=representation.payload,
+                    peerAddress=observer.clientID)
+                notification.options[options.observe] = sequence
+                self.communicator.sendMessage(notification)
+                mid = notification.message_id
+            self.updateLastMID(observer.clientID, resource, mid)
+        return len(observers)
+
+    def updateLastMID(self, clientID, resource, mid):
+        """
+        Records the message ID of the last notification sent to an observer.
+        """
+        toUpdate = self.observersByClient.get(clientID, {}).get(resource)
+        if toUpdate is not None:
+            toUpdate.lastMID = mid
+            logging.info("Updated last MID for observing relationship: %s @ %s", clientID, resource.title)
+            return
+        logging.warning("Cannot find observing relationship to update MID: %s @ %s", clientID, resource.title)
+
+    def prepareResponse(self, request):
+        """
+        consecutive response require new MID that must be stored for RST matching
+        :param request:
+        """
+        raise NotImplementedError
+    #    if request.response.MID == -1:
+    #        request.getResponse().setMID(TransactionLayer.nextMessageID())
+    #    #  16-bit second counter
+    #    secs = ((round(time.time() * 1000) - request.startTime) / 1000) & 0xFFFF
+    #    request.getResponse().setOption(Option(secs, options.OBSERVE))
+    #    #  store MID for RST matching
+    #    updateLastMID(str(request.peer), request.uri, request.response.MID)
+
+    def addObserver(self, request, resource):
+        """
+        Establishes an observing relationship, replacing the previous one of
+        the same client on the resource.
+
+        :param request: the GET request with an Observe option
+        :param resource: the resource to observe
+        """
+        relationship = self.ObservingRelationship(request, resource)
+        self.observersByResource.setdefault(resource, dict())[relationship.clientID] = relationship
+        self.observersByClient.setdefault(relationship.clientID, dict())[resource] = relationship
+        logging.info("Established observing relationship: %s @ %s", relationship.clientID, resource.title)
+        return relationship
+
+    def removeObserver(self, client, resource=None, mid=None):
+        """
+        Remove a selected observer from observation structures.
+        Remove an observer by MID from RST.
+        :param mid: the MID from the RST
+        :param resource: the resource to un-observe.
+        :param client: the peer address
+        :return: True if a relationship was terminated
+        """
+        clientObservees = self.observersByClient.get(client)
+        if not clientObservees:
+            #  should not be called if not existent
+            logging.warning("Cannot find observing relationship: %s", client)
+            return False
+        if mid is not None:
+            for entry in clientObservees.values():
+                if mid == entry.lastMID:  # found it
+                    self.removeRelationship(entry)
+                    logging.info("Terminated observing relationship by RST: %s @ %s", client, entry.resource.title)
+                    return True
+            return False
+        if resource is not None:
+            entry = clientObservees.get(resource)
+            if entry is None:
+                return False
+            self.removeRelationship(entry)
+            logging.info("Terminated observing relationship: %s @ %s", client, resource.title)
+            return True
+        for entry in list(clientObservees.values()):
+            self.removeRelationship(entry)
+        logging.info("Terminated all observing relationships for client: %s", client)
+        return True
+
+    def removeRelationship(self, relationship):
+        for table, outer, inner in ((self.observersByResource, relationship.resource, relationship.clientID),
+                                    (self.observersByClient, relationship.clientID, relationship.resource)):
+            entries = table.get(outer)
+            if entries is not None:
+                entries.pop(inner, None)
+                if not entries:
+                    del table[outer]
+
+
+# Manager used by the module functions
+defaultManager = ObservingManager()
+
+
+def isObserved(resource):
+    return defaultManager.isObserved(resource)
 
 
 def notifyObservers(resource):
-    raise NotImplementedError
-#    if resource.path in uri2client:
-#        observers = uri2client(resource.path)
-#        if observers:
-#            logging.info("Notifying %d observers about %s" % len(observers), resource.path)
-#            #  get/initialize
-#            if resource.path not in intervalByResource:
-#                check = checkInterval
-#            else:
-#                check = intervalByResource[resource.path] - 1
-#            #  update
-#            if check <= 0:
-#                intervalByResource[resource.path] = checkInterval
-#                logging.info("Refreshing observing relationship: %s" % resource.path)
-#            else:
-#                intervalByResource.put(resource.getPath(), check)
-#            for observer in observers:
-#                request = Request()
-#                if check <= 0:  #  check
-#                    request.type(msgType.CON)
-#                else:
-#                    request.type(msgType.NON)
-#                #  execute
-#                resource.get(request)
-#                prepareResponse(request)
-#                request.sendResponse()
-
-
-def updateLastMID(clientID, path, mid):
-    raise NotImplementedError
-#    clientObservees = client2uri[clientID]
-#    if clientObservees is not None:
-#        if toUpdate is not None:
-#            toUpdate.lastMID = mid
-#            logging.info("Updated last MID for observing relationship: %s @ %s"\
-#            .format(clientID, toUpdate.resourcePath))
-#            return
-#    logging.warning("Cannot find observing relationship to update MID: {:s} @ {:s}"\
-#    .format(clientID, path))
+    return defaultManager.notifyObservers(resource)
+
+
+def updateLastMID(clientID, resource, mid):
+    return defaultManager.updateLastMID(clientID, resource, mid)
 
 
 def prepareResponse(request):
-    """
-    consecutive response require new MID that must be stored for RST matching
-    :param request:
-    """
-    raise NotImplementedError
-#    if request.response.MID == -1:
-#        request.getResponse().setMID(TransactionLayer.nextMessageID())
-#    #  16-bit second counter
-#    secs = ((round(time.time() * 1000) - request.startTime) / 1000) & 0xFFFF
-#    request.getResponse().setOption(Option(secs, options.OBSERVE))
-#    #  store MID for RST matching
-#    updateLastMID(str(request.peer), request.uri, request.response.MID)
+    return defaultManager.prepareResponse(request)
 
 
 def addObserver(request, resource):
-    """
-    get clients map for the given resource path
-    :param request:
-    :param resource:
-    """
-    raise NotImplementedError
-#    Map<String, ObservingRelationship> resourceObservers = observersByResource.get(resource.getPath())
-#
-#    if not resourceObservers:
-#        #  lazy creation
-#        resourceObservers = dict()
-#        observersByResource[resource.getPath()] = resourceObservers
-#        #  get resource map for given client address
-#        Map<String, ObservingRelationship> clientObservees = observersByClient.get(request.getPeerAddress().__str__())
-#
-#    if not clientObservees:
-#        #  lazy creation
-#        clientObservees = dict()
-#        observersByClient.put(str(request.peerAddress), clientObservees)
-#
-#    #  save relationship for notifications triggered by resource
-#    resourceObservers.put(str(request.peerAddress), toAdd)
-#    #  save relationship for actions triggered by client
-#    clientObservees.put(resource.path, toAdd)
-#    logging.info("Established observing relationship: %s @ %s", str(request.peerAddress), resource.path)
-#    #  update response
-#    request.response.options[0, options.OBSERVE]
+    return defaultManager.addObserver(request, resource)
 
 
 def removeObserver(client, resource=None, mid=None):
-    """
-    Remove a selected observer from observation structures.
-    Remove an observer by MID from RST.
-    :param mid: the MID from the RST
-    :param resource: the resource to un-observe.
-    :param client: the peer address as string.
-    """
-    raise NotImplementedError
-#    if mid:
-#        if client2uri[client]:
-#            for entry in clientObservees.values():
-#                if mid == entry.lastMID and client == entry.clientID:  # found it
-#                    del(entry)
-#                    logging.info("Terminated observing relationship by RST: {:s} @ {:s}"\
-#                    .format(client, toRemove.resourcePath))
-#                    return
-#        return
-#    if resource:
-#        client2uri[client].remove(resource)
-#        uri2client[resource].remove(client)
-#        logging.info("Terminated observing relationship: %s @ %s".format(resource, client))
-#        return
-#    if client in client2uri:
-#        for entry in client2uri[client]:
-#            entry.remove(client)
-#        del(client2uri[client])
-#        logging.info("Terminated all observing relationships for client: %s" % client)
-#        return
-#    #  should not be called if not existent
-#    logging.warning("Cannot find observing relationship: %s @ %s".format(resource, client))
+    return defaultManager.removeObserver(client, resource, mid)
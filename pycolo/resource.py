@@ -8,7 +8,7 @@ Pycolo resource.
 """
 import re
 
-from pycolo.observe import notifyObservers
+from pycolo import observe
 
 
 class Resource:
@@ -18,10 +18,15 @@ class Resource:
     :param link_format:
     :param hidden:
     :param observable:
+    :param observingManager: the ObservingManager of the Communicator
+        serving the resource, the default manager if None
     :raise:
     """
     subResources = dict()
 
+    # Cached MessageTemplate of the representation, dropped by changed()
+    template = None
+
 
     attributes = {
         "resourceType": "rt",
@@ -34,7 +39,7 @@ class Resource:
     def __init__(self, title, resourceIdentifier=None,
                  interfaceDescription=None, link_format="",
                  hidden=False, observable=False, parent=None,
-                 resourceType=None, contentType=None):
+                 resourceType=None, contentType=None, observingManager=None):
         """
         If a Core Link description string is passed, the resource
         created match the description
@@ -52,6 +57,7 @@ class Resource:
         self.resourceIdentifier = resourceIdentifier
         self.interfaceDescription = interfaceDescription
         self.observable = observable
+        self.observingManager = observingManager
         self.hidden = hidden
 
         if parent:
@@ -115,9 +121,34 @@ class Resource:
     def changed(self):
         """
         Send a notification to all the subscribed resource.
+        The cached response template, if any, is invalidated first.
         :return:
         """
-        notifyObservers(self)
+        self.template = None
+        if self.observingManager is None:
+            observe.notifyObservers(self)
+        else:
+            self.observingManager.notifyObservers(self)
+
+    def getTemplate(self):
+        """
+        Returns the MessageTemplate of the current representation, with an
+        Observe option for notifications. It is built once and reused until
+        the resource changed.
+        :return: a MessageTemplate
+        """
+        if self.template is None:
+            self.template = self.getRepresentation().template(observe=True)
+        return self.template
+
+    def getRepresentation(self):
+        """
+        Returns the current representation of the resource, sent to its
+        observers when it changed: a Message whose status code, options
+        and payload are copied into each notification.
+        :raise:
+        """
+        raise NotImplementedError
 
     def toLink(self):
         """
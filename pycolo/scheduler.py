@@ -0,0 +1,375 @@
+# coding=utf-8
+
+"""
+pycolo.scheduler
+~~~~~~~~~~~~~~~~
+
+Client-side request scheduling. Requests are queued per destination
+endpoint so that no more than NSTART confirmable requests are outstanding
+to any of them, while non-confirmable requests are pipelined. Responses
+are dispatched to the callers as they arrive, through futures. Block2
+representations can be downloaded with several blocks in flight.
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from pycolo import MAX_RETRANSMIT, NSTART
+from pycolo.blockwise import BlockOption
+from pycolo.codes import codes, isResponse, msgType, options, responseClass
+from pycolo.exceptions import COAPError, Timeout
+from pycolo.message import Message
+
+
+class RequestScheduler:
+    """
+    Sends the requests of a Communicator, limiting the confirmable requests
+    outstanding to each destination.
+
+    :param communicator: the Communicator sending the requests, the
+        scheduler registers as one of its receivers
+    :param nstart: maximum number of outstanding confirmable requests per
+        destination
+    """
+
+    class Destination:
+        """
+        Entity class to keep the state of a destination endpoint
+        """
+        __slots__ = ("queue", "outstanding")
+
+        def __init__(self):
+            self.queue = deque()
+            self.outstanding = 0
+
+    def __init__(self, communicator, nstart=NSTART):
+        self.communicator = communicator
+        self.nstart = nstart
+        # destinations with outstanding confirmable requests, by address
+        self.destinations = dict()
+        # requests waiting for their response, by sequence key
+        self.pending = dict()
+        self.lock = threading.Lock()
+        communicator.registerReceiver(self)
+
+    def submit(self, request):
+        """
+        Sends a request now, or once a confirmable request to the same
+        destination completes if NSTART of them are outstanding.
+
+        :param request: the request, with its peer address
+        :return: a Future resolved with the response, or failing with
+            pycolo.exceptions.Timeout
+        """
+        future = Future()
+        if request.msg_type == msgType.con:
+            with self.lock:
+                destination = self.destinations.get(request.peerAddress)
+                if destination is None:
+                    destination = self.destinations[request.peerAddress] = self.Destination()
+                if destination.outstanding >= self.nstart:
+                    destination.queue.append((request, future))
+                    return future
+                destination.outstanding += 1
+        self.send(request, future)
+        return future
+
+    def download(self, request, window=4, retries=MAX_RETRANSMIT, szx=None):
+        """
+        Retrieves a representation, requesting up to window of its blocks at
+        once when it is transferred blockwise. Confirmable block requests
+        are still limited to NSTART per destination, non-confirmable ones
+        fill the whole window.
+
+        :param request: the request, with its peer address
+        :param window: maximum number of block requests outstanding
+        :param retries: number of times a failed block is requested again
+        :param szx: the block size exponent to ask for, the server's if None
+        :return: a Future resolved with a single response holding the
+            whole representation
+        """
+        return WindowedDownload(self, request, window, retries).start(szx)
+
+    def send(self, request, future):
+        if not request.token:
+            # a token of its own, to match the response to this request
+            request.token = self.communicator.tokenManager.acquireToken()
+        request.timeoutHandler = self.handleTimeout
+        with self.lock:
+            self.pending[request.sequenceKey()] = (request, future)
+        try:
+            self.communicator.sendMessage(request)
+        except OSError as e:
+            self.complete(request.sequenceKey(), exception=e)
+
+    def receiveMessage(self, msg):
+        if isResponse(msg.status_code):
+            self.complete(msg.sequenceKey(), response=msg)
+
+    def handleTimeout(self, request):
+        logging.warning("Request timed out: %s", request.sequenceKey())
+        self.complete(request.sequenceKey(), exception=Timeout(request.sequenceKey()))
+
+    def complete(self, key, response=None, exception=None):
+        """
+        Resolves the future of a request and sends the next request queued
+        for its destination.
+
+        :param key: the sequence key of the request
+        :param response: the response
+        :param exception: the error, if the request failed
+        :return: True if a pending request matched the key
+        """
+        following = None
+        with self.lock:
+            entry = self.pending.pop(key, None)
+            if entry is None:
+                return False
+            request, future = entry
+            if request.msg_type == msgType.con:
+                destination = self.destinations[request.peerAddress]
+                if destination.queue:
+                    # the slot goes to the next request
+                    following = destination.queue.popleft()
+                else:
+                    destination.outstanding -= 1
+                    if not destination.outstanding:
+                        del self.destinations[request.peerAddress]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+        if following is not None:
+            self.send(*following)
+        return True
+
+    def getStats(self):
+        stats = dict()
+        with self.lock:
+            stats["Destinations"] = len(self.destinations)
+            stats["Outstanding requests"] = len(self.pending)
+            stats["Queued requests"] = sum(len(destination.queue) for destination in self.destinations.values())
+        return stats
+
+
+class WindowedDownload:
+    """
+    Block2 download with several blocks in flight. The first response
+    reveals the block size and, through Size2, the length of the
+    representation: the remaining blocks are then requested window at a
+    time, each with a token of its own, and copied at their offset into a
+    buffer allocated once. Only the blocks whose request failed are
+    requested again. A slot is complete once its whole byte range arrived:
+    if the server shrinks the block size, the rest of the slot is requested
+    again in blocks of the new size. Without Size2, the blocks are requested
+    one after the other.
+
+    :param scheduler: the RequestScheduler sending the block requests
+    :param request: the request of the representation
+    :param window: maximum number of block requests outstanding
+    :param retries: number of times a failed block is requested again
+    """
+
+    def __init__(self, scheduler, request, window, retries):
+        self.scheduler = scheduler
+        self.request = request
+        self.window = max(window, 1)
+        self.retries = retries
+        self.future = Future()
+        self.lock = threading.Lock()
+        # first response, completed with the whole representation
+        self.first = None
+        self.szx = None
+        self.etag = None
+        self.buffer = None
+        self.sequential = False
+        # (start, end) byte ranges still to request, oldest failures first
+        self.missing = deque()
+        self.failures = dict()
+        self.outstanding = 0
+        # bytes of the representation not received yet
+        self.remaining = 0
+        self.done = False
+
+    def start(self, szx=None):
+        """
+        Sends the request of the first block.
+
+        :param szx: the block size exponent to ask for, the server's if None
+        :return: the Future of the download
+        """
+        request = self.request
+        if options.size2 not in request.options:
+            # asks the server for the length of the representation
+            request.options[options.size2] = 0
+        if szx is not None:
+            request.options[options.block2] = BlockOption(0, False, szx).value
+        self.scheduler.submit(request).add_done_callback(self.firstReceived)
+        return self.future
+
+    def firstReceived(self, future):
+        try:
+            response = future.result()
+        except Exception as e:
+            self.complete(exception=e)
+            return
+        if options.block2 not in response.options or responseClass(response.status_code) != codes.CLASS_SUCCESS:
+            self.complete(response)
+            return
+        block = BlockOption.fromValue(response.options[options.block2])
+        if not block.m:
+            self.complete(response)
+            return
+        payload = response.payload if response.payload is not None else b""
+        self.first = response
+        self.szx = block.szx
+        self.etag = response.options.get(options.etag)
+        length = response.options.get(options.size2)
+        with self.lock:
+            if length:
+                self.buffer = bytearray(length)
+                received = min(len(payload), length)
+                self.buffer[:received] = payload[:received]
+                self.missing.extend(self.slots(received, length))
+                self.remaining = length - received
+            else:
+                logging.info("No Size2 for %s, downloading blocks in turn", response.sequenceKey())
+                self.sequential = True
+                self.buffer = bytearray(payload)
+                self.missing.append((len(payload), None))
+                self.remaining = 1
+        if self.remaining:
+            self.fill()
+        else:
+            self.finish()
+
+    def slots(self, start, end):
+        """
+        Splits a byte range into slots of the current block size.
+
+        :return: list of (start, end) byte ranges
+        """
+        size = 1 << (self.szx + 4)
+        return [(offset, min(offset + size, end)) for offset in range(start, end, size)]
+
+    def fill(self):
+        """
+        Requests missing blocks until window of them are outstanding.
+        """
+        with self.lock:
+            window = 1 if self.sequential else self.window
+            slots = []
+            while self.missing and self.outstanding < window:
+                slots.append(self.missing.popleft())
+                self.outstanding += 1
+        for slot in slots:
+            self.fetch(slot)
+
+    def fetch(self, slot):
+        # slots start on a multiple of every smaller block size as well
+        num = slot[0] >> (self.szx + 4)
+        original = self.request
+        request = Message(msg_type=original.msg_type, status_code=original.status_code,
+                          options=dict(original.options), peerAddress=original.peerAddress)
+        del request.options[options.size2]
+        request.options[options.block2] = BlockOption(num, False, self.szx).value
+        self.scheduler.submit(request).add_done_callback(
+            lambda future: self.blockReceived(slot, future))
+
+    def blockReceived(self, slot, future):
+        if self.done:
+            return
+        try:
+            response = future.result()
+        except Exception as e:
+            self.retry(slot, e)
+            return
+        if options.block2 not in response.options or responseClass(response.status_code) != codes.CLASS_SUCCESS:
+            self.complete(response)
+            return
+        if response.options.get(options.etag) != self.etag:
+            error = COAPError("Representation changed during the download: %s" % (self.first.sequenceKey(),))
+            error.response = response
+            self.complete(exception=error)
+            return
+        block = BlockOption.fromValue(response.options[options.block2])
+        payload = response.payload if response.payload is not None else b""
+        start, end = slot
+        with self.lock:
+            if self.sequential:
+                valid = block.offset == start == len(self.buffer)
+            else:
+                # a block is full sized, or the last one of the representation
+                stop = block.offset + len(payload)
+                valid = block.offset == start and bool(payload) and \
+                    (len(payload) == block.size or stop == len(self.buffer)) and stop <= len(self.buffer)
+        if not valid:
+            self.retry(slot, COAPError("Unexpected block %s" % (block,)))
+            return
+        with self.lock:
+            if self.sequential:
+                self.buffer += payload
+                self.szx = min(self.szx, block.szx)
+                if block.m:
+                    self.missing.append((len(self.buffer), None))
+                else:
+                    self.remaining = 0
+            else:
+                received = min(len(payload), end - start)
+                self.buffer[start:start + received] = payload[:received]
+                self.remaining -= received
+                if start + received < end:
+                    # the server shrank the block size, request the rest of the slot
+                    logging.info("Block size reduced to %d bytes by the server", block.size)
+                    self.szx = block.szx
+                    self.missing.extendleft(reversed(self.slots(start + received, end)))
+            self.outstanding -= 1
+            complete = not self.remaining
+        if complete:
+            self.finish()
+        else:
+            self.fill()
+
+    def retry(self, slot, exception):
+        """
+        Requests a failed block again, or fails the download once the block
+        failed more than retries times.
+        """
+        with self.lock:
+            self.outstanding -= 1
+            failures = self.failures[slot[0]] = self.failures.get(slot[0], 0) + 1
+            if failures <= self.retries:
+                self.missing.appendleft(slot)
+        if failures > self.retries:
+            self.complete(exception=exception)
+            return
+        logging.info("Requesting block at %d again: %s", slot[0], exception)
+        self.fill()
+
+    def finish(self):
+        response = self.first
+        del response.options[options.block2]
+        response.payload = self.buffer
+        self.complete(response)
+
+    def complete(self, response=None, exception=None):
+        """
+        Resolves the download once, later block responses are ignored.
+        """
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+        if exception is not None:
+            self.future.set_exception(exception)
+        else:
+            self.future.set_result(response)
+
+    def getStats(self):
+        stats = dict()
+        with self.lock:
+            stats["Outstanding blocks"] = self.outstanding
+            stats["Remaining bytes"] = self.remaining
+            stats["Retried blocks"] = sum(self.failures.values())
+        return stats
@@ -0,0 +1,195 @@
+# coding=utf-8
+
+"""
+pycolo.timing
+~~~~~~~~~~~~~
+
+Hashed timing wheel driving the retransmissions and the exchange timeouts
+of the stack. A single wheel replaces one timer thread per confirmable
+message: scheduling and cancelling a timeout are O(1), and the wheel is
+advanced either by one dedicated thread or by an asyncio event loop.
+"""
+
+import asyncio
+import logging
+import math
+import threading
+import time
+
+
+class Timeout:
+    """
+    Handle of a scheduled callback, returned by TimingWheel.schedule.
+    """
+
+    __slots__ = ("wheel", "tick", "callback", "args", "cancelled")
+
+    def __init__(self, wheel, tick, callback, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancels the callback, if it has not run yet.
+        """
+        self.wheel.cancel(self)
+
+
+class TimingWheel:
+    """
+    A hashed timing wheel: a ring of slots, each holding the timeouts that
+    expire on the ticks hashing to it. Timeouts further away than one turn
+    of the wheel stay in their slot until their tick comes.
+
+    :param tick: resolution of the wheel, in seconds
+    :param slots: number of slots of the ring
+    :param clock: monotonic clock, in seconds
+    """
+
+    def __init__(self, tick=0.01, slots=512, clock=time.monotonic):
+        self.tickLength = tick
+        self.clock = clock
+        self.slots = [dict() for _ in range(slots)]
+        self.origin = clock()
+        #  last tick whose timeouts have been fired
+        self.current = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.loop = None
+        self.handle = None
+        self.running = False
+
+    def schedule(self, delay, callback, *args):
+        """
+        Schedules a callback.
+
+        :param delay: time to wait, in seconds
+        :param callback: function called with args once the delay elapsed
+        :return: a Timeout handle to cancel the callback
+        """
+        tick = math.ceil((self.clock() - self.origin + delay) / self.tickLength)
+        with self.lock:
+            timeout = Timeout(self, max(tick, self.current + 1), callback, args)
+            self.slots[timeout.tick % len(self.slots)][timeout] = None
+            self.pending += 1
+        return timeout
+
+    def cancel(self, timeout):
+        """
+        Cancels a scheduled callback. Cancelling twice or after the callback
+        ran has no effect.
+
+        :param timeout: the Timeout handle
+        """
+        with self.lock:
+            if timeout.cancelled:
+                return
+            timeout.cancelled = True
+            slot = self.slots[timeout.tick % len(self.slots)]
+            if timeout in slot:
+                del slot[timeout]
+                self.pending -= 1
+
+    def advance(self, now=None):
+        """
+        Runs the callbacks whose delay elapsed.
+
+        :param now: the current time of the clock, read if None
+        :return: the number of callbacks run
+        """
+        if now is None:
+            now = self.clock()
+        target = int((now - self.origin) / self.tickLength)
+        due = []
+        with self.lock:
+            if target <= self.current:
+                return 0
+            count = len(self.slots)
+            #  beyond one turn every slot is visited once
+            for tick in range(self.current + 1, min(target, self.current + count) + 1):
+                slot = self.slots[tick % count]
+                expired = [timeout for timeout in slot if timeout.tick <= target]
+                for timeout in expired:
+                    del slot[timeout]
+                    timeout.cancelled = True
+                due.extend(expired)
+            self.current = target
+            self.pending -= len(due)
+        due.sort(key=lambda timeout: timeout.tick)
+        for timeout in due:
+            try:
+                timeout.callback(*timeout.args)
+            except Exception:
+                logging.exception("Timeout callback failed: %r", timeout.callback)
+        return len(due)
+
+    def __len__(self):
+        return self.pending
+
+    def start(self):
+        """
+        Advances the wheel from a dedicated daemon thread.
+
+        :return: the wheel itself
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="TimingWheel", daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while self.running:
+            time.sleep(self.tickLength)
+            self.advance()
+
+    def attach(self, loop=None):
+        """
+        Advances the wheel from an asyncio event loop. The callbacks then
+        run on the loop.
+
+        :param loop: the event loop, the running one if None
+        :return: the wheel itself
+        """
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.running = True
+        self.handle = self.loop.call_later(self.tickLength, self._tick)
+        return self
+
+    def _tick(self):
+        if self.running:
+            self.advance()
+            self.handle = self.loop.call_later(self.tickLength, self._tick)
+
+    def stop(self):
+        """
+        Stops advancing the wheel. Scheduled callbacks are kept.
+        """
+        self.running = False
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+
+_defaultWheel = None
+_defaultLock = threading.Lock()
+
+
+def getDefaultWheel():
+    """
+    Returns the wheel shared by the layers created without one, started
+    on its own thread on first use.
+
+    :return: a running TimingWheel
+    """
+    global _defaultWheel
+    with _defaultLock:
+        if _defaultWheel is None:
+            _defaultWheel = TimingWheel().start()
+        return _defaultWheel
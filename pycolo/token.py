@@ -2,70 +2,143 @@
 
 """
 The TokenManager stores all tokens currently used in transfers. New
-transfers can acquire unique tokens from the manager.
+transfers can acquire unique tokens from the manager. Each Communicator
+owns one; the module functions act on a default manager.
 """
 
 import logging
 import random
+import threading
+from collections import deque
 
-acquiredTokens = set()
-currentToken = random.randint(1, 2 ** 16)
-emptyToken = 0
+# Odd multipliers of the token scramble
+_MULTIPLIERS = (0x9E3779B97F4A7C15, 0xBF58476D1CE4E5B9)
 
 
-def nextToken():
+class TokenManager:
     """
-    Returns the next message ID to use out of the consecutive 16 - bit range.
+    Token space of an endpoint.
+
+    Fresh tokens are a counter passed through a keyed bijection of the
+    token space, so they never collide with each other and acquiring one
+    needs no scan of the acquired tokens. Released tokens go to a FIFO free
+    list and are reused, oldest first, once more than quarantine of them
+    are waiting or the space is exhausted. Acquiring and releasing are O(1)
+    and thread safe.
 
-    :return: the current message ID
+    :param length: length of the tokens, 1 to 8 bytes
+    :param quarantine: number of released tokens kept before reusing one
     """
-    global currentToken
-    currentToken = (currentToken + 1) % 16
-    logging.info("Token value: %d" % currentToken)
 
-    return currentToken
+    emptyToken = b""
+
+    def __init__(self, length=8, quarantine=1024):
+        if not 1 <= length <= 8:
+            raise ValueError("Token length must be between 1 and 8 bytes: %d" % length)
+        self.length = length
+        self.bits = 8 * length
+        self.quarantine = quarantine
+        self.key = random.SystemRandom().getrandbits(self.bits)
+        self.counter = 0
+        self.freeTokens = deque()
+        self.acquiredTokens = set()
+        self.lock = threading.Lock()
+
+    def scramble(self, value):
+        """
+        Maps a counter value to a token, bijectively over the token space.
+
+        :param value: the counter value
+        :return: the token as an integer
+        """
+        bits = self.bits
+        mask = (1 << bits) - 1
+        value ^= self.key
+        for multiplier in _MULTIPLIERS:
+            value = (value * multiplier) & mask
+            value ^= value >> (bits // 2)
+        return value
+
+    def nextToken(self):
+        """
+        Returns a token that has never been issued by this manager.
+
+        :return: the token, None if the token space is exhausted
+        """
+        if self.counter >> self.bits:
+            return None
+        token = self.scramble(self.counter).to_bytes(self.length, "big")
+        self.counter += 1
+        return token
+
+    def acquireToken(self, preferEmptyToken=False):
+        """
+        Returns an unique token.
+
+        :param preferEmptyToken: If set to true, the caller will receive the empty token if it is available.
+
+        This is useful for reducing
+        datagram sizes in transactions that are expected to complete
+        in short time. On the other hand, empty tokens are not preferred
+        in block - wise transfers, as the empty token is then not available
+        for concurrent transactions.
+
+        :raise RuntimeError: if every token is in use
+        """
+        with self.lock:
+            if preferEmptyToken and self.emptyToken not in self.acquiredTokens:
+                token = self.emptyToken
+            elif len(self.freeTokens) > self.quarantine:
+                token = self.freeTokens.popleft()
+            else:
+                token = self.nextToken()
+                if token is None:
+                    if not self.freeTokens:
+                        raise RuntimeError("All %d-byte tokens are in use" % self.length)
+                    token = self.freeTokens.popleft()
+            self.acquiredTokens.add(token)
+
+        return token
+
+    def releaseToken(self, token):
+        """
+        Releases an acquired token and makes it available for reuse.
+
+        :param token: The token to release
+        """
+        with self.lock:
+            if token in self.acquiredTokens:
+                self.acquiredTokens.remove(token)
+                if token != self.emptyToken:
+                    self.freeTokens.append(token)
+            else:
+                logging.warning("Token to release is not acquired: %s", token.hex())
+
+    def isAcquired(self, token):
+        """
+        Checks if a token is acquired by this manager.
+
+        :param token: The token to check
+        :return: True iff the token is currently in use
+        """
+        return token in self.acquiredTokens
+
+
+# Manager used by the module functions
+defaultManager = TokenManager()
 
 
-def acquireToken(preferEmptyToken=False):
-    """
-    Returns an unique token.
-
-    :param preferEmptyToken: If set to true, the caller will receive the empty token if it is available.
+def nextToken():
+    return defaultManager.nextToken()
 
-    This is useful for reducing
-    datagram sizes in transactions that are expected to complete
-    in short time. On the other hand, empty tokens are not preferred
-    in block - wise transfers, as the empty token is then not available
-    for concurrent transactions.
-    """
-    global token
-    if preferEmptyToken and emptyToken not in acquiredTokens:
-        token = emptyToken
-    else:
-        while token in acquiredTokens:
-            token = nextToken()
-        acquiredTokens.add(token)
 
-    return token
+def acquireToken(preferEmptyToken=False):
+    return defaultManager.acquireToken(preferEmptyToken)
 
 
 def releaseToken(token):
-    """
-    Releases an acquired token and makes it available for reuse.
-
-    :param token: The token to release
-    """
-    if token in acquiredTokens:
-        acquiredTokens.remove(token)
-    else:
-        logging.warning("Token to release is not acquired: %s", hex(token))
+    return defaultManager.releaseToken(token)
 
 
 def isAcquired(token):
-    """
-    Checks if a token is acquired by this manager.
-
-    :param token: The token to check
-    :return: True iff the token is currently in use
-    """
-    return token in acquiredTokens
+    return defaultManager.isAcquired(token)
@@ -0,0 +1,402 @@
+# coding=utf-8
+
+"""
+Testing suite for blockwise transfers.
+"""
+
+import io
+import os
+import tempfile
+import unittest
+
+from pycolo.blockwise import BlockOption, BlockwiseStore, FileSource, GeneratorSource, MmapSource, PeerStatistics
+from pycolo.blockwise import sourceFor
+from pycolo.codes import codes, options
+from pycolo.codes import msgType as refType
+from pycolo.layers import TransferLayer
+from pycolo.message import Message
+from tests.core.helpers import Clock, Recorder
+
+PEER = ("127.0.0.1", 5683)
+IMAGE = bytes(range(256)) * 10
+
+
+def demand(num, szx=2, message_id=10):
+    msg = Message(msg_type=refType.con, status_code=codes.get, message_id=message_id,
+                  token=b"t", peerAddress=PEER)
+    msg.options[options.block2] = BlockOption(num, False, szx).value
+    return msg
+
+
+def response(payload):
+    return Message(msg_type=refType.ack, status_code=codes.RESP_CONTENT, message_id=1,
+                   token=b"t", peerAddress=PEER, payload=payload)
+
+
+class BlockOptionTest(unittest.TestCase):
+
+    def testValue(self):
+        block = BlockOption(5, True, 2)
+        self.assertEqual(block.value, 5 << 4 | 0x8 | 2)
+        self.assertEqual(BlockOption.fromValue(block.value), block)
+        self.assertEqual(block.size, 64)
+        self.assertEqual(block.offset, 320)
+
+
+class SourceTest(unittest.TestCase):
+
+    def check(self, source):
+        blocks = []
+        offset = 0
+        while True:
+            block = source.read(offset, 1000)
+            blocks.append(bytes(block))
+            offset += len(block)
+            if not source.more(offset):
+                break
+        self.assertEqual(b"".join(blocks), IMAGE)
+        self.assertEqual(source.length, len(IMAGE))
+        self.assertIsNone(source.read(offset, 1000))
+        source.close()
+
+    def testBuffer(self):
+        source = sourceFor(IMAGE)
+        self.assertIsInstance(source.read(0, 16), memoryview)
+        self.check(source)
+
+    def testFile(self):
+        source = sourceFor(io.BytesIO(IMAGE))
+        self.assertIsInstance(source, FileSource)
+        self.check(source)
+
+    def testGenerator(self):
+        source = sourceFor(IMAGE[i:i + 300] for i in range(0, len(IMAGE), 300))
+        self.assertIsInstance(source, GeneratorSource)
+        self.assertIsNone(source.length)
+        self.check(source)
+
+    def testMmap(self):
+        with tempfile.NamedTemporaryFile(delete=False) as file:
+            file.write(IMAGE)
+        try:
+            self.check(MmapSource(file.name))
+        finally:
+            os.unlink(file.name)
+
+
+class TransferLayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.layer = TransferLayer(64)
+        self.lower = Recorder()
+        self.layer.setLowerLayer(self.lower)
+
+    def download(self, payload):
+        """
+        Sends a response through the layer, then demands its blocks in turn.
+        """
+        self.layer.sendMessage(response(payload))
+        received = [self.lower.sent[-1]]
+        while BlockOption.fromValue(received[-1].options[options.block2]).m:
+            num = BlockOption.fromValue(received[-1].options[options.block2]).num + 1
+            self.layer.receiveMessage(demand(num, message_id=10 + num))
+            received.append(self.lower.sent[-1])
+        return received
+
+    def testSmall(self):
+        msg = response(b"small")
+        self.layer.sendMessage(msg)
+        self.assertIs(self.lower.sent[0], msg)
+        self.assertNotIn(options.block2, msg.options)
+
+    def testStream(self):
+        """
+        A file is served block by block and freed once complete.
+        """
+        blocks = self.download(io.BytesIO(IMAGE))
+        self.assertEqual(len(blocks), len(IMAGE) // 64)
+        self.assertEqual(b"".join(bytes(block.payload) for block in blocks), IMAGE)
+        self.assertEqual(blocks[0].message_id, 1)
+        self.assertEqual(blocks[1].message_id, 11)
+        self.assertEqual(blocks[1].msg_type, refType.ack)
+        self.assertEqual(blocks[1].options[options.size2], len(IMAGE))
+        self.assertEqual(len(self.layer.transfers), 0)
+
+    def testGenerator(self):
+        chunks = (IMAGE[i:i + 100] for i in range(0, len(IMAGE), 100))
+        blocks = self.download(chunks)
+        self.assertEqual(b"".join(bytes(block.payload) for block in blocks), IMAGE)
+        self.assertNotIn(options.size2, blocks[0].options)
+        self.assertEqual(len(self.layer.transfers), 0)
+
+    def testSmallerSZX(self):
+        """
+        A demand with a smaller SZX is served from the same transfer.
+        """
+        self.layer.sendMessage(response(IMAGE))
+        self.layer.receiveMessage(demand(4, szx=1))
+        block = self.lower.sent[-1]
+        self.assertEqual(BlockOption.fromValue(block.options[options.block2]), BlockOption(4, True, 1))
+        self.assertEqual(bytes(block.payload), IMAGE[128:160])
+
+    def testDemandWithoutTransfer(self):
+        """
+        The resource response to a demand without transfer is cut at the
+        demanded block.
+        """
+        self.layer.receiveMessage(demand(3))
+        self.layer.sendMessage(response(IMAGE))
+        block = self.lower.sent[-1]
+        self.assertEqual(BlockOption.fromValue(block.options[options.block2]).num, 3)
+        self.assertEqual(bytes(block.payload), IMAGE[192:256])
+
+    def testOutOfScope(self):
+        self.layer.sendMessage(response(IMAGE))
+        self.layer.receiveMessage(demand(1000))
+        self.assertEqual(self.lower.sent[-1].status_code, codes.RESP_BAD_REQUEST)
+        self.assertEqual(len(self.layer.transfers), 0)
+
+
+class Sink:
+    """
+    Upload sink keeping the blocks written to it.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.closed = False
+        self.aborted = False
+
+    def write(self, data):
+        self.blocks.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+def block(num, m, payload, szx=2, size1=None):
+    msg = Message(msg_type=refType.con, status_code=codes.put, message_id=20 + num,
+                  token=b"u", peerAddress=PEER, payload=payload)
+    msg.options[options.block1] = BlockOption(num, m, szx).value
+    if size1 is not None:
+        msg.options[options.size1] = size1
+    return msg
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sinks = []
+        self.layer = TransferLayer(64, sinkProvider=self.openSink, maxBodySize=1000)
+        self.lower = Recorder()
+        self.layer.setLowerLayer(self.lower)
+        self.delivered = []
+        self.layer.registerReceiver(self)
+
+    def openSink(self, request):
+        self.sinks.append(Sink())
+        return self.sinks[-1]
+
+    def receiveMessage(self, msg):
+        self.delivered.append(msg)
+
+    def upload(self, body, size1=None):
+        count = (len(body) + 63) // 64
+        for num in range(count):
+            self.layer.receiveMessage(block(num, num < count - 1, body[num * 64:num * 64 + 64],
+                                            size1=size1 if num == 0 else None))
+
+    def testSink(self):
+        """
+        Each block goes to the sink as it arrives, the last request is
+        delivered with the sink.
+        """
+        self.upload(IMAGE[:300])
+        sink = self.sinks[0]
+        self.assertEqual(b"".join(sink.blocks), IMAGE[:300])
+        self.assertTrue(sink.closed)
+        self.assertEqual(len(self.lower.sent), 4)
+        reply = self.lower.sent[1]
+        self.assertEqual(reply.status_code, codes.RESP_CONTINUE)
+        self.assertEqual(reply.msg_type, refType.ack)
+        self.assertEqual(reply.message_id, 21)
+        self.assertEqual(BlockOption.fromValue(reply.options[options.block1]), BlockOption(1, True, 2))
+        self.assertEqual(len(self.delivered), 1)
+        self.assertIs(self.delivered[0].payload, sink)
+        self.assertEqual(len(self.layer.transfers), 0)
+
+        response = Message(msg_type=refType.ack, status_code=codes.RESP_CHANGED, message_id=24,
+                           token=b"u", peerAddress=PEER)
+        self.layer.sendMessage(response)
+        self.assertEqual(BlockOption.fromValue(response.options[options.block1]), BlockOption(4, False, 2))
+
+    def testMemory(self):
+        self.layer.sinkProvider = None
+        self.upload(IMAGE[:200])
+        self.assertEqual(self.delivered[0].payload, IMAGE[:200])
+
+    def testSize1(self):
+        """
+        An upload announcing a body too large is rejected before any block is
+        written.
+        """
+        self.upload(IMAGE[:300], size1=2000)
+        reply = self.lower.sent[0]
+        self.assertEqual(reply.status_code, codes.RESP_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(reply.options[options.size1], 1000)
+        self.assertEqual(self.sinks, [])
+        self.assertEqual(self.delivered, [])
+
+    def testTooLarge(self):
+        self.upload(IMAGE[:1100])
+        self.assertTrue(self.sinks[0].aborted)
+        self.assertIn(codes.RESP_REQUEST_ENTITY_TOO_LARGE, [msg.status_code for msg in self.lower.sent])
+        self.assertEqual(self.delivered, [])
+
+    def testStoreBudget(self):
+        """
+        An in-memory upload over the store budget is rejected with the budget
+        as Size1, even without a maximum body size.
+        """
+        self.layer = TransferLayer(64, storeBudget=100)
+        self.layer.setLowerLayer(self.lower)
+        self.layer.registerReceiver(self)
+        self.upload(IMAGE[:300])
+        replies = [msg for msg in self.lower.sent if msg.status_code == codes.RESP_REQUEST_ENTITY_TOO_LARGE]
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(Message().from_raw(replies[0].to_raw()).options[options.size1], 100)
+        self.assertEqual(self.delivered, [])
+
+    def testOutOfOrder(self):
+        self.layer.receiveMessage(block(0, True, IMAGE[:64]))
+        self.layer.receiveMessage(block(2, True, IMAGE[128:192]))
+        self.assertEqual(self.lower.sent[-1].status_code, codes.RESP_REQUEST_ENTITY_INCOMPLETE)
+        self.assertTrue(self.sinks[0].aborted)
+        self.assertEqual(len(self.layer.transfers), 0)
+
+
+class PeerStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = PeerStatistics(defaultSZX=5, growAfter=4)
+
+    def testGrow(self):
+        """
+        Blocks grow up to 1024 bytes on a clean link.
+        """
+        for _ in range(4):
+            self.stats.recordExchange(PEER, 0.1)
+        self.assertEqual(self.stats.getSZX(PEER), 6)
+        for _ in range(8):
+            self.stats.recordExchange(PEER, 0.1)
+        self.assertEqual(self.stats.getSZX(PEER), 6)
+        self.assertEqual(self.stats.getSZX(("127.0.0.2", 5683)), 5)
+
+    def testShrink(self):
+        """
+        Blocks shrink on a lossy link, down to the smallest size.
+        """
+        for _ in range(40):
+            self.stats.recordExchange(PEER, None, 2)
+        self.assertEqual(self.stats.getSZX(PEER), 0)
+        stats = self.stats.getStats()[PEER]
+        self.assertEqual(stats["Block size"], 16)
+        self.assertEqual(stats["Retransmissions"], 80)
+        self.assertIsNone(stats["SRTT (ms)"])
+
+    def testSpike(self):
+        """
+        Round-trip time spikes hold the block size.
+        """
+        for rtt in (0.1, 0.1, 0.1, 2.0, 0.1, 0.1, 0.1):
+            self.stats.recordExchange(PEER, rtt)
+        self.assertEqual(self.stats.getSZX(PEER), 5)
+
+    def testCapacity(self):
+        stats = PeerStatistics(defaultSZX=5, capacity=2)
+        for port in range(3):
+            stats.recordLoss(("127.0.0.1", port))
+        self.assertEqual(list(stats.getStats()), [("127.0.0.1", 1), ("127.0.0.1", 2)])
+
+    def testTransferLayer(self):
+        """
+        The transfer layer cuts blocks of the size chosen for the peer.
+        """
+        for _ in range(4):
+            self.stats.recordExchange(PEER, 0.1)
+        layer = TransferLayer(64, peerStatistics=self.stats)
+        lower = Recorder()
+        layer.setLowerLayer(lower)
+        layer.sendMessage(response(IMAGE))
+        self.assertEqual(len(lower.sent[-1].payload), 1024)
+        self.assertIn(PEER, layer.getStats()["Peers"])
+
+
+class BlockwiseStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.dropped = []
+        self.store = BlockwiseStore(budget=100, idleTimeout=10, capacity=3,
+                                    onDrop=lambda key, value: self.dropped.append(key), clock=self.clock)
+
+    def testIdle(self):
+        """
+        Entries not accessed for idleTimeout are abandoned.
+        """
+        self.store.put("a", 1)
+        self.store.put("b", 2)
+        self.clock.now = 6
+        self.assertEqual(self.store.get("a"), 1)
+        self.clock.now = 12
+        self.assertIsNone(self.store.get("b"))
+        self.assertEqual(self.store.get("a"), 1)
+        self.assertEqual(self.dropped, ["b"])
+        self.assertEqual(self.store.getStats()["Abandoned"], 1)
+
+    def testLRU(self):
+        for key in "abc":
+            self.store.put(key, key)
+        self.store.get("a")
+        self.store.put("d", "d")
+        self.assertEqual(self.dropped, ["b"])
+        self.assertEqual(self.store.getStats()["Evictions"], 1)
+
+    def testBudget(self):
+        self.store.put("a", "a", 60)
+        self.store.put("b", "b", 30)
+        self.assertTrue(self.store.resize("b", 50))
+        self.assertEqual(self.dropped, ["a"])
+        self.assertEqual(self.store.getStats()["Bytes"], 50)
+        self.assertFalse(self.store.resize("b", 150))
+        self.assertFalse(self.store.put("c", "c", 150))
+        self.assertEqual(len(self.store), 0)
+
+    def testPop(self):
+        self.store.put("a", "a", 60)
+        self.assertEqual(self.store.pop("a"), "a")
+        self.assertEqual(self.dropped, [])
+        self.assertEqual(self.store.getStats()["Bytes"], 0)
+
+    def testAbandonedTransfer(self):
+        """
+        An abandoned download is freed and its source closed.
+        """
+        layer = TransferLayer(64, transferTimeout=10000)
+        layer.transfers.clock = self.clock
+        layer.setLowerLayer(Recorder())
+        file = io.BytesIO(IMAGE)
+        layer.sendMessage(response(file))
+        self.assertEqual(len(layer.transfers), 1)
+        self.clock.now = 11
+        layer.transfers.expire()
+        self.assertEqual(len(layer.transfers), 0)
+        self.assertTrue(file.closed)
+        self.assertEqual(layer.getStats()["Transfer store abandoned"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+# coding=utf-8
+
+"""
+Testing suite for the Communicator layer stack.
+"""
+
+import asyncio
+import threading
+import unittest
+
+from pycolo import MAX_RETRANSMIT
+from pycolo.codes import codes, options
+from pycolo.codes import msgType as refType
+from pycolo.layers import AsyncUDPLayer, Communicator
+from pycolo.message import Message
+from pycolo.resource import Resource
+from pycolo.timing import TimingWheel
+from tests.core.helpers import Clock, Collector, Echo
+
+
+class Lossy(AsyncUDPLayer):
+    """
+    Asyncio UDP layer losing the first datagram it receives.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lost = 0
+
+    def datagramReceived(self, data, address):
+        if not self.lost:
+            self.lost += 1
+            return
+        super().datagramReceived(data, address)
+
+
+class Counter(Resource):
+    """
+    Observable resource whose representation is its value.
+    """
+
+    value = 1
+    representations = 0
+
+    def getRepresentation(self):
+        self.representations += 1
+        return Message(status_code=codes.content, payload=b"%d" % self.value)
+
+
+class Registrar:
+    """
+    Registers the clients observing a resource through the manager of a
+    Communicator, and answers them with the resource representation.
+    """
+
+    def __init__(self, communicator, resource):
+        self.communicator = communicator
+        self.resource = resource
+
+    def receiveMessage(self, msg):
+        response = msg.new_accept()
+        response.status_code = codes.content
+        response.token = msg.token
+        response.payload = self.resource.getRepresentation().payload
+        if options.observe in msg.options:
+            self.communicator.observingManager.addObserver(msg, self.resource)
+            response.options[options.observe] = 1
+        self.communicator.sendMessage(response)
+
+
+class CommunicatorTest(unittest.TestCase):
+
+    def exchange(self, fused, requestOptions=None):
+        server = Communicator(port=0, address="127.0.0.1", fused=fused)
+        client = Communicator(port=0, address="127.0.0.1", fused=fused)
+        server.registerReceiver(Echo(server))
+        collector = Collector()
+        client.registerReceiver(collector)
+        try:
+            client.sendMessage(Message(
+                msg_type=refType.con,
+                status_code=codes.get,
+                options=requestOptions,
+                peerAddress=("127.0.0.1", server.getPort())))
+            collector.waitFor(1)
+        finally:
+            client.close()
+            server.close()
+        self.assertEqual(len(collector.messages), 1)
+        self.assertEqual(bytes(collector.messages[0].payload), b"pong")
+        return client
+
+    def testFused(self):
+        client = self.exchange(True)
+        stats = client.getStats()
+        self.assertEqual(stats["Fast path messages sent"], 1)
+        self.assertEqual(stats["Fast path messages received"], 1)
+        self.assertEqual(client.tokenLayer.numMessagesSent, 0)
+        self.assertEqual(client.tokenLayer.getStats()["Request-Response exchanges"], 0)
+
+    def testFullStack(self):
+        client = self.exchange(False)
+        self.assertEqual(client.getStats()["Fast path messages sent"], 0)
+        self.assertEqual(client.tokenLayer.numMessagesReceived, 1)
+
+    def testObserveUsesFullStack(self):
+        """
+        In fused mode, messages with an Observe option still go through
+        every layer.
+        """
+        client = self.exchange(True, {options.observe: 0})
+        self.assertEqual(client.getStats()["Fast path messages sent"], 0)
+        self.assertEqual(client.tokenLayer.numMessagesSent, 1)
+        self.assertEqual(client.tokenLayer.numMessagesReceived, 1)
+
+    def checkBodyTooLarge(self, fused):
+        """
+        A request announcing a body larger than maxBodySize with Size1 is
+        rejected with 4.13 and not delivered.
+        """
+        server = Communicator(port=0, address="127.0.0.1", fused=fused, maxBodySize=100)
+        client = Communicator(port=0, address="127.0.0.1", fused=fused)
+        delivered = Collector()
+        server.registerReceiver(delivered)
+        collector = Collector()
+        client.registerReceiver(collector)
+        try:
+            request = Message(msg_type=refType.con, status_code=codes.put, payload=b"first bytes",
+                              peerAddress=("127.0.0.1", server.getPort()))
+            request.options[options.size1] = 1000
+            client.sendMessage(request)
+            collector.waitFor(1)
+        finally:
+            client.close()
+            server.close()
+        self.assertEqual(delivered.messages, [])
+        self.assertEqual([msg.status_code for msg in collector.messages], [codes.RESP_REQUEST_ENTITY_TOO_LARGE])
+        self.assertEqual(collector.messages[0].options[options.size1], 100)
+
+    def testBodyTooLargeFused(self):
+        self.checkBodyTooLarge(True)
+
+    def testBodyTooLargeFullStack(self):
+        self.checkBodyTooLarge(False)
+
+    def testAdaptiveBlockSize(self):
+        """
+        In fused mode, a response larger than the block size of its peer
+        goes through the transfer layer, even below the default size.
+        """
+        communicator = Communicator(port=0, address="127.0.0.1")
+        try:
+            peer = ("127.0.0.1", 5683)
+            for _ in range(2):
+                communicator.peerStatistics.recordLoss(peer)
+            self.assertEqual(communicator.transferLayer.getSZX(peer), 4)
+            response = Message(msg_type=refType.ack, status_code=codes.content, message_id=1,
+                               payload=bytes(400), peerAddress=peer)
+            self.assertTrue(communicator.requiresFullStack(response))
+            response.peerAddress = ("127.0.0.2", 5683)
+            self.assertFalse(communicator.requiresFullStack(response))
+        finally:
+            communicator.close()
+
+    def checkDeadPeer(self, fused):
+        """
+        Requests to a peer that never answers leave no open request, token
+        or exchange behind.
+        """
+        clock = Clock()
+        communicator = Communicator(port=0, address="127.0.0.1", fused=fused,
+                                    timer=TimingWheel(tick=0.01, clock=clock))
+        try:
+            for msg_type in (refType.con, refType.con, refType.non):
+                communicator.sendMessage(Message(msg_type=msg_type, status_code=codes.get,
+                                                 peerAddress=("127.0.0.1", 9)))
+            self.assertEqual(len(communicator.matchingLayer.pairs), 3)
+            for _ in range(MAX_RETRANSMIT + 1):
+                clock.now += 100
+                communicator.timer.advance()
+        finally:
+            communicator.close()
+        self.assertEqual(communicator.matchingLayer.pairs, {})
+        self.assertEqual(communicator.tokenLayer.exchanges, {})
+        self.assertEqual(communicator.transactionLayer.transactionTable, {})
+
+    def testDeadPeerFused(self):
+        self.checkDeadPeer(True)
+
+    def testDeadPeerFullStack(self):
+        self.checkDeadPeer(False)
+
+    def testAsync(self):
+        """
+        On asyncio, a confirmable request is retransmitted from the event
+        loop until it is answered.
+        """
+        async def exchange():
+            server = await Lossy(port=0, address="127.0.0.1").open()
+            server.registerReceiver(Echo(server))
+            client = await Communicator.openAsync(port=0, address="127.0.0.1")
+            client.transactionLayer.initialTimeout = lambda: 50
+            threads = []
+            send = client.udpLayer.doSendMessage
+            client.udpLayer.doSendMessage = lambda msg: (threads.append(threading.current_thread()), send(msg))
+            collector = Collector()
+            client.registerReceiver(collector)
+            try:
+                client.sendMessage(Message(
+                    msg_type=refType.con,
+                    status_code=codes.get,
+                    peerAddress=("127.0.0.1", server.getPort())))
+                for _ in range(200):
+                    if collector.messages:
+                        break
+                    await asyncio.sleep(0.01)
+                return collector.messages, threads, client
+            finally:
+                client.close()
+                server.close()
+
+        messages, threads, client = asyncio.run(exchange())
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(bytes(messages[0].payload), b"pong")
+        self.assertEqual(threads, [threading.main_thread()] * 2)
+        self.assertFalse(client.timer.running)
+
+    def testIndependentInstances(self):
+        """
+        Each Communicator has its own token space, observing relationships
+        and timer.
+        """
+        first = Communicator(port=0, address="127.0.0.1")
+        second = Communicator(port=0, address="127.0.0.1")
+        try:
+            self.assertIsNot(first.tokenManager, second.tokenManager)
+            self.assertIsNot(first.observingManager, second.observingManager)
+            self.assertIsNot(first.timer, second.timer)
+            self.assertIs(first.tokenLayer.tokenManager, first.tokenManager)
+            self.assertEqual(first.tokenManager.acquireToken(True), b"")
+            self.assertEqual(second.tokenManager.acquireToken(True), b"")
+        finally:
+            first.close()
+            second.close()
+        self.assertFalse(first.timer.running)
+
+    def observe(self, server, client, resource):
+        """
+        Registers client as observer of the resource served by server.
+
+        :return: the Collector of the messages the client receives
+        """
+        server.registerReceiver(Registrar(server, resource))
+        collector = Collector()
+        client.registerReceiver(collector)
+        client.sendMessage(Message(
+            msg_type=refType.con,
+            status_code=codes.get,
+            options={options.observe: 0},
+            peerAddress=("127.0.0.1", server.getPort())))
+        collector.waitFor(1)
+        return collector
+
+    def testObserversPerInstance(self):
+        """
+        A changed resource notifies the observers registered on the
+        Communicator serving it, and not through another one.
+        """
+        first = Communicator(port=0, address="127.0.0.1")
+        second = Communicator(port=0, address="127.0.0.1")
+        client = Communicator(port=0, address="127.0.0.1")
+        resource = Counter("counter", observable=True, observingManager=first.observingManager)
+        try:
+            collector = self.observe(first, client, resource)
+            self.assertTrue(first.observingManager.isObserved(resource))
+            self.assertFalse(second.observingManager.isObserved(resource))
+            self.assertEqual(second.observingManager.notifyObservers(resource), 0)
+            resource.value = 2
+            resource.changed()
+            collector.waitFor(2)
+        finally:
+            client.close()
+            second.close()
+            first.close()
+        self.assertEqual([bytes(msg.payload) for msg in collector.messages], [b"1", b"2"])
+        self.assertEqual(collector.messages[1].options[options.observe], 2)
+        self.assertEqual(second.udpLayer.getStats()["Messages sent"], 0)
+
+    def testNotificationTemplate(self):
+        """
+        Notifications are rendered from a template of the resource, which is
+        built again once the resource changed.
+        """
+        server = Communicator(port=0, address="127.0.0.1")
+        client = Communicator(port=0, address="127.0.0.1")
+        resource = Counter("counter", observable=True, observingManager=server.observingManager)
+        try:
+            collector = self.observe(server, client, resource)
+            resource.changed()
+            template = resource.template
+            server.observingManager.notifyObservers(resource)
+            self.assertIs(resource.template, template)
+            resource.value = 2
+            resource.changed()
+            self.assertIsNot(resource.template, template)
+            collector.waitFor(4)
+        finally:
+            client.close()
+            server.close()
+        self.assertEqual([bytes(msg.payload) for msg in collector.messages], [b"1", b"1", b"1", b"2"])
+        self.assertEqual([msg.options[options.observe] for msg in collector.messages[1:]], [2, 3, 4])
+        self.assertEqual({msg.msg_type for msg in collector.messages[1:]}, {refType.non})
+        # one for the registration, one per template
+        self.assertEqual(resource.representations, 3)
+        self.assertEqual(server.getStats()["Fast path messages sent"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,7 @@ import unittest
 import logging
 from pycolo.codes import codes, options
 from pycolo.codes import msgType as refType
-from pycolo.message import Message
+from pycolo.message import Message, decode_batch
 
 
 class MessageTest(unittest.TestCase):
@@ -34,7 +34,7 @@ class MessageTest(unittest.TestCase):
         self.assertEquals(original.status_code, new_message.status_code)
         self.assertEquals(original.msg_type, new_message.msg_type)
         self.assertEquals(original.message_id, new_message.message_id)
-        self.assertEquals(original.payload, new_message.payload)
+        self.assertEquals(original.payload, new_message.payload_text())
 
     def test_OptionMessage(self):
         """
@@ -53,7 +53,7 @@ class MessageTest(unittest.TestCase):
         self.assertEquals(msg.status_code, newMsg.status_code)
         self.assertEquals(msg.msg_type, newMsg.msg_type)
         self.assertEquals(msg.message_id, newMsg.message_id)
-        self.assertEquals(msg.payload, newMsg.payload)
+        self.assertEquals(msg.payload, newMsg.payload_text())
 
 
     def test_ExtendedOptionMessage(self):
@@ -73,6 +73,219 @@ class MessageTest(unittest.TestCase):
         self.assertEquals(msg.msg_type, newMsg.msg_type)
         self.assertEquals(msg.message_id, newMsg.message_id)
 
+    def test_Slots(self):
+        """
+        Messages carry no per-instance dictionary.
+        """
+        msg = Message(peerAddress=("localhost", 5683))
+        self.assertFalse(hasattr(msg, "__dict__"))
+        self.assertEqual(msg.peerAddress, ("localhost", 5683))
+        self.assertTrue(msg.requiresToken)
+        self.assertFalse(msg.requiresBlockwise)
+        self.assertRaises(AttributeError, setattr, msg, "unknown", 1)
+
+    def test_DecodeOptions(self):
+        """
+        Decoding of token, repeated options and extended option lengths.
+        """
+        query = "sensor=temperature01"
+        raw = b"".join([
+            b"\x44\x01\x30\x39",  # CON GET, TKL 4, MID 12345
+            b"\x01\x02\x03\x04",  # token
+            b"\xb4temp",  # Uri-Path (11)
+            b"\x04room",  # Uri-Path, delta 0
+            b"\x4d" + bytes([len(query) - 13]) + query.encode("utf-8"),  # Uri-Query (15)
+            b"\x81\x02",  # Block2 (23)
+            b"\xd1\x18\x00",  # unknown elective option (60), extended delta
+            b"\xffHello",
+        ])
+        msg = Message().from_raw(raw)
+        self.assertEqual(msg.version, 1)
+        self.assertEqual(msg.msg_type, refType.con)
+        self.assertEqual(msg.status_code, codes.get)
+        self.assertEqual(msg.message_id, 12345)
+        self.assertEqual(msg.token, b"\x01\x02\x03\x04")
+        self.assertEqual(msg.options[11], ["temp", "room"])
+        self.assertEqual(msg.options[15], [query])
+        self.assertEqual(msg.options[23], 2)
+        self.assertEqual(msg.payload, b"Hello")
+
+    def test_ExtendedOptionHeaders(self):
+        """
+        Round trip of option values across every delta/length encoding form.
+        """
+        for length in (1, 12, 13, 63, 64, 268, 269, 270, 1034):
+            msg = Message(status_code=codes.get, message_id=length, options={
+                11: ["p" * min(length, 255)],
+                35: "u" * length,
+            })
+            newMsg = Message().from_raw(msg.to_raw())
+            self.assertEqual(newMsg.options, msg.options, length)
+        # unknown elective option 300, 2-byte extended delta
+        raw = b"\x40\x01\x00\x01\xe1\x00\x1f\x00\xffx"
+        newMsg = Message().from_raw(raw)
+        self.assertEqual(len(newMsg.options), 0)
+        self.assertEqual(newMsg.payload, b"x")
+
+    def test_DecodeMalformed(self):
+        """
+        Truncated datagrams and reserved nibbles are rejected.
+        """
+        self.assertIsNone(Message().from_raw(b"\x40\x01"))
+        self.assertIsNone(Message().from_raw(b"\x40\x01\x30\x39\xb8temp"))
+        self.assertIsNone(Message().from_raw(b"\x40\x01\x30\x39\xf0"))
+        self.assertIsNone(Message().from_raw(b"\x40\x01\x30\x39\x0f"))
+        self.assertIsNone(Message().from_raw(b"\x40\x01\x30\x39\xd0"))
+        self.assertIsNone(Message().from_raw(b"\x40\x01\x30\x39\x0e\x01"))
+
+    def test_DecodeInvalidString(self):
+        """
+        A string option that is not valid UTF-8 makes the datagram
+        malformed, whether options are decoded lazily or not.
+        """
+        raw = b"\x40\x01\x00\x01\xb1\xff"
+        self.assertIsNone(Message().from_raw(raw))
+        self.assertIsNone(Message().from_raw(raw, lazy=False))
+        self.assertIsNone(Message().from_raw(b"\x40\x01\x00\x01\xb2a\xc3"))
+        self.assertEqual(decode_batch([raw]).decode(lazy=False), [None])
+
+    def test_LazyOptions(self):
+        """
+        Options are decoded on first access and can still be modified.
+        """
+        raw = b"\x40\x01\x30\x39\xb4temp\x04room\x43a=1\xffHi"
+        msg = Message().from_raw(raw)
+        self.assertNotIsInstance(msg.options, dict)
+        self.assertIn(11, msg.options)
+        self.assertNotIn(12, msg.options)
+        self.assertEqual(msg.options[11], ["temp", "room"])
+        msg.options[12] = 50
+        self.assertEqual(dict(msg.options), {11: ["temp", "room"], 12: 50, 15: ["a=1"]})
+        eager = Message().from_raw(raw, lazy=False)
+        self.assertEqual(eager.options, {11: ["temp", "room"], 15: ["a=1"]})
+
+    def test_BinaryPayload(self):
+        """
+        Binary payloads survive a round trip untouched, text is only decoded
+        for textual Content-Formats.
+        """
+        image = bytes(range(256))
+        msg = Message(status_code=codes.content, message_id=7,
+                      options={12: 23}, payload=image)
+        newMsg = Message().from_raw(msg.to_raw())
+        self.assertIsInstance(newMsg.payload, memoryview)
+        self.assertEqual(newMsg.payload, image)
+        self.assertIsNone(newMsg.payload_text())
+        text = Message(status_code=codes.content, message_id=8,
+                       options={12: 50}, payload="{\"t\": 21.5}")
+        self.assertEqual(Message().from_raw(text.to_raw()).payload_text(), "{\"t\": 21.5}")
+        self.assertIsNone(Message().from_raw(b"\x40\x01\x30\x39\xff"))
+
+    def test_Template(self):
+        """
+        Rendering a template only patches header and token.
+        """
+        response = Message(msg_type=refType.ack, status_code=codes.content,
+                           options={12: 0, 14: 30}, payload="22.5 C")
+        template = response.template()
+        response.message_id, response.token = 4321, b"\xca\xfe"
+        self.assertEqual(template.render(4321, b"\xca\xfe"), response.to_raw())
+        buffer = bytearray(32)
+        length = template.render_into(buffer, 2, 99, msg_type=refType.non)
+        newMsg = Message().from_raw(buffer[2:2 + length])
+        self.assertEqual(newMsg.message_id, 99)
+        self.assertEqual(newMsg.msg_type, refType.non)
+        self.assertEqual(newMsg.token, b"")
+        self.assertEqual(newMsg.options, {12: 0, 14: 30})
+        self.assertEqual(newMsg.payload_text(), "22.5 C")
+        self.assertRaises(ValueError, template.render_into, bytearray(8), 0, 1)
+        self.assertRaises(ValueError, template.render, 1, observe=2)
+
+    def test_TemplateObserve(self):
+        """
+        A notification template reserves the Observe option set by rendering.
+        """
+        notification = Message(msg_type=refType.non, status_code=codes.content,
+                               options={3: "sensor", 12: 0}, payload="22.5 C")
+        template = notification.template(observe=True)
+        for observe in (2, 0x1234, 0x1000002):
+            newMsg = Message().from_raw(template.render(7, b"\x01", observe=observe), lazy=False)
+            self.assertEqual(newMsg.options, {3: "sensor", 6: observe & 0xFFFFFF, 12: 0})
+            self.assertEqual(newMsg.payload_text(), "22.5 C")
+        buffer = bytearray(32)
+        length = template.render_into(buffer, 1, 7, b"\x01", observe=5)
+        self.assertEqual(bytes(buffer[1:1 + length]), template.render(7, b"\x01", observe=5))
+
+    def test_EncodeInto(self):
+        """
+        Serialization into a caller-supplied buffer at an offset.
+        """
+        msg = Message(
+            status_code=codes.get,
+            msg_type=refType.con,
+            message_id=12345,
+            token=b"\x01\x02",
+            options={11: ["temp", "room"], 15: ["sensor=temperature01"], 23: 2},
+            payload="Hello",
+        )
+        buffer = bytearray(64)
+        length = msg.encode_into(buffer, 3)
+        self.assertEqual(bytes(buffer[3:3 + length]), msg.to_raw())
+        newMsg = Message().from_raw(memoryview(buffer)[3:3 + length])
+        self.assertEqual(newMsg.token, msg.token)
+        self.assertEqual(newMsg.options, msg.options)
+
+    def test_EncodeIntoTooSmall(self):
+        """
+        A message that does not fit raises ValueError.
+        """
+        msg = Message(status_code=codes.get, message_id=1, payload="Hello")
+        self.assertRaises(ValueError, msg.encode_into, bytearray(6))
+
+    def test_DecodeBatch(self):
+        """
+        Header columns of a batch, then full decoding of selected rows.
+        """
+        datagrams = [
+            Message(msg_type=refType.con, status_code=codes.get, message_id=1, payload="a").to_raw(),
+            Message(msg_type=refType.ack, status_code=codes.content, message_id=0xBEEF).to_raw(),
+            b"\x40",
+            Message(msg_type=refType.non, status_code=codes.post, message_id=3).to_raw(),
+        ]
+        batch = decode_batch(datagrams)
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(list(batch.version), [1, 1, 0, 1])
+        self.assertEqual(list(batch.msg_type), [refType.con, refType.ack, 0, refType.non])
+        self.assertEqual(list(batch.status_code), [codes.get, codes.content, 0, codes.post])
+        self.assertEqual(list(batch.message_id), [1, 0xBEEF, 0, 3])
+        self.assertEqual(batch.select(), [0, 1, 3])
+        self.assertEqual(batch.select(msg_type=refType.ack), [1])
+        msg, = batch.decode(batch.select(status_code=codes.get))
+        self.assertEqual(msg.payload, b"a")
+
+        contiguous = b"".join(datagrams)
+        offsets = [0]
+        for datagram in datagrams[:-1]:
+            offsets.append(offsets[-1] + len(datagram))
+        batch = decode_batch(contiguous, offsets)
+        self.assertEqual(list(batch.message_id), [1, 0xBEEF, 0, 3])
+        self.assertEqual(batch.decode([3])[0].message_id, 3)
+
+    def test_Keys(self):
+        """
+        Exchange keys of a received message match the keys of the message
+        sent, without string formatting.
+        """
+        peer = ("192.0.2.1", 5683)
+        sent = Message(msg_type=refType.con, status_code=codes.get,
+                       message_id=7, token=b"\x2a", peerAddress=peer)
+        received = Message().from_raw(sent.to_raw())
+        received.peerAddress = peer
+        self.assertEqual(received.key(), (peer, 7, refType.con))
+        self.assertEqual(received.transactionKey(), sent.transactionKey())
+        self.assertEqual(received.sequenceKey(), (peer, b"\x2a"))
+        self.assertEqual(len({sent.sequenceKey(), received.sequenceKey()}), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
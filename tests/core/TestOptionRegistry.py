@@ -0,0 +1,51 @@
+# coding=utf-8
+
+"""
+Testing suite for the option descriptor table.
+"""
+
+import unittest
+from pycolo.codes import options, optionTable, getOption
+
+
+class OptionRegistryTest(unittest.TestCase):
+    """
+    Lookups and codecs of the option registry.
+    """
+
+    def testLookup(self):
+        """
+        Same descriptor by number, name and alias.
+        """
+        descriptor = optionTable[11]
+        self.assertEqual(descriptor.name, "Uri-Path")
+        self.assertIs(getOption("Uri-Path"), descriptor)
+        self.assertIs(getOption("uri_path"), descriptor)
+        self.assertIs(getOption(options.URI_PATH), descriptor)
+        self.assertTrue(descriptor.repeatable)
+        self.assertIsNone(getOption(2))
+        self.assertIsNone(getOption(1000))
+        self.assertIsNone(getOption("unknown"))
+
+    def testUintCodec(self):
+        """
+        Unsigned integers use the shortest encoding.
+        """
+        descriptor = getOption("max_age")
+        self.assertEqual(descriptor.encoder(0), b"")
+        self.assertEqual(descriptor.encoder(255), b"\xff")
+        self.assertEqual(descriptor.encoder(256), b"\x01\x00")
+        self.assertEqual(descriptor.decoder(b"\x01\x00"), 256)
+        self.assertEqual(descriptor.default, 60)
+
+    def testStringCodec(self):
+        """
+        Strings are UTF-8 encoded.
+        """
+        descriptor = getOption("uri_host")
+        self.assertEqual(descriptor.encoder("café"), b"caf\xc3\xa9")
+        self.assertEqual(descriptor.decoder(memoryview(b"caf\xc3\xa9")), "café")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# coding=utf-8
+
+"""
+Testing suite for the SO_REUSEPORT multi-process server.
+"""
+
+import socket
+import time
+import unittest
+
+from pycolo.codes import codes
+from pycolo.codes import msgType as refType
+from pycolo.endpoint import ReusePortServer
+from pycolo.message import Message
+from tests.core.helpers import Echo
+
+
+def echoStack(layer):
+    layer.registerReceiver(Echo(layer))
+    return layer
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT is not available")
+class ReusePortServerTest(unittest.TestCase):
+    """
+    Serving a port from several worker processes.
+    """
+
+    def setUp(self):
+        self.server = ReusePortServer(echoStack, workers=2, port=0, address="127.0.0.1").start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def ping(self, count):
+        """
+        Sends a CON from count client sockets and waits for the ACKs.
+        """
+        answered = 0
+        for mid in range(count):
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.settimeout(5)
+            try:
+                request = Message(msg_type=refType.con, status_code=codes.get, message_id=mid)
+                client.sendto(request.to_raw(), ("127.0.0.1", self.server.port))
+                response = Message().from_raw(client.recv(1024))
+                answered += response.message_id == mid and response.msg_type == refType.ack
+            finally:
+                client.close()
+        return answered
+
+    def waitForStats(self, count, timeout=5):
+        """
+        Polls the statistics of the workers until count messages were
+        received and sent, or timeout seconds elapsed: a worker counts a
+        message sent only after the client may have received it.
+        """
+        deadline = time.monotonic() + timeout
+        stats = self.server.getStats()
+        while (stats["Messages received"] < count or stats["Messages sent"] < count) \
+                and time.monotonic() < deadline:
+            time.sleep(0.05)
+            stats = self.server.getStats()
+        return stats
+
+    def testServe(self):
+        self.assertEqual(self.ping(20), 20)
+        stats = self.waitForStats(20)
+        self.assertEqual(stats["Workers"], 2)
+        self.assertEqual(stats["Messages received"], 20)
+        self.assertEqual(stats["Messages sent"], 20)
+
+    def testRestart(self):
+        """
+        A worker that dies is replaced and the port keeps being served.
+        """
+        self.server.processes[0].terminate()
+        for _ in range(100):
+            if self.server.restarts:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.server.restarts, 1)
+        self.assertEqual(self.ping(10), 10)
+        self.assertEqual(self.server.getStats()["Workers"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
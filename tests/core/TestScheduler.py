@@ -0,0 +1,166 @@
+# coding=utf-8
+
+"""
+Testing suite for the client request scheduler.
+"""
+
+import threading
+import time
+import unittest
+
+from pycolo.codes import codes, options
+from pycolo.codes import msgType as refType
+from pycolo.layers import Communicator
+from pycolo.message import Message
+from pycolo.scheduler import RequestScheduler
+
+
+class Gate:
+    """
+    Keeps the requests received by a server until the test answers them.
+    """
+
+    def __init__(self, communicator):
+        self.communicator = communicator
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def receiveMessage(self, msg):
+        with self.lock:
+            self.requests.append(msg)
+
+    def waitFor(self, count):
+        for _ in range(200):
+            if len(self.requests) >= count:
+                break
+            time.sleep(0.01)
+        # leave time for unexpected extra requests
+        time.sleep(0.05)
+        return len(self.requests)
+
+    def answer(self, request, payload=None):
+        self.communicator.sendMessage(Message(
+            msg_type=refType.ack if request.msg_type == refType.con else refType.non,
+            status_code=codes.content,
+            message_id=request.message_id if request.msg_type == refType.con else None,
+            token=request.token,
+            payload=bytes(request.payload) if payload is None else payload,
+            peerAddress=request.peerAddress))
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Communicator(port=0, address="127.0.0.1")
+        self.client = Communicator(port=0, address="127.0.0.1")
+        self.gate = Gate(self.server)
+        self.server.registerReceiver(self.gate)
+        self.scheduler = RequestScheduler(self.client, nstart=1)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def request(self, msg_type, number):
+        return Message(msg_type=msg_type, status_code=codes.get, payload=b"%d" % number,
+                       peerAddress=("127.0.0.1", self.server.getPort()))
+
+    def testNstart(self):
+        """
+        Confirmable requests to one destination are sent one at a time.
+        """
+        futures = [self.scheduler.submit(self.request(refType.con, number)) for number in range(4)]
+        self.assertEqual(self.scheduler.getStats()["Queued requests"], 3)
+        for number in range(4):
+            self.assertEqual(self.gate.waitFor(number + 1), number + 1)
+            self.gate.answer(self.gate.requests[number])
+        results = [bytes(future.result(2).payload) for future in futures]
+        self.assertEqual(results, [b"0", b"1", b"2", b"3"])
+        self.assertEqual(self.scheduler.getStats()["Destinations"], 0)
+
+    def testPipelining(self):
+        """
+        Non-confirmable requests are all sent at once, and dispatched as
+        their responses arrive.
+        """
+        futures = [self.scheduler.submit(self.request(refType.non, number)) for number in range(4)]
+        self.assertEqual(self.gate.waitFor(4), 4)
+        for request in reversed(self.gate.requests):
+            self.gate.answer(request)
+        results = [bytes(future.result(2).payload) for future in futures]
+        self.assertEqual(results, [b"0", b"1", b"2", b"3"])
+
+
+class Representation:
+    """
+    Resource answering every request with the same large representation.
+    """
+
+    def __init__(self, communicator, payload):
+        self.communicator = communicator
+        self.payload = payload
+        self.requests = 0
+        self.shrinkTo = None
+
+    def receiveMessage(self, msg):
+        self.requests += 1
+        Gate(self.communicator).answer(msg, self.payload)
+        if self.requests == 1 and self.shrinkTo is not None:
+            # the next blocks are smaller than the first one
+            self.communicator.transferLayer.peerStatistics = None
+            self.communicator.transferLayer.defaultSZX = self.shrinkTo
+
+
+class WindowedDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Communicator(port=0, address="127.0.0.1", defaultBlockSize=64)
+        self.client = Communicator(port=0, address="127.0.0.1")
+        self.payload = bytes(range(256)) * 5
+        self.resource = Representation(self.server, self.payload)
+        self.server.registerReceiver(self.resource)
+        self.scheduler = RequestScheduler(self.client, nstart=1)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def request(self, msg_type):
+        return Message(msg_type=msg_type, status_code=codes.get,
+                       peerAddress=("127.0.0.1", self.server.getPort()))
+
+    def testWindow(self):
+        """
+        The blocks are requested concurrently and reassembled into a single
+        response.
+        """
+        response = self.scheduler.download(self.request(refType.non), window=8).result(5)
+        self.assertEqual(bytes(response.payload), self.payload)
+        self.assertNotIn(options.block2, response.options)
+        self.assertEqual(response.options[options.size2], len(self.payload))
+        self.assertEqual(self.resource.requests, len(self.payload) // 64)
+
+    def testConfirmable(self):
+        response = self.scheduler.download(self.request(refType.con), window=8, szx=3).result(5)
+        self.assertEqual(bytes(response.payload), self.payload)
+
+    def testShrink(self):
+        """
+        Blocks shrunk by the server partway through are all fetched.
+        """
+        self.server.transferLayer.peerStatistics = None
+        self.server.transferLayer.defaultSZX = 6
+        self.resource.payload = bytes(range(256)) * 12
+        self.resource.shrinkTo = 5
+        response = self.scheduler.download(self.request(refType.non), window=8).result(5)
+        self.assertEqual(bytes(response.payload), self.resource.payload)
+        self.assertEqual(self.resource.requests, 1 + 2048 // 512)
+
+    def testSmall(self):
+        self.resource.payload = b"small"
+        response = self.scheduler.download(self.request(refType.con)).result(5)
+        self.assertEqual(bytes(response.payload), b"small")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# coding=utf-8
+
+"""
+Testing suite for the hashed timing wheel.
+"""
+
+import asyncio
+import unittest
+
+from pycolo.timing import TimingWheel
+from tests.core.helpers import Clock
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimingWheel(tick=0.01, slots=8, clock=self.clock)
+        self.fired = []
+
+    def testSchedule(self):
+        self.wheel.schedule(0.05, self.fired.append, "a")
+        self.wheel.schedule(0.02, self.fired.append, "b")
+        self.assertEqual(len(self.wheel), 2)
+        self.clock.now = 0.03
+        self.assertEqual(self.wheel.advance(), 1)
+        self.assertEqual(self.fired, ["b"])
+        self.clock.now = 0.05
+        self.wheel.advance()
+        self.assertEqual(self.fired, ["b", "a"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def testBeyondOneTurn(self):
+        """
+        Timeouts further away than the ring stay in their slot until due.
+        """
+        self.wheel.schedule(0.25, self.fired.append, "late")
+        self.wheel.schedule(0.01, self.fired.append, "early")
+        self.clock.now = 0.17
+        self.wheel.advance()
+        self.assertEqual(self.fired, ["early"])
+        self.clock.now = 0.25
+        self.wheel.advance()
+        self.assertEqual(self.fired, ["early", "late"])
+
+    def testLongGap(self):
+        """
+        Advancing over many turns at once fires everything due, in order.
+        """
+        for delay in (0.3, 0.1, 0.2):
+            self.wheel.schedule(delay, self.fired.append, delay)
+        self.clock.now = 1.0
+        self.assertEqual(self.wheel.advance(), 3)
+        self.assertEqual(self.fired, [0.1, 0.2, 0.3])
+
+    def testCancel(self):
+        timeout = self.wheel.schedule(0.02, self.fired.append, "a")
+        timeout.cancel()
+        timeout.cancel()
+        self.assertEqual(len(self.wheel), 0)
+        self.clock.now = 1.0
+        self.assertEqual(self.wheel.advance(), 0)
+        self.assertEqual(self.fired, [])
+
+    def testAsyncio(self):
+        async def run():
+            wheel = TimingWheel(tick=0.005).attach()
+            done = asyncio.get_running_loop().create_future()
+            wheel.schedule(0.02, done.set_result, "done")
+            try:
+                return await asyncio.wait_for(done, 1)
+            finally:
+                wheel.stop()
+
+        self.assertEqual(asyncio.run(run()), "done")
+
+
+if __name__ == '__main__':
+    unittest.main()
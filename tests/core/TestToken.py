@@ -0,0 +1,68 @@
+# coding=utf-8
+
+"""
+Testing suite for the token allocator.
+"""
+
+import threading
+import unittest
+
+from pycolo.token import TokenManager
+
+
+class TokenManagerTest(unittest.TestCase):
+
+    def testEmptyTokenPreferred(self):
+        manager = TokenManager()
+        self.assertEqual(manager.acquireToken(True), b"")
+        token = manager.acquireToken(True)
+        self.assertEqual(len(token), 8)
+        manager.releaseToken(b"")
+        self.assertEqual(manager.acquireToken(True), b"")
+
+    def testUnique(self):
+        manager = TokenManager(length=2, quarantine=0)
+        tokens = [manager.acquireToken() for _ in range(2 ** 16)]
+        self.assertEqual(len(set(tokens)), 2 ** 16)
+        self.assertTrue(all(len(token) == 2 for token in tokens))
+        self.assertRaises(RuntimeError, manager.acquireToken)
+
+    def testReuseOldestReleased(self):
+        """
+        Released tokens come back in release order, after the quarantine.
+        """
+        manager = TokenManager(length=1, quarantine=2)
+        tokens = [manager.acquireToken() for _ in range(4)]
+        for token in tokens:
+            manager.releaseToken(token)
+        self.assertEqual(manager.acquireToken(), tokens[0])
+        self.assertEqual(manager.acquireToken(), tokens[1])
+        self.assertNotIn(manager.acquireToken(), tokens)
+
+    def testExhaustedSpaceReuses(self):
+        manager = TokenManager(length=1, quarantine=10)
+        tokens = [manager.acquireToken() for _ in range(256)]
+        manager.releaseToken(tokens[5])
+        self.assertEqual(manager.acquireToken(), tokens[5])
+
+    def testThreads(self):
+        manager = TokenManager(quarantine=10000)
+        acquired = []
+
+        def work():
+            tokens = [manager.acquireToken() for _ in range(1000)]
+            acquired.extend(tokens)
+            for token in tokens[::2]:
+                manager.releaseToken(token)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(acquired)), 4000)
+        self.assertEqual(len(manager.acquiredTokens), 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
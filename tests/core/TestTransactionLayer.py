@@ -0,0 +1,239 @@
+# coding=utf-8
+
+"""
+Testing suite for the reliability and exchange layers.
+"""
+
+import unittest
+
+from pycolo import MAX_RETRANSMIT, RESPONSE_RANDOM_FACTOR, RESPONSE_TIMEOUT
+from pycolo.blockwise import PeerStatistics
+from pycolo.codes import codes
+from pycolo.codes import msgType as refType
+from pycolo.layers import MatchingLayer, TokenLayer, TransactionLayer
+from pycolo.message import Message
+from pycolo.timing import TimingWheel
+from tests.core.helpers import Clock, Recorder
+
+
+def request(msg_type=refType.con, message_id=1):
+    return Message(msg_type=msg_type, status_code=codes.get,
+                   message_id=message_id, peerAddress=("127.0.0.1", 5683))
+
+
+class TransactionLayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimingWheel(tick=0.01, clock=self.clock)
+        self.layer = TransactionLayer(timer=self.wheel)
+        self.lower = Recorder()
+        self.layer.setLowerLayer(self.lower)
+
+    def testRetransmission(self):
+        """
+        A CON is retransmitted MAX_RETRANSMIT times with exponential backoff,
+        then times out.
+        """
+        msg = request()
+        timedOut = []
+        msg.timeoutHandler = timedOut.append
+        self.layer.sendMessage(msg)
+        self.assertEqual(len(self.lower.sent), 1)
+        timeout = self.layer.getTransaction(msg).timeout / 1000
+        self.assertTrue(RESPONSE_TIMEOUT / 1000 <= timeout <= RESPONSE_TIMEOUT * RESPONSE_RANDOM_FACTOR / 1000)
+        for attempt in range(MAX_RETRANSMIT):
+            self.clock.now += timeout * 2 ** attempt + 0.02
+            self.wheel.advance()
+            self.assertEqual(len(self.lower.sent), attempt + 2)
+        self.assertEqual(timedOut, [])
+        self.clock.now += timeout * 2 ** MAX_RETRANSMIT + 0.02
+        self.wheel.advance()
+        self.assertEqual(timedOut, [msg])
+        self.assertEqual(len(self.wheel), 0)
+
+    def testAcknowledged(self):
+        """
+        The ACK completes the transaction and cancels its retransmission.
+        """
+        msg = request()
+        self.layer.sendMessage(msg)
+        self.layer.receiveMessage(msg.new_accept())
+        self.assertIsNone(self.layer.getTransaction(msg))
+        self.assertEqual(len(self.wheel), 0)
+
+    def testDuplicate(self):
+        """
+        A duplicated CON is answered with the cached reply, not delivered.
+        """
+        delivered = []
+        self.layer.registerReceiver(type("Sink", (), {"receiveMessage": lambda _, msg: delivered.append(msg)})())
+        incoming = request()
+        self.layer.receiveMessage(incoming)
+        reply = incoming.new_accept()
+        self.layer.sendMessage(reply)
+        self.layer.receiveMessage(request())
+        self.assertEqual(delivered, [incoming])
+        self.assertEqual(self.lower.sent, [reply, reply])
+
+    def testServedExchanges(self):
+        """
+        On a server, new requests are clean exchanges: the block size of a
+        peer grows back after the losses shown by duplicates.
+        """
+        statistics = PeerStatistics(defaultSZX=5, growAfter=16)
+        self.layer.peerStatistics = statistics
+        peer = ("127.0.0.1", 5683)
+        for message_id in (1, 2):
+            self.layer.receiveMessage(request(message_id=message_id))
+            self.layer.sendMessage(request(message_id=message_id).new_accept())
+            self.layer.receiveMessage(request(message_id=message_id))
+        for _ in range(5):
+            statistics.recordLoss(peer)
+        self.assertLess(statistics.getSZX(peer), 5)
+        for message_id in range(3, 200):
+            self.layer.receiveMessage(request(message_id=message_id))
+        self.assertEqual(statistics.getSZX(peer), 6)
+        self.assertEqual(statistics.getStats()[peer]["Exchanges"], 206)
+
+
+class MessageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = TransactionLayer.MessageCache(capacity=4, lifetime=10, clock=self.clock)
+
+    def testEviction(self):
+        """
+        The oldest entries are overwritten once the ring is full.
+        """
+        for mid in range(6):
+            self.cache.put(("peer", mid), mid)
+        self.assertEqual(len(self.cache), 4)
+        self.assertIsNone(self.cache.get(("peer", 0)))
+        self.assertEqual(self.cache.get(("peer", 5)), 5)
+        stats = self.cache.getStats()
+        self.assertEqual((stats["Hits"], stats["Misses"], stats["Evictions"]), (1, 1, 2))
+
+    def testExpiry(self):
+        self.cache.put(("peer", 1), "msg")
+        self.clock.now = 9
+        self.assertIn(("peer", 1), self.cache)
+        self.clock.now = 11
+        self.assertNotIn(("peer", 1), self.cache)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.getStats()["Expirations"], 1)
+
+    def testUpdate(self):
+        """
+        Caching a key again replaces its message in place.
+        """
+        self.cache.put(("peer", 1), "first")
+        self.cache.put(("peer", 1), "second")
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get(("peer", 1)), "second")
+
+
+class MatchingLayerTest(unittest.TestCase):
+
+    def testMatch(self):
+        layer = MatchingLayer()
+        layer.setLowerLayer(Recorder())
+        delivered = []
+        layer.registerReceiver(type("Sink", (), {"receiveMessage": lambda _, msg: delivered.append(msg)})())
+        sent = request()
+        sent.token = b"\x01"
+        layer.sendMessage(sent)
+        self.assertIsNotNone(layer.getOpenRequest((sent.peerAddress, b"\x01")))
+        stranger = Message(msg_type=refType.ack, status_code=codes.content, message_id=2,
+                           token=b"\x02", peerAddress=sent.peerAddress)
+        layer.receiveMessage(stranger)
+        response = Message(msg_type=refType.ack, status_code=codes.content, message_id=1,
+                           token=b"\x01", peerAddress=sent.peerAddress)
+        layer.receiveMessage(response)
+        self.assertEqual(delivered, [response])
+        self.assertEqual(layer.getStats()["Open requests"], 0)
+
+    def testExpiry(self):
+        clock = Clock()
+        layer = MatchingLayer(timer=TimingWheel(tick=0.01, clock=clock), lifetime=1000)
+        layer.setLowerLayer(Recorder())
+        layer.sendMessage(request(refType.non))
+        self.assertEqual(len(layer.pairs), 1)
+        clock.now = 1.5
+        layer.timer.advance()
+        self.assertEqual(layer.pairs, {})
+
+
+class FailureTest(unittest.TestCase):
+    """
+    Open requests, exchanges and transactions are cleared when a request
+    fails, whichever layer detects it.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimingWheel(tick=0.01, clock=self.clock)
+        self.tokenLayer = TokenLayer(sequenceTimeout=100000, timer=self.wheel)
+        self.matchingLayer = MatchingLayer(timer=self.wheel)
+        self.transactionLayer = TransactionLayer(timer=self.wheel)
+        self.lower = Recorder()
+        self.tokenLayer.setLowerLayer(self.matchingLayer)
+        self.matchingLayer.setLowerLayer(self.transactionLayer)
+        self.transactionLayer.setLowerLayer(self.lower)
+
+    def assertCleared(self):
+        self.assertEqual(self.matchingLayer.pairs, {})
+        self.assertEqual(self.tokenLayer.exchanges, {})
+        self.assertEqual(self.transactionLayer.transactionTable, {})
+
+    def send(self, msg_type=refType.con):
+        msg = request(msg_type)
+        msg.message_id = None
+        self.tokenLayer.sendMessage(msg)
+        self.assertIn(msg.sequenceKey(), self.matchingLayer.pairs)
+        return msg
+
+    def testTransactionTimeout(self):
+        msg = self.send()
+        timedOut = []
+        msg.timeoutHandler = timedOut.append
+        for _ in range(MAX_RETRANSMIT + 1):
+            self.clock.now += 100
+            self.wheel.advance()
+        self.assertEqual(timedOut, [msg])
+        self.assertCleared()
+
+    def testReset(self):
+        msg = self.send()
+        self.transactionLayer.receiveMessage(msg.new_reject())
+        self.assertCleared()
+
+    def testExchangeTimeout(self):
+        self.send(refType.non)
+        self.send()
+        self.clock.now += 101
+        self.wheel.advance()
+        self.assertCleared()
+
+
+class TokenLayerTest(unittest.TestCase):
+
+    def testOverallTimeout(self):
+        clock = Clock()
+        wheel = TimingWheel(tick=0.01, clock=clock)
+        layer = TokenLayer(sequenceTimeout=1000, timer=wheel)
+        layer.setLowerLayer(Recorder())
+        msg = request(refType.non)
+        timedOut = []
+        msg.timeoutHandler = timedOut.append
+        layer.sendMessage(msg)
+        self.assertEqual(layer.getStats()["Request-Response exchanges"], 1)
+        clock.now = 1.5
+        wheel.advance()
+        self.assertEqual(timedOut, [msg])
+        self.assertEqual(layer.getStats()["Request-Response exchanges"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
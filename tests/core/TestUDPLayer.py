@@ -0,0 +1,141 @@
+# coding=utf-8
+
+"""
+Testing suite for the UDP transport layers.
+"""
+
+import asyncio
+import socket
+import unittest
+
+from pycolo.codes import codes
+from pycolo.codes import msgType as refType
+from pycolo.layers import AsyncUDPLayer, UDPLayer
+from pycolo.message import Message
+from pycolo.mmsg import BatchReceiver, hasNativeBatching, sendBatch
+from tests.core.helpers import Collector, Echo
+
+
+class BatchIOTest(unittest.TestCase):
+    """
+    Batched datagram I/O, with recvmmsg and sendmmsg and with the fallback
+    loop.
+    """
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(("127.0.0.1", 0))
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender.bind(("127.0.0.1", 0))
+
+    def tearDown(self):
+        self.receiver.close()
+        self.sender.close()
+
+    def checkBatch(self, native):
+        datagrams = [(b"datagram %d" % i, self.receiver.getsockname()) for i in range(5)]
+        self.assertEqual(sendBatch(self.sender, datagrams, native), 5)
+        receiver = BatchReceiver(self.receiver, 8, 64, native)
+        received = []
+        while len(received) < 5:
+            received.extend((bytes(buffer[:length]), address) for buffer, length, address in receiver.receive())
+        self.assertEqual([data for data, address in received], [data for data, address in datagrams])
+        self.assertEqual(received[0][1], self.sender.getsockname())
+
+    @unittest.skipUnless(hasNativeBatching(), "recvmmsg is not available")
+    def testNative(self):
+        self.checkBatch(True)
+
+    def testFallback(self):
+        self.checkBatch(False)
+
+    @unittest.skipUnless(hasNativeBatching(), "sendmmsg is not available")
+    def testHostName(self):
+        """
+        Datagrams to a host name are sent along with the batch.
+        """
+        port = self.receiver.getsockname()[1]
+        datagrams = [(b"datagram %d" % i, ("localhost" if i % 2 else "127.0.0.1", port)) for i in range(4)]
+        self.assertEqual(sendBatch(self.sender, datagrams, True), 4)
+        receiver = BatchReceiver(self.receiver, 8, 64, True)
+        received = []
+        while len(received) < 4:
+            received.extend(bytes(buffer[:length]) for buffer, length, address in receiver.receive())
+        self.assertEqual(sorted(received), [data for data, address in datagrams])
+
+
+class UDPLayerTest(unittest.TestCase):
+    """
+    Exchange of messages through threaded UDP layers.
+    """
+
+    def checkExchange(self, batchSize):
+        server = UDPLayer(port=0, batchSize=batchSize, address="127.0.0.1")
+        client = UDPLayer(port=0, address="127.0.0.1")
+        server.registerReceiver(Echo(server))
+        collector = Collector()
+        client.registerReceiver(collector)
+        try:
+            for mid in range(10):
+                client.sendMessage(Message(
+                    msg_type=refType.con,
+                    status_code=codes.get,
+                    message_id=mid,
+                    peerAddress=("127.0.0.1", server.getPort())))
+            collector.waitFor(10)
+        finally:
+            client.close()
+            server.close()
+        self.assertEqual(sorted(msg.message_id for msg in collector.messages), list(range(10)))
+        self.assertEqual(collector.messages[0].msg_type, refType.ack)
+        self.assertEqual(server.getStats()["Messages sent"], 10)
+
+    def testExchange(self):
+        self.checkExchange(1)
+
+    def testBatchExchange(self):
+        """
+        Messages sent while handling a batch are flushed at its end.
+        """
+        self.checkExchange(16)
+
+
+class AsyncUDPLayerTest(unittest.TestCase):
+    """
+    Exchange of messages between two asyncio UDP layers.
+    """
+
+    def testExchange(self):
+        """
+        A message sent by one layer is delivered to the receivers of the
+        other one, with the sender address.
+        """
+        async def exchange():
+            server = await AsyncUDPLayer(port=0, address="127.0.0.1").open()
+            client = await AsyncUDPLayer(port=0, address="127.0.0.1").open()
+            collector = Collector()
+            server.registerReceiver(collector)
+            try:
+                for mid in range(3):
+                    client.sendMessage(Message(
+                        msg_type=refType.non,
+                        status_code=codes.get,
+                        message_id=mid,
+                        peerAddress=("127.0.0.1", server.getPort())))
+                for _ in range(100):
+                    if len(collector.messages) == 3:
+                        break
+                    await asyncio.sleep(0.01)
+                return collector.messages, client.getPort(), server.getStats()
+            finally:
+                client.close()
+                server.close()
+
+        messages, port, stats = asyncio.run(exchange())
+        self.assertEqual([msg.message_id for msg in messages], [0, 1, 2])
+        self.assertEqual(messages[0].peerAddress, ("127.0.0.1", port))
+        self.assertEqual(stats["Messages received"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
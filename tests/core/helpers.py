@@ -0,0 +1,82 @@
+# coding=utf-8
+
+"""
+Helpers shared by the testing suites of the layer stack.
+"""
+
+import time
+
+from pycolo.codes import codes, options
+from pycolo.codes import msgType as refType
+from pycolo.layers import Layer
+from pycolo.message import Message
+
+
+class Clock:
+    """
+    Manually advanced clock.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Recorder(Layer):
+    """
+    Lowest layer keeping the messages sent through it.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def doSendMessage(self, msg):
+        self.sent.append(msg)
+
+
+class Collector:
+    """
+    Receiver keeping the messages delivered by a layer.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def receiveMessage(self, msg):
+        self.messages.append(msg)
+
+    def waitFor(self, count, timeout=2):
+        """
+        Waits until count messages were delivered, or timeout seconds
+        elapsed.
+
+        :return: the messages delivered
+        """
+        deadline = time.monotonic() + timeout
+        while len(self.messages) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.messages
+
+
+class Echo:
+    """
+    Answers every message with a piggybacked response, from the thread
+    delivering it.
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def receiveMessage(self, msg):
+        response = Message(
+            msg_type=refType.ack,
+            status_code=codes.content,
+            message_id=msg.message_id,
+            token=msg.token,
+            payload=b"pong",
+            peerAddress=msg.peerAddress)
+        if options.observe in msg.options:
+            response.options[options.observe] = 1
+        self.layer.sendMessage(response)